@@ -1,14 +1,64 @@
-from kubernetes import client, config
+"""Report completed kaniko pods to pubgrade.
+
+Kaniko pods are watched (selected by label) instead of polled. The watch
+resumes from the last seen `resourceVersion` after disconnects; when that
+version is too old (410 Gone), all pods are listed again. Pods are also
+relisted every `RESYNC_INTERVAL` seconds as a safety net for missed events.
+
+Pods which succeeded, failed (including evicted pods) or exceeded the
+build timeout set in their `pubgrade/timeout-seconds` annotation are
+reported; timed out pods are deleted. Each completion is reported once:
+reported pods are annotated (and remembered), so that neither relists nor
+restarts of the updater report them again.
+
+Completions are reported by a background thread in micro-batches of up to
+`BATCH_SIZE` completions, collected for at most `BATCH_INTERVAL` seconds.
+Completions that pubgrade did not accept are retried with exponential
+backoff and jitter.
+"""
+
+from kubernetes import client, config, watch
+from kubernetes.client import ApiException
+import datetime
+import heapq
+import itertools
+import logging
 import os
+import queue
+import random
+import threading
 import time
 import requests
 import json
+from urllib3.exceptions import HTTPError
 
 NAMESPACE = "broker"
 BROKER_PORT = "8080"
-SLEEP_INTERVAL = 5
 BUILD_ID_LENGTH = 6
 BROKER_URL = ""
+LABEL_SELECTOR = (
+    "app.kubernetes.io/component=kaniko,app.kubernetes.io/managed-by=pubgrade"
+)
+# Seconds between full relists of kaniko pods.
+RESYNC_INTERVAL = 300
+# Seconds to wait before watching again after an error.
+RETRY_INTERVAL = 5
+# Annotation marking pods whose completion was reported.
+REPORTED_ANNOTATION = "pubgrade/completion-reported"
+# Annotation holding the seconds after which a pod times out.
+TIMEOUT_ANNOTATION = "pubgrade/timeout-seconds"
+# Attempts to report a completion, and bounds of the delay between them.
+MAX_REPORT_ATTEMPTS = 8
+REPORT_BACKOFF_BASE = 1
+REPORT_BACKOFF_MAX = 60
+# Completions reported per request, and seconds to wait for further
+# completions before reporting.
+BATCH_SIZE = 100
+BATCH_INTERVAL = 0.5
+REQUEST_TIMEOUT = 60
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 if os.getenv("NAMESPACE"):
     NAMESPACE = os.getenv("NAMESPACE")
@@ -20,11 +70,33 @@ else:
 
 if os.getenv("BROKER_URL"):
     BROKER_URL = os.getenv("BROKER_URL")
-    BROKER_URL = BROKER_URL + "/repositories/{}/builds/{}"
+COMPLETIONS_URL = BROKER_URL + "/builds/completions"
 
 if os.getenv("BROKER_PORT"):
     BROKER_PORT = os.getenv("BROKER_PORT")
 
+if os.getenv("LABEL_SELECTOR"):
+    LABEL_SELECTOR = os.getenv("LABEL_SELECTOR")
+
+if os.getenv("RESYNC_INTERVAL"):
+    RESYNC_INTERVAL = int(os.getenv("RESYNC_INTERVAL"))
+
+if os.getenv("BATCH_SIZE"):
+    BATCH_SIZE = int(os.getenv("BATCH_SIZE"))
+
+if os.getenv("BATCH_INTERVAL"):
+    BATCH_INTERVAL = float(os.getenv("BATCH_INTERVAL"))
+
+# Identifiers of pods whose completion was already reported.
+reported_pods = set()
+# Identifiers of pods whose completion is queued or retried.
+reporting_pods = set()
+pods_lock = threading.Lock()
+# Completions to report: (pod, outcome, annotate, attempts).
+report_queue = queue.Queue()
+# Pending or running pods with a timeout: pod identifier -> (deadline, pod).
+deadlines = {}
+
 
 def get_env(env, name):
     for var in env:
@@ -32,27 +104,407 @@ def get_env(env, name):
             return var.value
 
 
-while True:
-    v1 = client.CoreV1Api()
-    pods = v1.list_namespaced_pod(namespace=NAMESPACE, watch=False)
+def get_outcome(pod):
+    """Get state to report for a finished pod.
+
+    Returns:
+        Tuple of state (`SUCCEEDED` or `FAILED`), reason and exit code, or
+        `None` if the pod did not finish.
+    """
+    if pod.status.phase == "Succeeded":
+        return "SUCCEEDED", "", None
+    if pod.status.phase != "Failed":
+        return None
+    reason = pod.status.reason or "Failed"
+    exit_code = None
+    for container_status in pod.status.container_statuses or []:
+        terminated = container_status.state.terminated
+        if terminated is not None:
+            reason = terminated.reason or reason
+            exit_code = terminated.exit_code
+    return "FAILED", reason, exit_code
+
+
+def get_deadline(pod):
+    """Get time after which pod times out, `None` if it has no timeout."""
+    timeout = (pod.metadata.annotations or {}).get(TIMEOUT_ANNOTATION)
+    if not timeout or pod.metadata.creation_timestamp is None:
+        return None
+    return pod.metadata.creation_timestamp + datetime.timedelta(
+        seconds=int(timeout)
+    )
+
+
+def get_completion(pod, outcome):
+    """Get completion of a kaniko pod to report to pubgrade.
+
+    Args:
+        pod: Pod as returned by the Kubernetes API.
+        outcome (tuple): State, reason and exit code, see `get_outcome`.
+
+    Returns:
+        Completion as accepted by `POST /builds/completions`, or `None` if
+        there is nothing to report.
+    """
+    if pod.spec.containers[0].env is None:
+        return None
+    build_name = get_env(pod.spec.containers[0].env, "BUILDNAME")
+    access_token = get_env(pod.spec.containers[0].env, "ACCESSTOKEN")
+    if build_name is None or access_token is None:
+        return None
+    image_index = get_env(pod.spec.containers[0].env, "IMAGE_INDEX")
+    status, reason, exit_code = outcome
+    completion = {
+        "repository_id": build_name[:BUILD_ID_LENGTH],
+        "build_id": build_name,
+        "access_token": access_token,
+        "image_index": int(image_index or 0),
+    }
+    if status != "SUCCEEDED":
+        completion.update(status=status, reason=reason, exit_code=exit_code)
+    return completion
+
+
+def report_completions(completions):
+    """Inform pubgrade that kaniko pods finished.
+
+    Args:
+        completions (list): Completions, see `get_completion`.
+
+    Returns:
+        For each completion, whether pubgrade accepted it.
+    """
+    try:
+        response = requests.request(
+            "POST",
+            COMPLETIONS_URL,
+            headers={"Content-Type": "application/json"},
+            data=json.dumps({"completions": completions}),
+            timeout=REQUEST_TIMEOUT,
+        )
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Could not report {len(completions)} pods: {e}")
+        return [False] * len(completions)
+    if not 200 <= response.status_code < 300:
+        logger.warning(
+            f"Report of {len(completions)} pods failed with status "
+            f"{response.status_code}."
+        )
+        return [False] * len(completions)
+    accepted = []
+    for completion, result in zip(completions, response.json()["results"]):
+        ok = 200 <= result["status_code"] < 300
+        if not ok:
+            logger.warning(
+                f"Report of image {completion['image_index']} of build "
+                f"{completion['build_id']} failed with status "
+                f"{result['status_code']}: {result.get('error')}"
+            )
+        accepted.append(ok)
+    return accepted
+
+
+def mark_reported(v1, pod, annotate=True):
+    with pods_lock:
+        reporting_pods.discard(pod.metadata.uid)
+        reported_pods.add(pod.metadata.uid)
+    if not annotate:
+        return
+    try:
+        v1.patch_namespaced_pod(
+            pod.metadata.name,
+            NAMESPACE,
+            {"metadata": {"annotations": {REPORTED_ANNOTATION: "true"}}},
+        )
+    except ApiException as e:
+        # Still remembered until the updater restarts.
+        logger.warning(f"Could not annotate pod {pod.metadata.name}: {e}")
+
+
+def handle_pod(v1, pod):
+    """Report pod if it finished and was not reported yet.
+
+    Args:
+        v1: CoreV1Api instance.
+        pod: Pod as returned by the Kubernetes API.
+    """
+    uid = pod.metadata.uid
+    if (pod.metadata.annotations or {}).get(REPORTED_ANNOTATION):
+        with pods_lock:
+            reported_pods.add(uid)
+        return
+    outcome = get_outcome(pod)
+    if outcome is None:
+        deadline = get_deadline(pod)
+        if deadline is not None:
+            deadlines[uid] = (deadline, pod)
+            check_timeouts(v1)
+        return
+    deadlines.pop(uid, None)
+    report(pod, outcome)
+
+
+def delete_timed_out_pod(v1, pod):
+    """Delete pod which exceeded its timeout and report it."""
+    timeout = pod.metadata.annotations[TIMEOUT_ANNOTATION]
+    logger.warning(f"Pod {pod.metadata.name} timed out after {timeout}s.")
+    try:
+        v1.delete_namespaced_pod(pod.metadata.name, NAMESPACE)
+    except ApiException as e:
+        if e.status != 404:
+            logger.error(f"Could not delete pod {pod.metadata.name}: {e}")
+    report(
+        pod,
+        ("TIMED_OUT", "Build exceeded timeout of %ss." % timeout, None),
+        annotate=False,
+    )
+
+
+def check_timeouts(v1):
+    """Delete and report pods which exceeded their timeout.
+
+    Returns:
+        Seconds until the next pod times out, `None` if there is none.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for uid, (deadline, pod) in list(deadlines.items()):
+        if deadline <= now:
+            del deadlines[uid]
+            delete_timed_out_pod(v1, pod)
+    if not deadlines:
+        return None
+    return (
+        min(deadline for deadline, _ in deadlines.values()) - now
+    ).total_seconds()
+
+
+def report(pod, outcome, annotate=True):
+    """Queue pod to be reported unless it is reported already.
+
+    Args:
+        pod: Pod as returned by the Kubernetes API.
+        outcome (tuple): State, reason and exit code, see `get_outcome`.
+        annotate (bool): Whether to annotate the pod once reported; deleted
+        pods are only remembered.
+    """
+    uid = pod.metadata.uid
+    with pods_lock:
+        if uid in reported_pods or uid in reporting_pods:
+            return
+        reporting_pods.add(uid)
+    report_queue.put((pod, outcome, annotate, 0))
+
+
+def next_batch(retries):
+    """Wait for completions to report.
+
+    Args:
+        retries (list): Heap of reports to retry, as (retry time, sequence
+        number, report) tuples.
+
+    Returns:
+        Up to `BATCH_SIZE` reports, as (pod, outcome, annotate, attempts)
+        tuples.
+    """
+    timeout = None
+    if retries:
+        timeout = max(retries[0][0] - time.monotonic(), 0)
+    batch = []
+    try:
+        batch.append(report_queue.get(timeout=timeout))
+        # Give completions of other pods a moment to arrive.
+        flush_at = time.monotonic() + BATCH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            batch.append(
+                report_queue.get(timeout=max(flush_at - time.monotonic(), 0))
+            )
+    except queue.Empty:
+        pass
+    while (
+        retries
+        and retries[0][0] <= time.monotonic()
+        and len(batch) < BATCH_SIZE
+    ):
+        batch.append(heapq.heappop(retries)[2])
+    return batch
+
+
+def report_batch(v1, retries, sequence):
+    """Report the next batch of completions, scheduling failed ones again.
+
+    Args:
+        v1: CoreV1Api instance.
+        retries (list): Heap of reports to retry, see `next_batch`.
+        sequence: Iterator of sequence numbers ordering retries due at the
+        same time.
+    """
+    pending = []
+    for pod, outcome, annotate, attempts in next_batch(retries):
+        completion = get_completion(pod, outcome)
+        if completion is None:
+            mark_reported(v1, pod, annotate)
+        else:
+            pending.append((completion, pod, outcome, annotate, attempts))
+    if not pending:
+        return
+    accepted = report_completions([item[0] for item in pending])
+    for ok, (_, pod, outcome, annotate, attempts) in zip(accepted, pending):
+        if ok:
+            logger.info(f"Reported pod {pod.metadata.name}.")
+            mark_reported(v1, pod, annotate)
+            continue
+        attempts += 1
+        if attempts >= MAX_REPORT_ATTEMPTS:
+            logger.error(
+                f"Giving up reporting pod {pod.metadata.name} after "
+                f"{attempts} attempts."
+            )
+            mark_reported(v1, pod, annotate=False)
+            continue
+        # Exponential backoff with full jitter.
+        delay = random.uniform(
+            0, min(REPORT_BACKOFF_MAX, REPORT_BACKOFF_BASE * 2 ** attempts)
+        )
+        heapq.heappush(
+            retries,
+            (
+                time.monotonic() + delay,
+                next(sequence),
+                (pod, outcome, annotate, attempts),
+            ),
+        )
+
+
+def reporter(v1):
+    """Report queued completions in batches; runs in a background thread."""
+    retries = []
+    sequence = itertools.count()
+    while True:
+        try:
+            report_batch(v1, retries, sequence)
+        except Exception:
+            logger.exception("Unexpected error reporting pods.")
+            time.sleep(RETRY_INTERVAL)
+
+
+def list_pods(v1):
+    """List kaniko pods and handle the ones that completed.
+
+    Returns:
+        Resource version to start watching from.
+    """
+    pods = v1.list_namespaced_pod(
+        namespace=NAMESPACE, label_selector=LABEL_SELECTOR
+    )
     for pod in pods.items:
-        if pod.spec.containers[0].env is not None:
-            if pod.status.phase == "Succeeded":
-                build_name = get_env(pod.spec.containers[0].env, "BUILDNAME")
-                access_token = get_env(pod.spec.containers[0].env, "ACCESSTOKEN")
-                if (
-                        build_name is not None and access_token is not None
-                ):
-                    repo_id = build_name[:BUILD_ID_LENGTH]
-                    url = BROKER_URL.format(
-                        repo_id, build_name
-                    )
-                    payload = json.dumps({"id": build_name})
-                    headers = {
-                        "X-Project-Access-Token": access_token,
-                        "Content-Type": "application/json",
-                    }
-                    response = requests.request(
-                        "PUT", url, headers=headers, data=payload
-                    )
-    time.sleep(SLEEP_INTERVAL)
+        handle_pod(v1, pod)
+    # Forget pods that were deleted in the meantime; their queued reports
+    # are still retried.
+    uids = {pod.metadata.uid for pod in pods.items}
+    with pods_lock:
+        reported_pods.intersection_update(uids)
+    for uid in set(deadlines) - uids:
+        del deadlines[uid]
+    return pods.metadata.resource_version
+
+
+def watch_pods(v1, resource_version, timeout):
+    """Handle pod events until the watch times out.
+
+    Events are read from their raw form where the client does not
+    deserialize them: bookmarks only carry a resource version, and errors
+    only a status.
+
+    Returns:
+        Last resource version seen, `None` if it expired and pods have to be
+        listed again.
+
+    Raises:
+        ApiException: Raised when the watch ended with an error other than
+        an expired resource version.
+    """
+    w = watch.Watch()
+    for event in w.stream(
+        v1.list_namespaced_pod,
+        namespace=NAMESPACE,
+        label_selector=LABEL_SELECTOR,
+        resource_version=resource_version,
+        allow_watch_bookmarks=True,
+        timeout_seconds=timeout,
+    ):
+        if event["type"] == "ERROR":
+            status = event["raw_object"]
+            if status.get("code") == 410:
+                logger.info("Resource version expired, listing pods again.")
+                return None
+            raise ApiException(
+                status=status.get("code"), reason=status.get("message")
+            )
+        resource_version = event["raw_object"]["metadata"]["resourceVersion"]
+        if event["type"] == "BOOKMARK":
+            continue
+        pod = event["object"]
+        if event["type"] == "DELETED":
+            with pods_lock:
+                reported_pods.discard(pod.metadata.uid)
+            deadlines.pop(pod.metadata.uid, None)
+        elif event["type"] in ("ADDED", "MODIFIED"):
+            handle_pod(v1, pod)
+    return resource_version
+
+
+def sync_pods(v1, resource_version, resync_at):
+    """List pods if due, then watch them until the next resync or timeout.
+
+    Args:
+        v1: CoreV1Api instance.
+        resource_version (str): Resource version to resume watching from,
+        `None` to list pods first.
+        resync_at (float): Time (`time.monotonic`) of the next relist.
+
+    Returns:
+        Resource version to resume from (`None` to list pods again) and time
+        of the next relist.
+    """
+    try:
+        if resource_version is None or time.monotonic() >= resync_at:
+            resource_version = list_pods(v1)
+            resync_at = time.monotonic() + RESYNC_INTERVAL
+        # Watch until the next resync or timeout is due.
+        timeout = resync_at - time.monotonic()
+        due_in = check_timeouts(v1)
+        if due_in is not None:
+            timeout = min(timeout, due_in)
+        return (
+            watch_pods(v1, resource_version, max(int(timeout), 1)),
+            resync_at,
+        )
+    except ApiException as e:
+        if e.status == 410:
+            logger.info("Resource version expired, listing pods again.")
+            return None, resync_at
+        logger.error(f"Could not watch pods: {e}")
+    except HTTPError as e:
+        # Resumed from the last resource version seen.
+        logger.error(f"Watch disconnected: {e}")
+    except Exception:
+        # E.g. events the client could not parse; start over from a list.
+        logger.exception("Unexpected error watching pods.")
+        resource_version = None
+    time.sleep(RETRY_INTERVAL)
+    return resource_version, resync_at
+
+
+def main():
+    v1 = client.CoreV1Api()
+    threading.Thread(target=reporter, args=(v1,), daemon=True).start()
+    resource_version = None
+    resync_at = 0
+    while True:
+        resource_version, resync_at = sync_pods(
+            v1, resource_version, resync_at
+        )
+
+
+if __name__ == "__main__":
+    main()
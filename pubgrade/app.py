@@ -5,6 +5,20 @@ import logging
 from flask import current_app
 from foca.foca import foca
 
+from pubgrade.modules.build_queue import BuildWorkerPool
+from pubgrade.modules.build_tasks import TaskWorkerPool
+from pubgrade.modules.endpoints.builds import (
+    clean_up_image,
+    fail_queued_build,
+    notify_subscriptions_of_image,
+    reset_queued_build,
+    run_queued_build,
+    sign_image,
+)
+from pubgrade.modules.endpoints.subscriptions import deliver_notification
+from pubgrade.modules.outbox import DeliveryWorkerPool
+from pubgrade.modules.scheduler import BuildScheduler
+
 logger = logging.getLogger(__name__)
 
 
@@ -39,9 +53,86 @@ def create_admin_user(app):
                 )
 
 
+def start_build_workers(app):
+    """
+    Function is used to start background workers processing queued builds.
+    """
+    queue_config = app.app.config["FOCA"].endpoints["builds"]["queue"]
+    scheduler_config = app.app.config["FOCA"].endpoints["builds"]["scheduler"]
+    scheduler = BuildScheduler(
+        max_concurrent_builds=scheduler_config["max_concurrent_builds"],
+        max_concurrent_builds_per_repository=scheduler_config[
+            "max_concurrent_builds_per_repository"
+        ],
+    )
+    pool = BuildWorkerPool(
+        app.app,
+        handler=run_queued_build,
+        failure_handler=fail_queued_build,
+        retry_handler=reset_queued_build,
+        workers=queue_config["workers"],
+        poll_interval=queue_config["poll_interval"],
+        claim_timeout=queue_config["claim_timeout"],
+        max_attempts=queue_config["max_attempts"],
+        scheduler=scheduler,
+    )
+    pool.start()
+    return pool
+
+
+def start_task_workers(app):
+    """
+    Function is used to start background workers signing built images,
+    cleaning up and notifying subscriptions left pending.
+    """
+    tasks_config = app.app.config["FOCA"].endpoints["builds"]["tasks"]
+    pool = TaskWorkerPool(
+        app.app,
+        handlers={
+            "sign": sign_image,
+            "cleanup": clean_up_image,
+            "notify": notify_subscriptions_of_image,
+        },
+        workers=tasks_config["workers"],
+        poll_interval=tasks_config["poll_interval"],
+        claim_timeout=tasks_config["claim_timeout"],
+        max_attempts=tasks_config["max_attempts"],
+        backoff_base=tasks_config["backoff_base"],
+        backoff_max=tasks_config["backoff_max"],
+        sweep_interval=tasks_config["sweep_interval"],
+    )
+    pool.start()
+    return pool
+
+
+def start_delivery_workers(app):
+    """
+    Function is used to start background workers delivering notifications
+    from the outbox to subscriptions.
+    """
+    notifications_config = app.app.config["FOCA"].endpoints["notifications"]
+    pool = DeliveryWorkerPool(
+        app.app,
+        deliver=deliver_notification,
+        workers=notifications_config["workers"],
+        poll_interval=notifications_config["poll_interval"],
+        visibility_timeout=notifications_config["visibility_timeout"],
+        renew_interval=notifications_config["renew_interval"],
+        max_attempts=notifications_config["max_attempts"],
+        backoff_base=notifications_config["backoff_base"],
+        backoff_max=notifications_config["backoff_max"],
+    )
+    pool.start()
+    return pool
+
+
 def main():
     app = foca("config.yaml")
     create_admin_user(app)
+    start_build_workers(app)
+    start_task_workers(app)
+    if app.app.config["FOCA"].endpoints["notifications"]["run_in_api"]:
+        start_delivery_workers(app)
     app.run(port=app.port)
 
 
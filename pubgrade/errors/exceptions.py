@@ -90,6 +90,18 @@ class DeletePodError(InternalServerError):
     pass
 
 
+class RegistryError(InternalServerError):
+    """Raised when container registry returned an unexpected response."""
+
+    pass
+
+
+class SigningError(InternalServerError):
+    """Raised when signing of an image could not be triggered."""
+
+    pass
+
+
 exceptions = {
     Exception: {
         "msg": "An unexpected error occurred.",
@@ -157,6 +169,14 @@ exceptions = {
         "status_code": "500",
     },
     CreatePodError: {"msg": "Unable to create pod.", "status_code": "500"},
+    RegistryError: {
+        "msg": "Unexpected response from container registry.",
+        "status_code": "500",
+    },
+    SigningError: {
+        "msg": "Unable to trigger signing of image.",
+        "status_code": "500",
+    },
     RequestNotSent: {
         "msg": "Unable to update deployment.",
         "status_code": "500",
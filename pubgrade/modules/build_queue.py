@@ -0,0 +1,272 @@
+"""Persistent queue for builds waiting to be processed.
+
+Builds registered via `POST /repositories/{id}/builds` are only stored in the
+`build_queue` collection; cloning the repository and creating the kaniko pod
+is done later by a pool of background workers which claim queued jobs
+atomically. Jobs are kept in MongoDB, so they survive restarts of the API.
+"""
+
+import datetime
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+from flask import Flask, current_app
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "QUEUED"
+CLAIMED = "CLAIMED"
+
+
+def enqueue_build(build_id: str, repository_id: str):
+    """Add build to the build queue.
+
+    Args:
+        build_id (str): Build identifier.
+        repository_id (str): Identifier of repository the build belongs to.
+    """
+    db_collection_queue = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_queue"]
+        .client
+    )
+    db_collection_queue.insert_one(
+        {
+            "id": build_id,
+            "repository_id": repository_id,
+            "state": QUEUED,
+            "queued_at": datetime.datetime.utcnow(),
+            "claimed_at": None,
+            "claimed_by": None,
+            "attempts": 0,
+        }
+    )
+
+
+def claimable_filter(claim_timeout: int) -> dict:
+    """Get query matching jobs that can be claimed.
+
+    Args:
+        claim_timeout (int): Seconds after which a claimed job is considered
+        abandoned.
+
+    Returns:
+        MongoDB filter matching queued and abandoned jobs.
+    """
+    return {
+        "$or": [
+            {"state": QUEUED},
+            {
+                "state": CLAIMED,
+                "claimed_at": {
+                    "$lt": datetime.datetime.utcnow()
+                    - datetime.timedelta(seconds=claim_timeout)
+                },
+            },
+        ]
+    }
+
+
+def claim_build(
+    worker_id: str,
+    claim_timeout: int,
+    repository_id: Optional[str] = None,
+    build_id: Optional[str] = None,
+) -> Optional[dict]:
+    """Atomically claim the oldest queued build.
+
+    Jobs claimed by a worker which did not finish them within
+    `claim_timeout` seconds (e.g. because the API was restarted) are claimed
+    again.
+
+    Args:
+        worker_id (str): Identifier of the claiming worker.
+        claim_timeout (int): Seconds after which a claimed job is considered
+        abandoned.
+        repository_id (str): Only claim builds of this repository.
+        build_id (str): Only claim this build.
+
+    Returns:
+        job (dict): Claimed job or `None` if the queue is empty.
+    """
+    db_collection_queue = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_queue"]
+        .client
+    )
+    query = claimable_filter(claim_timeout)
+    if repository_id is not None:
+        query["repository_id"] = repository_id
+    if build_id is not None:
+        query["id"] = build_id
+    return db_collection_queue.find_one_and_update(
+        query,
+        {
+            "$set": {
+                "state": CLAIMED,
+                "claimed_at": datetime.datetime.utcnow(),
+                "claimed_by": worker_id,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("queued_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def complete_build(build_id: str, worker_id: str):
+    """Remove processed build from the build queue.
+
+    Args:
+        build_id (str): Build identifier.
+        worker_id (str): Identifier of the worker holding the claim.
+    """
+    db_collection_queue = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_queue"]
+        .client
+    )
+    db_collection_queue.delete_one({"id": build_id, "claimed_by": worker_id})
+
+
+def release_build(build_id: str, worker_id: str, count_attempt: bool = True):
+    """Put claimed build back into the build queue.
+
+    Args:
+        build_id (str): Build identifier.
+        worker_id (str): Identifier of the worker holding the claim.
+        count_attempt (bool): Whether the claim counts as an attempt; not
+        the case for builds put back because they could not be admitted.
+    """
+    db_collection_queue = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_queue"]
+        .client
+    )
+    update = {
+        "$set": {"state": QUEUED, "claimed_at": None, "claimed_by": None}
+    }
+    if not count_attempt:
+        update["$inc"] = {"attempts": -1}
+    db_collection_queue.update_one(
+        {"id": build_id, "claimed_by": worker_id}, update
+    )
+
+
+class BuildWorkerPool:
+    """Pool of background threads processing queued builds.
+
+    Args:
+        app: Flask application, used to push an application context in each
+        worker thread.
+        handler: Called with the claimed job; processes the build.
+        failure_handler: Called with the claimed job and the raised exception
+        once a job has failed `max_attempts` times.
+        retry_handler: Called with the claimed job after a failed attempt
+        which is going to be retried, e.g. to clean up what it left behind.
+        workers: Number of worker threads.
+        poll_interval: Seconds to wait before polling an empty queue again.
+        claim_timeout: Seconds after which a claimed job is considered
+        abandoned and claimed again.
+        max_attempts: Number of times a job is tried before giving up.
+        scheduler: Admits claimed jobs according to concurrency limits, see
+        `pubgrade.modules.scheduler.BuildScheduler`. Jobs are claimed in
+        queue order without limits if not specified.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        handler: Callable[[dict], None],
+        failure_handler: Callable[[dict, Exception], None],
+        retry_handler: Optional[Callable[[dict], None]] = None,
+        workers: int = 4,
+        poll_interval: float = 2,
+        claim_timeout: int = 900,
+        max_attempts: int = 3,
+        scheduler=None,
+    ):
+        self.app = app
+        self.handler = handler
+        self.failure_handler = failure_handler
+        self.retry_handler = retry_handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.scheduler = scheduler
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start worker threads."""
+        for _ in range(self.workers):
+            worker_id = uuid.uuid4().hex
+            thread = threading.Thread(
+                target=self._run,
+                args=(worker_id,),
+                name=f"build-worker-{worker_id[:8]}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Signal worker threads to stop after their current job."""
+        self._stop.set()
+
+    def run_once(self, worker_id: str) -> bool:
+        """Claim and process a single job.
+
+        Args:
+            worker_id (str): Identifier of the worker.
+
+        Returns:
+            `True` if a job was processed, `False` if the queue was empty
+            or no job could be admitted.
+        """
+        with self.app.app_context():
+            if self.scheduler is not None:
+                job = self.scheduler.claim(worker_id, self.claim_timeout)
+            else:
+                job = claim_build(worker_id, self.claim_timeout)
+            if job is None:
+                return False
+            try:
+                self.handler(job)
+            except Exception as e:
+                logger.exception(
+                    f"Build {job['id']} failed (attempt {job['attempts']})."
+                )
+                if self.scheduler is not None:
+                    self.scheduler.release(job["id"])
+                if job["attempts"] < self.max_attempts:
+                    if self.retry_handler is not None:
+                        try:
+                            self.retry_handler(job)
+                        except Exception:
+                            logger.exception(
+                                f"Could not clean up build {job['id']}."
+                            )
+                    release_build(job["id"], worker_id)
+                    return True
+                self.failure_handler(job, e)
+            complete_build(job["id"], worker_id)
+            return True
+
+    def _run(self, worker_id: str):
+        while not self._stop.is_set():
+            try:
+                if not self.run_once(worker_id):
+                    time.sleep(self.poll_interval)
+            except Exception:
+                logger.exception("Unexpected error in build worker.")
+                time.sleep(self.poll_interval)
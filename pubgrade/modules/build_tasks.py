@@ -0,0 +1,570 @@
+"""Persistent queue of steps following the completion of an image.
+
+Completing an image only records its state. Signing the image, cleaning up
+its kaniko pod and the build directory and notifying subscriptions are
+stored as tasks in the `build_tasks` collection and run by a pool of
+background workers, so that completions are answered right away. Each step
+is retried independently with exponential backoff. The state of each step
+is recorded in `steps` of the image on the build document.
+
+Steps are recorded as `PENDING` in the same update that finishes the image
+and only then added to the task queue, so that steps whose task was never
+added (e.g. because the API was restarted in between) are queued by the
+workers later on, see `enqueue_pending_steps`.
+"""
+
+import datetime
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from flask import Flask, current_app
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+PENDING = "PENDING"
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+
+
+def set_step_state(
+    build_id: str,
+    image_index: int,
+    step: str,
+    state: str,
+    attempts: int,
+    error: Optional[str] = None,
+):
+    """Record state of a step on the build document.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        step (str): Name of the step, e.g. `sign`.
+        state (str): `PENDING`, `QUEUED`, `RUNNING`, `SUCCEEDED` or
+        `FAILED`.
+        attempts (int): Number of times the step was started.
+        error (str): Error of the last attempt, if it failed.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    db_collection_builds.update_one(
+        {"id": build_id},
+        {
+            "$set": {
+                f"images.{image_index}.steps.{step}": {
+                    "status": state,
+                    "attempts": attempts,
+                    "error": error,
+                    "updated_at": str(datetime.datetime.now().isoformat()),
+                }
+            }
+        },
+    )
+
+
+def get_task_id(build_id: str, image_index: int, step: str) -> str:
+    """Get identifier of the task running a step of an image.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        step (str): Name of the step, e.g. `sign`.
+
+    Returns:
+        Task identifier, the same every time the step is queued.
+    """
+    return f"{build_id}-{image_index}-{step}"
+
+
+def add_pending_steps(
+    update: dict, image_index: int, steps: Dict[str, Optional[dict]]
+) -> dict:
+    """Add steps of an image to an update of its build.
+
+    Steps are recorded as `PENDING` with their payload and counted in
+    `pending_steps` of the build, until they are queued by `enqueue_task`.
+
+    Args:
+        update (dict): Update of the build document, modified in place.
+        image_index (int): Position of the image in the build's images.
+        steps (dict): Payload of each step, by name of the step.
+
+    Returns:
+        The given update.
+    """
+    now = datetime.datetime.utcnow()
+    for step, payload in steps.items():
+        update.setdefault("$set", {})[
+            f"images.{image_index}.steps.{step}"
+        ] = {
+            "status": PENDING,
+            "payload": payload or {},
+            "attempts": 0,
+            "error": None,
+            "pending_since": now,
+            "updated_at": str(datetime.datetime.now().isoformat()),
+        }
+    increments = update.setdefault("$inc", {})
+    increments["pending_steps"] = increments.get("pending_steps", 0) + len(
+        steps
+    )
+    return update
+
+
+def enqueue_task(
+    build_id: str,
+    image_index: int,
+    step: str,
+    payload: Optional[dict] = None,
+):
+    """Add step of an image to the task queue.
+
+    Steps recorded by `add_pending_steps` are queued at most once, even if
+    they are queued concurrently by `enqueue_pending_steps`.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        step (str): Name of the step, e.g. `sign`.
+        payload (dict): Arguments of the step.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    db_collection_tasks = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_tasks"]
+        .client
+    )
+    task_id = get_task_id(build_id, image_index, step)
+    now = datetime.datetime.utcnow()
+    result = db_collection_tasks.update_one(
+        {"id": task_id},
+        {
+            "$setOnInsert": {
+                "id": task_id,
+                "build_id": build_id,
+                "image_index": image_index,
+                "step": step,
+                "payload": payload or {},
+                "state": QUEUED,
+                "queued_at": now,
+                "run_after": now,
+                "claimed_at": None,
+                "claimed_by": None,
+                "attempts": 0,
+                "error": None,
+            }
+        },
+        upsert=True,
+    )
+    state = {
+        "status": QUEUED,
+        "attempts": 0,
+        "error": None,
+        "updated_at": str(datetime.datetime.now().isoformat()),
+    }
+    queued = db_collection_builds.update_one(
+        {
+            "id": build_id,
+            f"images.{image_index}.steps.{step}.status": PENDING,
+        },
+        {
+            "$set": {f"images.{image_index}.steps.{step}": state},
+            "$inc": {"pending_steps": -1},
+        },
+    )
+    if queued.modified_count:
+        return
+    # Steps not recorded as pending are queued right away.
+    queued = db_collection_builds.update_one(
+        {
+            "id": build_id,
+            f"images.{image_index}.steps.{step}": {"$exists": False},
+        },
+        {"$set": {f"images.{image_index}.steps.{step}": state}},
+    )
+    if not queued.modified_count and result.upserted_id is not None:
+        # The step was queued concurrently and may have been run already.
+        db_collection_tasks.delete_one(
+            {"id": task_id, "state": QUEUED, "attempts": 0}
+        )
+
+
+def complete_pending_step(build_id: str, image_index: int, step: str):
+    """Record step of an image which was run without being queued.
+
+    Steps queued meanwhile by `enqueue_pending_steps` are left to the task
+    workers.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        step (str): Name of the step, e.g. `notify`.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    db_collection_builds.update_one(
+        {
+            "id": build_id,
+            f"images.{image_index}.steps.{step}.status": PENDING,
+        },
+        {
+            "$set": {
+                f"images.{image_index}.steps.{step}": {
+                    "status": SUCCEEDED,
+                    "attempts": 1,
+                    "error": None,
+                    "updated_at": str(datetime.datetime.now().isoformat()),
+                }
+            },
+            "$inc": {"pending_steps": -1},
+        },
+    )
+
+
+def enqueue_pending_steps(steps: List[str], pending_timeout: int):
+    """Queue steps still pending after `pending_timeout` seconds.
+
+    Args:
+        steps (list): Names of the steps to queue.
+        pending_timeout (int): Seconds after which a pending step is
+        considered abandoned.
+
+    Returns:
+        Number of steps queued.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    deadline = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=pending_timeout
+    )
+    queued = 0
+    for build in db_collection_builds.find(
+        {"pending_steps": {"$gt": 0}}, {"id": True, "images": True}
+    ):
+        for index, image in enumerate(build["images"]):
+            for step, state in image.get("steps", {}).items():
+                if (
+                    step not in steps
+                    or state.get("status") != PENDING
+                    or state["pending_since"] > deadline
+                ):
+                    continue
+                logger.warning(
+                    f"Queueing step {step} of image {index} of build "
+                    f"{build['id']}, which was left pending."
+                )
+                enqueue_task(build["id"], index, step, state.get("payload"))
+                queued += 1
+    return queued
+
+
+def claim_task(worker_id: str, claim_timeout: int) -> Optional[dict]:
+    """Atomically claim the task that is due longest.
+
+    Tasks claimed by a worker which did not finish them within
+    `claim_timeout` seconds (e.g. because the API was restarted) are claimed
+    again.
+
+    Args:
+        worker_id (str): Identifier of the claiming worker.
+        claim_timeout (int): Seconds after which a claimed task is considered
+        abandoned.
+
+    Returns:
+        task (dict): Claimed task or `None` if no task is due.
+    """
+    db_collection_tasks = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_tasks"]
+        .client
+    )
+    now = datetime.datetime.utcnow()
+    return db_collection_tasks.find_one_and_update(
+        {
+            "$or": [
+                {"state": QUEUED, "run_after": {"$lte": now}},
+                {
+                    "state": RUNNING,
+                    "claimed_at": {
+                        "$lt": now - datetime.timedelta(seconds=claim_timeout)
+                    },
+                },
+            ]
+        },
+        {
+            "$set": {
+                "state": RUNNING,
+                "claimed_at": now,
+                "claimed_by": worker_id,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_after", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def complete_task(task: dict, worker_id: str):
+    """Remove finished task from the task queue.
+
+    Args:
+        task (dict): Claimed task.
+        worker_id (str): Identifier of the worker holding the claim.
+    """
+    db_collection_tasks = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_tasks"]
+        .client
+    )
+    db_collection_tasks.delete_one({"id": task["id"], "claimed_by": worker_id})
+    set_step_state(
+        task["build_id"],
+        task["image_index"],
+        task["step"],
+        SUCCEEDED,
+        task["attempts"],
+    )
+
+
+def retry_task(task: dict, worker_id: str, error: str, delay: float):
+    """Put claimed task back into the task queue.
+
+    Args:
+        task (dict): Claimed task.
+        worker_id (str): Identifier of the worker holding the claim.
+        error (str): Why the attempt failed.
+        delay (float): Seconds to wait before the task is tried again.
+    """
+    db_collection_tasks = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_tasks"]
+        .client
+    )
+    db_collection_tasks.update_one(
+        {"id": task["id"], "claimed_by": worker_id},
+        {
+            "$set": {
+                "state": QUEUED,
+                "run_after": datetime.datetime.utcnow()
+                + datetime.timedelta(seconds=delay),
+                "claimed_at": None,
+                "claimed_by": None,
+                "error": error,
+            }
+        },
+    )
+    set_step_state(
+        task["build_id"],
+        task["image_index"],
+        task["step"],
+        QUEUED,
+        task["attempts"],
+        error,
+    )
+
+
+def fail_task(task: dict, worker_id: str, error: str):
+    """Give up on claimed task; it is kept for inspection.
+
+    Args:
+        task (dict): Claimed task.
+        worker_id (str): Identifier of the worker holding the claim.
+        error (str): Why the last attempt failed.
+    """
+    db_collection_tasks = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_tasks"]
+        .client
+    )
+    db_collection_tasks.update_one(
+        {"id": task["id"], "claimed_by": worker_id},
+        {"$set": {"state": FAILED, "claimed_by": None, "error": error}},
+    )
+    set_step_state(
+        task["build_id"],
+        task["image_index"],
+        task["step"],
+        FAILED,
+        task["attempts"],
+        error,
+    )
+
+
+class TaskWorkerPool:
+    """Pool of background threads running queued steps.
+
+    Args:
+        app: Flask application, used to push an application context in each
+        worker thread.
+        handlers: Called with the claimed task, by name of its step; raise
+        to have the step retried.
+        workers: Number of worker threads.
+        poll_interval: Seconds to wait before polling again if no task is
+        due.
+        claim_timeout: Seconds after which a claimed task is considered
+        abandoned and claimed again.
+        max_attempts: Number of times a task is tried before giving up.
+        backoff_base: Seconds to wait before the first retry; doubled for
+        every further attempt.
+        backoff_max: Maximum number of seconds to wait before a retry.
+        sweep_interval: Seconds between looking for steps left pending for
+        longer than `claim_timeout`, see `enqueue_pending_steps`.
+    """
+
+    thread_name = "task-worker"
+
+    def __init__(
+        self,
+        app: Flask,
+        handlers: Dict[str, Callable[[dict], None]],
+        workers: int = 4,
+        poll_interval: float = 1,
+        claim_timeout: int = 300,
+        max_attempts: int = 5,
+        backoff_base: float = 5,
+        backoff_max: float = 600,
+        sweep_interval: float = 60,
+    ):
+        self.app = app
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sweep_interval = sweep_interval
+        self._swept_at = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start worker threads."""
+        for _ in range(self.workers):
+            worker_id = uuid.uuid4().hex
+            thread = threading.Thread(
+                target=self._run,
+                args=(worker_id,),
+                name=f"{self.thread_name}-{worker_id[:8]}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Signal worker threads to stop after their current task."""
+        self._stop.set()
+
+    def join(self, timeout: Optional[float] = None):
+        """Wait for stopped worker threads to finish their current task.
+
+        Args:
+            timeout (float): Seconds to wait for all threads together.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(0, deadline - time.monotonic()))
+
+    def get_delay(self, attempts: int) -> float:
+        """Get seconds to wait before retrying a task.
+
+        Args:
+            attempts (int): Number of times the task was tried.
+
+        Returns:
+            Delay growing exponentially with the number of attempts.
+        """
+        return min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+
+    def sweep(self):
+        """Queue steps left pending, at most every `sweep_interval` s."""
+        now = time.monotonic()
+        if (
+            self._swept_at is not None
+            and now - self._swept_at < self.sweep_interval
+        ):
+            return
+        self._swept_at = now
+        enqueue_pending_steps(list(self.handlers), self.claim_timeout)
+
+    def run_once(self, worker_id: str) -> bool:
+        """Claim and run a single task.
+
+        Args:
+            worker_id (str): Identifier of the worker.
+
+        Returns:
+            `True` if a task was run, `False` if no task was due.
+        """
+        with self.app.app_context():
+            self.sweep()
+            task = claim_task(worker_id, self.claim_timeout)
+            if task is None:
+                return False
+            set_step_state(
+                task["build_id"],
+                task["image_index"],
+                task["step"],
+                RUNNING,
+                task["attempts"],
+            )
+            try:
+                self.handlers[task["step"]](task)
+            except Exception as e:
+                logger.exception(
+                    f"Step {task['step']} of image {task['image_index']} of "
+                    f"build {task['build_id']} failed (attempt "
+                    f"{task['attempts']})."
+                )
+                if task["attempts"] < self.max_attempts:
+                    retry_task(
+                        task,
+                        worker_id,
+                        repr(e),
+                        self.get_delay(task["attempts"]),
+                    )
+                else:
+                    fail_task(task, worker_id, repr(e))
+                return True
+            complete_task(task, worker_id)
+            return True
+
+    def _run(self, worker_id: str):
+        while not self._stop.is_set():
+            try:
+                if not self.run_once(worker_id):
+                    time.sleep(self.poll_interval)
+            except Exception:
+                logger.exception("Unexpected error in task worker.")
+                time.sleep(self.poll_interval)
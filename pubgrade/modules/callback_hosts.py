@@ -0,0 +1,324 @@
+"""Circuit breakers and rate limits of subscription callback hosts.
+
+Every host receiving callbacks has a circuit breaker and a token bucket.
+After `failure_threshold` consecutive failed callbacks, the breaker of a
+host opens and no callbacks are sent to it for `recovery_timeout` seconds;
+it then lets `half_open_max_calls` callbacks through to probe the host,
+closing again if they succeed. The token bucket lets at most `rate`
+callbacks per second through, with bursts of up to `burst` callbacks.
+Callbacks that may not be sent yet are not waited for, but postponed, so
+that callbacks to healthy hosts do not queue up behind broken or busy
+ones. State is stored in the `callback_hosts` collection, so that it is
+shared by the API and all `pubgrade-notifier` replicas.
+"""
+
+import threading
+import time
+from typing import Callable, Optional
+
+from flask import current_app
+from pymongo.errors import DuplicateKeyError
+
+CLOSED = "CLOSED"
+OPEN = "OPEN"
+HALF_OPEN = "HALF_OPEN"
+
+_callback_hosts = None
+_callback_hosts_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """Circuit breaker of a single host; not thread-safe.
+
+    Args:
+        failure_threshold (int): Number of consecutive failures opening the
+        breaker.
+        recovery_timeout (float): Seconds for which the breaker stays open
+        before probing the host.
+        half_open_max_calls (int): Number of probing calls at a time.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30,
+        half_open_max_calls: int = 1,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_calls = 0
+
+    def get_state(self) -> dict:
+        """Get state of the breaker, to be stored."""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened_at": self.opened_at,
+            "half_open_calls": self.half_open_calls,
+        }
+
+    def set_state(self, state: dict):
+        """Restore state of the breaker returned by `get_state`."""
+        self.state = state["state"]
+        self.failures = state["failures"]
+        self.opened_at = state["opened_at"]
+        self.half_open_calls = state["half_open_calls"]
+
+    def get_delay(self) -> Optional[float]:
+        """Get seconds until a call may be made.
+
+        Returns:
+            Delay, or `None` if a call may be made now.
+        """
+        if self.state == OPEN:
+            remaining = (
+                self.opened_at + self.recovery_timeout - time.time()
+            )
+            if remaining > 0:
+                return remaining
+            self.state = HALF_OPEN
+            self.half_open_calls = 0
+        if (
+            self.state == HALF_OPEN
+            and self.half_open_calls >= self.half_open_max_calls
+        ):
+            # Wait for the outcome of the probing calls.
+            return self.recovery_timeout
+        return None
+
+    def acquire(self):
+        """Record that a call allowed by `get_delay` is made."""
+        if self.state == HALF_OPEN:
+            self.half_open_calls += 1
+
+    def release(self):
+        """Record that a call allowed by `get_delay` was not made."""
+        if self.state == HALF_OPEN and self.half_open_calls > 0:
+            self.half_open_calls -= 1
+
+    def record_success(self):
+        """Record successful call; closes the breaker."""
+        self.state = CLOSED
+        self.failures = 0
+        self.half_open_calls = 0
+
+    def record_failure(self):
+        """Record failed call; opens the breaker if it failed too often."""
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.time()
+            self.half_open_calls = 0
+
+
+class TokenBucket:
+    """Token bucket limiting the rate of calls to a host; not thread-safe.
+
+    Args:
+        rate (float): Tokens added per second.
+        burst (int): Maximum number of tokens.
+    """
+
+    def __init__(self, rate: float = 10, burst: int = 20):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+
+    def get_state(self) -> dict:
+        """Get state of the bucket, to be stored."""
+        return {"tokens": self.tokens, "updated_at": self.updated_at}
+
+    def set_state(self, state: dict):
+        """Restore state of the bucket returned by `get_state`."""
+        self.tokens = state["tokens"]
+        self.updated_at = state["updated_at"]
+
+    def refill(self):
+        """Add tokens accumulated since the last refill."""
+        now = time.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def try_acquire(self) -> Optional[float]:
+        """Take a token if one is available.
+
+        Returns:
+            `None` if a token was taken, otherwise seconds until the next
+            token is available.
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) / self.rate
+
+
+class CallbackHosts:
+    """Circuit breakers and token buckets by callback host.
+
+    State is read, changed and written back only if no other thread or
+    process changed it meanwhile; otherwise the change is applied again.
+
+    Args:
+        circuit_breaker (dict): Settings of the circuit breakers, see
+        `CircuitBreaker`.
+        rate_limit (dict): Settings of the token buckets, see `TokenBucket`.
+    """
+
+    def __init__(
+        self,
+        circuit_breaker: Optional[dict] = None,
+        rate_limit: Optional[dict] = None,
+    ):
+        self.circuit_breaker = circuit_breaker or {}
+        self.rate_limit = rate_limit or {}
+
+    def _load(self, document: Optional[dict]):
+        breaker = CircuitBreaker(**self.circuit_breaker)
+        bucket = TokenBucket(**self.rate_limit)
+        if document is not None:
+            breaker.set_state(document["breaker"])
+            bucket.set_state(document["bucket"])
+        return breaker, bucket
+
+    def _update(self, host: str, change: Callable):
+        db_collection_hosts = (
+            current_app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["callback_hosts"]
+            .client
+        )
+        while True:
+            document = db_collection_hosts.find_one({"host": host})
+            breaker, bucket = self._load(document)
+            result = change(breaker, bucket)
+            state = {
+                "host": host,
+                "breaker": breaker.get_state(),
+                "bucket": bucket.get_state(),
+            }
+            if document is None:
+                try:
+                    db_collection_hosts.insert_one({**state, "version": 1})
+                except DuplicateKeyError:
+                    continue
+                return result
+            written = db_collection_hosts.update_one(
+                {"host": host, "version": document["version"]},
+                {"$set": state, "$inc": {"version": 1}},
+            )
+            if written.modified_count:
+                return result
+
+    def acquire(self, host: str) -> Optional[float]:
+        """Check whether a callback may be sent to a host now.
+
+        Args:
+            host (str): Host of the callback URL.
+
+        Returns:
+            `None` if the callback may be sent, otherwise seconds to wait
+            before trying again.
+        """
+
+        def acquire(breaker, bucket):
+            delay = breaker.get_delay()
+            if delay is not None:
+                return delay
+            delay = bucket.try_acquire()
+            if delay is not None:
+                return delay
+            breaker.acquire()
+            return None
+
+        return self._update(host, acquire)
+
+    def record(self, host: str, success: bool):
+        """Record outcome of a callback sent to a host.
+
+        Args:
+            host (str): Host of the callback URL.
+            success (bool): Whether the host processed the callback.
+        """
+
+        def record(breaker, bucket):
+            if success:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+        self._update(host, record)
+
+    def release(self, host: str):
+        """Record that an allowed callback to a host was not sent.
+
+        Args:
+            host (str): Host of the callback URL.
+        """
+        self._update(host, lambda breaker, bucket: breaker.release())
+
+    def get_states(self) -> dict:
+        """Get state of the circuit breaker and token bucket of each host.
+
+        Returns:
+            Breaker `state`, consecutive `failures`, seconds until an open
+            breaker probes the host (`retry_in`) and available `tokens`,
+            by host.
+        """
+        db_collection_hosts = (
+            current_app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["callback_hosts"]
+            .client
+        )
+        states = {}
+        for document in db_collection_hosts.find():
+            breaker, bucket = self._load(document)
+            bucket.refill()
+            retry_in = None
+            if breaker.state == OPEN:
+                retry_in = max(
+                    breaker.opened_at + breaker.recovery_timeout - time.time(),
+                    0,
+                )
+            states[document["host"]] = {
+                "state": breaker.state,
+                "failures": breaker.failures,
+                "retry_in": retry_in,
+                "tokens": bucket.tokens,
+            }
+        return states
+
+
+def get_callback_hosts(settings: Optional[dict] = None) -> CallbackHosts:
+    """Get circuit breakers and rate limits of callback hosts.
+
+    Args:
+        settings (dict): `circuit_breaker` and `rate_limit` settings, read
+        from the `notifications` endpoint configuration if not specified.
+        Only used when the breakers are created.
+
+    Returns:
+        Circuit breakers and token buckets shared by all threads and
+        processes.
+    """
+    global _callback_hosts
+    with _callback_hosts_lock:
+        if _callback_hosts is None:
+            if settings is None:
+                notifications = current_app.config["FOCA"].endpoints[
+                    "notifications"
+                ]
+                settings = {
+                    "circuit_breaker": notifications["circuit_breaker"],
+                    "rate_limit": notifications["rate_limit"],
+                }
+            _callback_hosts = CallbackHosts(**settings)
+        return _callback_hosts
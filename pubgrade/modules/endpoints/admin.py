@@ -0,0 +1,141 @@
+import logging
+
+from flask import current_app
+from werkzeug.exceptions import Unauthorized
+
+from pubgrade.errors.exceptions import UserNotFound
+from pubgrade.modules.callback_hosts import get_callback_hosts
+from pubgrade.modules.http_client import get_http_client
+from pubgrade.modules.outbox import get_dead_letters, replay_dead_letters
+
+logger = logging.getLogger(__name__)
+
+
+def verify_admin_user(admin_user_id: str, admin_user_access_token: str):
+    """Verify credentials of an admin user.
+
+    Args:
+        admin_user_id (str): Unique identifier for admin user.
+        admin_user_access_token (str): Secret to verify admin user.
+
+    Raises:
+        UserNotFound: Raised when there is no admin user with specified uid.
+        Unauthorized: Raised when access_token is invalid or not specified
+        in request.
+    """
+    db_collection_admin_users = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["admin_users"]
+        .client
+    )
+    data_from_db = db_collection_admin_users.find_one({"uid": admin_user_id})
+    if data_from_db is None:
+        raise UserNotFound
+    if data_from_db["user_access_token"] != admin_user_access_token:
+        raise Unauthorized
+
+
+def get_http_destinations(admin_user_id: str, admin_user_access_token: str):
+    """Get latency and error statistics of outgoing requests.
+
+    Args:
+        admin_user_id (str): Unique identifier for admin user.
+        admin_user_access_token (str): Secret to verify admin user.
+
+    Returns:
+        Statistics of requests to each destination host, see
+        `pubgrade.modules.http_client.HttpClient.get_stats`.
+
+    Raises:
+        UserNotFound: Raised when there is no admin user with specified uid.
+        Unauthorized: Raised when access_token is invalid or not specified
+        in request.
+    """
+    verify_admin_user(admin_user_id, admin_user_access_token)
+    return [
+        {"host": host, **stats}
+        for host, stats in sorted(get_http_client().get_stats().items())
+    ]
+
+
+def get_callback_host_states(
+    admin_user_id: str, admin_user_access_token: str
+):
+    """Get circuit breaker and rate limit state of callback hosts.
+
+    Args:
+        admin_user_id (str): Unique identifier for admin user.
+        admin_user_access_token (str): Secret to verify admin user.
+
+    Returns:
+        State of each callback host notified by any process, see
+        `pubgrade.modules.callback_hosts.CallbackHosts.get_states`.
+
+    Raises:
+        UserNotFound: Raised when there is no admin user with specified uid.
+        Unauthorized: Raised when access_token is invalid or not specified
+        in request.
+    """
+    verify_admin_user(admin_user_id, admin_user_access_token)
+    return [
+        {"host": host, **state}
+        for host, state in sorted(get_callback_hosts().get_states().items())
+    ]
+
+
+def get_notification_dead_letters(
+    admin_user_id: str, admin_user_access_token: str
+):
+    """Get notifications which could not be delivered to subscriptions.
+
+    Args:
+        admin_user_id (str): Unique identifier for admin user.
+        admin_user_access_token (str): Secret to verify admin user.
+
+    Returns:
+        Dead letters, oldest first, see `pubgrade.modules.outbox`.
+
+    Raises:
+        UserNotFound: Raised when there is no admin user with specified uid.
+        Unauthorized: Raised when access_token is invalid or not specified
+        in request.
+    """
+    verify_admin_user(admin_user_id, admin_user_access_token)
+    return [
+        {
+            "id": dead_letter["id"],
+            "build_id": dead_letter["build_id"],
+            "image_index": dead_letter["image_index"],
+            "image": dead_letter["image"],
+            "subscription_id": dead_letter["subscription_id"],
+            "attempts": dead_letter["attempts"],
+            "error": dead_letter["error"],
+            "created_at": dead_letter["created_at"].isoformat(),
+            "dead_lettered_at": dead_letter["dead_lettered_at"].isoformat(),
+        }
+        for dead_letter in get_dead_letters()
+    ]
+
+
+def replay_notification_dead_letters(
+    admin_user_id: str, admin_user_access_token: str, data: dict
+):
+    """Deliver notifications which could not be delivered again.
+
+    Args:
+        admin_user_id (str): Unique identifier for admin user.
+        admin_user_access_token (str): Secret to verify admin user.
+        data (dict): Request body with the `ids` of the dead letters to
+        replay; all dead letters are replayed if not specified.
+
+    Returns:
+        Identifiers of the notifications moved back into the outbox.
+
+    Raises:
+        UserNotFound: Raised when there is no admin user with specified uid.
+        Unauthorized: Raised when access_token is invalid or not specified
+        in request.
+    """
+    verify_admin_user(admin_user_id, admin_user_access_token)
+    return {"replayed": replay_dead_letters((data or {}).get("ids"))}
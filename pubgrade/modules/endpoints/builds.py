@@ -4,15 +4,21 @@ import os
 import shutil
 import requests
 import base64
+import functools
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
 import yaml
 from flask import current_app
-from git import Repo, GitCommandError
-from kubernetes import client, config
+from git import Git, Repo, GitCommandError
 from kubernetes.client import ApiException
+from kubernetes.config import ConfigException
+from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
-from werkzeug.exceptions import Unauthorized
+from urllib3.exceptions import HTTPError
+from werkzeug.exceptions import HTTPException, Unauthorized
 
 from pubgrade.errors.exceptions import (
     RepositoryNotFound,
@@ -21,9 +27,31 @@ from pubgrade.errors.exceptions import (
     CreatePodError,
     GitCloningError,
     InternalServerError,
+    RegistryError,
+    SigningError,
 )
+from pubgrade.modules.build_queue import enqueue_build
+from pubgrade.modules.build_tasks import (
+    add_pending_steps,
+    complete_pending_step,
+    enqueue_task,
+)
+from pubgrade.modules.endpoints.admin import verify_admin_user
 from pubgrade.modules.endpoints.repositories import generate_id
-from pubgrade.modules.endpoints.subscriptions import notify_subscriptions
+from pubgrade.modules.endpoints.subscriptions import (
+    add_subscription_updates,
+    find_matching_subscriptions,
+)
+from pubgrade.modules.git_cache import (
+    MirrorCache,
+    get_mirror_cache,
+    set_sparse_checkout,
+)
+from pubgrade.modules.http_client import get_http_client
+from pubgrade.modules.kubernetes_client import get_kubernetes_client
+from pubgrade.modules.outbox import add_notifications
+from pubgrade.modules.registry import image_exists, with_tag, without_tag
+from pubgrade.modules.scheduler import get_queue_status, release_slot
 from pubgrade.secrets import gh_access_token, cosign_password, cosign_private_key
 
 logger = logging.getLogger(__name__)
@@ -32,11 +60,33 @@ template_file = '/app/pubgrade/modules/endpoints/kaniko/template.yaml'
 BASE_DIR = os.getenv("BASE_DIR")
 if BASE_DIR is None:
     BASE_DIR = '/pubgrade_temp_files'
+# Messages logged by the kaniko executor for each cacheable command.
+CACHE_HIT_MESSAGE = "Using caching version of cmd"
+CACHE_MISS_MESSAGE = "No cached layer found for cmd"
+# History depths tried by shallow clones before fetching the complete history.
+SHALLOW_FETCH_DEPTHS = (50, 500)
+# States of builds and images which do not change anymore.
+FINISHED_STATES = ("SUCCEEDED", "FAILED", "TIMED_OUT")
+# Pod annotation holding the build timeout enforced by build-complete-updater.
+TIMEOUT_ANNOTATION = "pubgrade/timeout-seconds"
+# Fields of builds needed to record completion of their images.
+BUILD_STATUS_PROJECTION = {
+    "_id": False,
+    "id": True,
+    "status": True,
+    "images": True,
+}
 
 
 def register_builds(repository_id: str, access_token: str, build_data: dict):
     """Register new builds for already registered repository.
 
+    The build is only stored and added to the build queue; cloning the
+    repository and creating the kaniko pod is done by the build workers (see
+    `run_queued_build`). If an identical build (same repository, commit and
+    images) is queued, running or recently succeeded, the request is attached
+    to that build instead and its identifier is returned.
+
     Args:
         repository_id (str): Identifier for repository.
         access_token (str): Secret used to verify source of the request to
@@ -85,6 +135,35 @@ def register_builds(repository_id: str, access_token: str, build_data: dict):
         raise RepositoryNotFound
     if data_from_db["access_token"] != access_token:
         raise Unauthorized
+
+    dedup_config = current_app.config["FOCA"].endpoints["builds"]["dedup"]
+    build_key = None
+    # Resolving branch heads and tags takes a `git ls-remote`, which holds
+    # up the request unless enabled explicitly.
+    if dedup_config["enabled"] and (
+        build_data["head_commit"].get("commit_sha")
+        or dedup_config["resolve_refs"]
+    ):
+        resolved_commit_sha = resolve_commit_sha(
+            data_from_db["url"],
+            build_data["head_commit"],
+            dedup_config["resolve_timeout"],
+        )
+        if resolved_commit_sha is not None:
+            build_key = get_build_key(
+                repository_id, resolved_commit_sha, build_data["images"]
+            )
+            duplicate_build = find_duplicate_build(
+                build_key, build_data["head_commit"], dedup_config["window"]
+            )
+            if duplicate_build is not None:
+                return attach_build(
+                    duplicate_build, build_data["head_commit"]
+                )
+            build_data["build_key"] = build_key
+            build_data["active_build_key"] = build_key
+            build_data["resolved_commit_sha"] = resolved_commit_sha
+
     for i in range(retries):
         logger.debug(
             f"Trying to insert/update object: try {i}" + str(build_data)
@@ -100,34 +179,27 @@ def register_builds(repository_id: str, access_token: str, build_data: dict):
             build_data["finished_at"] = "NULL"
             build_data["started_at"] = str(datetime.datetime.now().isoformat())
             build_data["status"] = "QUEUED"
+            for image in build_data["images"]:
+                image["status"] = "QUEUED"
             db_collection_builds.insert_one(build_data)
-            branch = ""
-            commit_sha = ""
-            try:
-                branch = build_data["head_commit"]["branch"]
-                try:
-                    commit_sha = build_data["head_commit"]["commit_sha"]
-                except KeyError:
-                    commit_sha = ""
-            except KeyError:
-                commit_sha = build_data["head_commit"]["tag"]
-            intermediate_registry_format = current_app.config["FOCA"].endpoints["builds"][
-                "intermediate_registery_format"]
-            intermediate_registry_path = intermediate_registry_format.format(
-                build_data["images"][0]["name"].split("/")[1].split(":")[0])
-            create_build(
-                repo_url=data_from_db["url"],
-                branch=branch,
-                commit=commit_sha,
-                base_dir=BASE_DIR,
-                build_id=build_data["id"],
-                dockerfile_location=build_data["images"][0]["location"],
-                intermediate_registry_path=intermediate_registry_path,
-                dockerhub_token=build_data["dockerhub_token"],
-                project_access_token=access_token,
+            enqueue_build(
+                build_id=build_data["id"], repository_id=repository_id
             )
             break
         except DuplicateKeyError:
+            db_collection_repositories.update_one(
+                {"id": repository_id},
+                {"$pull": {"build_list": build_data["id"]}},
+            )
+            if build_key is not None:
+                # Identical build was registered concurrently.
+                duplicate_build = find_duplicate_build(
+                    build_key, build_data["head_commit"], 0
+                )
+                if duplicate_build is not None:
+                    return attach_build(
+                        duplicate_build, build_data["head_commit"]
+                    )
             logger.error(
                 f"DuplicateKeyError ({build_data['id']}): Key "
                 f"generated is already present."
@@ -142,6 +214,145 @@ def register_builds(repository_id: str, access_token: str, build_data: dict):
     return {"id": build_data["id"]}
 
 
+def resolve_commit_sha(repo_url: str, head_commit: dict, timeout: int):
+    """Resolve commit sha the build's head commit points to.
+
+    Branch heads and tags are resolved with `git ls-remote`, without cloning
+    the repository.
+
+    Args:
+        repo_url (str): URL of git repository.
+        head_commit (dict): Head commit of build request.
+        timeout (int): Seconds to wait for `git ls-remote`.
+
+    Returns:
+        commit_sha (str): Resolved commit sha, or `None` if it could not be
+        resolved.
+    """
+    if head_commit.get("commit_sha"):
+        return head_commit["commit_sha"].lower()
+    if "branch" in head_commit:
+        refs = ["refs/heads/%s" % head_commit["branch"]]
+    else:
+        # Annotated tags are peeled to the commit they point to (`^{}`).
+        refs = [
+            "refs/tags/%s" % head_commit["tag"],
+            "refs/tags/%s^{}" % head_commit["tag"],
+        ]
+    try:
+        output = Git().ls_remote(repo_url, *refs, kill_after_timeout=timeout)
+    except GitCommandError:
+        logger.warning(f"Could not resolve {head_commit} of {repo_url}.")
+        return None
+    resolved = dict(
+        reversed(line.split("\t", 1))
+        for line in output.splitlines()
+        if "\t" in line
+    )
+    for ref in reversed(refs):
+        if ref in resolved:
+            return resolved[ref]
+    return None
+
+
+def get_build_key(repository_id: str, commit_sha: str, images: list) -> str:
+    """Compute key identifying builds producing the same images.
+
+    Args:
+        repository_id (str): Identifier for repository.
+        commit_sha (str): Resolved commit sha.
+        images (list): Images to be built.
+
+    Returns:
+        Hex digest of repository, commit, Dockerfile locations, build contexts
+        and target images.
+    """
+    key = json.dumps(
+        [
+            repository_id,
+            commit_sha,
+            sorted(
+                [
+                    image.get("location", "./Dockerfile"),
+                    image.get("context", ""),
+                    image["name"],
+                ]
+                for image in images
+            ),
+        ]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def find_duplicate_build(build_key: str, head_commit: dict, window: int):
+    """Find build with the same build key to attach a new request to.
+
+    Queued and running builds are always matched. Succeeded builds are
+    matched if they finished within `window` seconds and were requested for
+    the same head commit, so that their subscriptions were notified.
+
+    Args:
+        build_key (str): Build key, see `get_build_key`.
+        head_commit (dict): Head commit of the new build request.
+        window (int): Seconds for which succeeded builds are reused.
+
+    Returns:
+        build_object (dict): Matching build, or `None`.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    build_object = db_collection_builds.find_one(
+        {"build_key": build_key, "status": {"$in": ["QUEUED", "RUNNING"]}}
+    )
+    if build_object is not None:
+        return build_object
+    finished_after = (
+        datetime.datetime.now() - datetime.timedelta(seconds=window)
+    ).isoformat()
+    for build_object in db_collection_builds.find(
+        {
+            "build_key": build_key,
+            "status": "SUCCEEDED",
+            "finished_at": {"$gte": finished_after},
+        }
+    ):
+        if head_commit == build_object["head_commit"] or head_commit in (
+            build_object.get("head_commit_aliases", [])
+        ):
+            return build_object
+    return None
+
+
+def attach_build(build_object: dict, head_commit: dict):
+    """Attach build request to an identical build.
+
+    Args:
+        build_object (dict): Build the request is attached to.
+        head_commit (dict): Head commit of the attached build request, kept
+        as alias so that matching subscriptions are notified.
+
+    Returns:
+        build_id (str): Identifier of the build the request is attached to.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    if head_commit != build_object["head_commit"]:
+        db_collection_builds.update_one(
+            {"id": build_object["id"]},
+            {"$addToSet": {"head_commit_aliases": head_commit}},
+        )
+    logger.info(f"Attached build request to build {build_object['id']}.")
+    return {"id": build_object["id"]}
+
+
 def get_builds(repository_id: str):
     """Retrieve build information.
 
@@ -214,20 +425,412 @@ def get_build_info(build_id: str):
         raise BuildNotFound
 
 
+def get_build_queue(admin_user_id: str, admin_user_access_token: str):
+    """Get status of the build queue.
+
+    Args:
+        admin_user_id (str): Unique identifier for admin user.
+        admin_user_access_token (str): Secret to verify admin user.
+
+    Returns:
+        Number of queued and running builds in total and per repository,
+        and queue wait times in seconds.
+
+    Raises:
+        UserNotFound: Raised when there is no admin user with specified uid.
+        Unauthorized: Raised when access_token is invalid or not specified
+        in request.
+    """
+    verify_admin_user(admin_user_id, admin_user_access_token)
+    return get_queue_status(
+        current_app.config["FOCA"].endpoints["builds"]["scheduler"][
+            "max_concurrent_builds"
+        ]
+    )
+
+
+def get_checkout_reference(head_commit: dict):
+    """Get branch and commit/tag to checkout from build's head commit.
+
+    Args:
+        head_commit (dict): Head commit of build request, containing either
+        `branch` (and optionally `commit_sha`) or `tag`.
+
+    Returns:
+        branch (str): Branch to clone, empty if tag is specified.
+        commit (str): Commit sha or tag to checkout, empty to stay at HEAD
+        of branch.
+    """
+    branch = ""
+    commit_sha = ""
+    try:
+        branch = head_commit["branch"]
+        try:
+            commit_sha = head_commit["commit_sha"]
+        except KeyError:
+            commit_sha = ""
+    except KeyError:
+        commit_sha = head_commit["tag"]
+    return branch, commit_sha
+
+
+def run_queued_build(job: dict):
+    """Process build claimed from the build queue.
+
+    Clones the repository and creates one kaniko pod per image of the build.
+    Images already built from the same commit are not built again. Called
+    by the build workers (`pubgrade.modules.build_queue.BuildWorkerPool`).
+
+    Args:
+        job (dict): Job claimed from the build queue.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    db_collection_repositories = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["repositories"]
+        .client
+    )
+    build_data = db_collection_builds.find_one({"id": job["id"]})
+    if build_data is None:
+        logger.error(f"Dropping queued build {job['id']}: build not found.")
+        return
+    repository = db_collection_repositories.find_one(
+        {"id": job["repository_id"]}
+    )
+    if repository is None:
+        logger.error(
+            f"Dropping queued build {job['id']}: repository "
+            f"{job['repository_id']} not found."
+        )
+        release_slot(job["id"])
+        return
+    branch, commit_sha = get_checkout_reference(build_data["head_commit"])
+    if branch != "" and commit_sha == "":
+        # Build the branch head the build key was computed for.
+        commit_sha = build_data.get("resolved_commit_sha", "")
+    skip_config = current_app.config["FOCA"].endpoints["builds"][
+        "skip_existing_images"
+    ]
+    if skip_config["enabled"] and len(commit_sha) != 40:
+        resolved_commit_sha = resolve_commit_sha(
+            repository["url"],
+            build_data["head_commit"],
+            skip_config["timeout"],
+        )
+        if resolved_commit_sha is not None and len(resolved_commit_sha) == 40:
+            commit_sha = resolved_commit_sha
+    intermediate_registry_format = current_app.config["FOCA"].endpoints[
+        "builds"
+    ]["intermediate_registery_format"]
+    build_timeout = repository.get(
+        "build_timeout",
+        current_app.config["FOCA"].endpoints["builds"]["timeout"],
+    )
+    images = []
+    reused_images = []
+    for index, image in enumerate(build_data["images"]):
+        if image.get("status", "QUEUED") != "QUEUED":
+            # Pod was already created by a previous attempt.
+            continue
+        intermediate_registry_path = intermediate_registry_format.format(
+            image["name"].split("/")[1].split(":")[0]
+        )
+        # Images are additionally tagged with the full commit sha they were
+        # built from, so that later builds of the same commit can reuse them.
+        commit_image_path = ""
+        if len(commit_sha) == 40:
+            commit_image_path = with_tag(
+                intermediate_registry_path, commit_sha
+            )
+            if skip_config["enabled"] and intermediate_image_exists(
+                commit_image_path, skip_config["timeout"]
+            ):
+                logger.info(
+                    f"Skipping image {image['name']} of build "
+                    f"{build_data['id']}: image {commit_image_path} already "
+                    f"exists."
+                )
+                reused_images.append((index, commit_image_path))
+                continue
+        cache_repository, cache_ttl = get_cache_settings(
+            repository, image["name"]
+        )
+        images.append(
+            {
+                "index": index,
+                "dockerfile_location": image.get("location", "./Dockerfile"),
+                "intermediate_registry_path": intermediate_registry_path,
+                "build_context": image.get("context", ""),
+                "include_paths": image.get("include_paths", []),
+                "commit_image_path": commit_image_path,
+                "cache_repository": cache_repository,
+                "cache_ttl": cache_ttl,
+                "timeout": build_timeout,
+            }
+        )
+    for index, commit_image_path in reused_images:
+        db_collection_builds.update_one(
+            {"id": build_data["id"]},
+            {
+                "$set": {
+                    f"images.{index}.intermediate_image": commit_image_path,
+                    f"images.{index}.image_reused": True,
+                }
+            },
+        )
+        complete_image(repository, build_data["id"], index, remove_pod=False)
+    if not images:
+        return
+    mirror_cache = None
+    git_cache_config = current_app.config["FOCA"].endpoints["builds"][
+        "git_cache"
+    ]
+    if git_cache_config["enabled"]:
+        mirror_cache = get_mirror_cache(
+            cache_dir=git_cache_config["directory"]
+            or "%s/.mirrors" % BASE_DIR,
+            max_size_mb=git_cache_config["max_size_mb"],
+        )
+    pod_names = create_build(
+        repo_url=repository["url"],
+        branch=branch,
+        commit=commit_sha,
+        base_dir=BASE_DIR,
+        build_id=build_data["id"],
+        images=images,
+        dockerhub_token=build_data["dockerhub_token"],
+        project_access_token=repository["access_token"],
+        mirror_cache=mirror_cache,
+        clone_strategy=repository.get(
+            "clone_strategy",
+            current_app.config["FOCA"].endpoints["builds"]["clone_strategy"],
+        ),
+    )
+    started_at = str(datetime.datetime.now().isoformat())
+    image_status = {}
+    for image, pod_name in zip(images, pod_names):
+        image_status.update(
+            {
+                f"images.{image['index']}.status": "RUNNING",
+                f"images.{image['index']}.started_at": started_at,
+                f"images.{image['index']}.pod_name": pod_name,
+                f"images.{image['index']}.intermediate_image": image[
+                    "intermediate_registry_path"
+                ],
+            }
+        )
+    db_collection_builds.update_one(
+        {"id": build_data["id"], "status": {"$nin": list(FINISHED_STATES)}},
+        {
+            "$set": dict(
+                image_status, status="RUNNING", timeout_seconds=build_timeout
+            )
+        },
+    )
+
+
+def get_cache_settings(repository: dict, image_name: str):
+    """Get kaniko layer cache settings for a repository.
+
+    The `cache` setting of the repository (`enabled`, `repository`, `ttl`)
+    takes precedence over the `cache` section of the builds configuration.
+    Unless specified, the cache repository is derived from
+    `intermediate_registery_format`, e.g. `ttl.sh/<image>-cache`.
+
+    Args:
+        repository (dict): Repository the build belongs to.
+        image_name (str): Name of the image to build.
+
+    Returns:
+        cache_repository (str): Repository to store cached layers in, empty
+        if caching is disabled.
+        cache_ttl (str): Time after which cached layers expire, e.g. `336h`.
+    """
+    builds_config = current_app.config["FOCA"].endpoints["builds"]
+    cache_config = dict(builds_config["cache"])
+    cache_config.update(repository.get("cache", {}))
+    if not cache_config["enabled"]:
+        return "", ""
+    cache_repository = cache_config.get("repository")
+    if not cache_repository:
+        repository_format = cache_config["repository_format"] or without_tag(
+            builds_config["intermediate_registery_format"].format("{}-cache")
+        )
+        cache_repository = repository_format.format(
+            image_name.split("/")[1].split(":")[0]
+        )
+    return cache_repository, cache_config["ttl"]
+
+
+def parse_cache_stats(logs: str) -> dict:
+    """Count kaniko layer cache hits and misses in executor logs.
+
+    Args:
+        logs (str): Logs of the kaniko pod.
+
+    Returns:
+        Number of cache hits and misses and the hit ratio (`None` if no
+        cacheable command was run).
+    """
+    hits = logs.count(CACHE_HIT_MESSAGE)
+    misses = logs.count(CACHE_MISS_MESSAGE)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / (hits + misses), 2)
+        if hits + misses
+        else None,
+    }
+
+
+def get_cache_stats(pod_name: str, namespace: str):
+    """Get kaniko layer cache statistics of a finished build pod.
+
+    Args:
+        pod_name (str): Name of kaniko pod.
+        namespace (str): Namespace of pod.
+
+    Returns:
+        Cache statistics, see `parse_cache_stats`, or `None` if the pod
+        logs could not be read.
+    """
+    kubernetes_client = get_kubernetes_client()
+    try:
+        logs = kubernetes_client.core_v1().read_namespaced_pod_log(
+            pod_name,
+            namespace,
+            _request_timeout=kubernetes_client.request_timeout,
+        )
+    except (ApiException, ConfigException, HTTPError) as e:
+        kubernetes_client.reset_if_unauthorized(e)
+        logger.warning(f"Could not read logs of pod {pod_name}: {e}")
+        return None
+    return parse_cache_stats(logs)
+
+
+def intermediate_image_exists(image: str, timeout: int) -> bool:
+    """Check whether image was already pushed to the intermediate registry.
+
+    Args:
+        image (str): Image reference in the intermediate registry.
+        timeout (int): Seconds to wait for the registry to respond.
+
+    Returns:
+        `True` if the image exists, `False` if it does not exist or the
+        registry could not be queried.
+    """
+    try:
+        return image_exists(
+            image,
+            auth=current_app.config["FOCA"].endpoints["builds"][
+                "intermediate_registry_token"
+            ],
+            timeout=timeout,
+        )
+    except RegistryError:
+        logger.warning(f"Could not check whether image {image} exists.")
+        return False
+
+
+def reset_queued_build(job: dict):
+    """Remove what a failed attempt of a queued build left behind.
+
+    Kaniko pods of images the attempt did not record as started and the
+    build directory are deleted, so that the next attempt starts from
+    scratch. Called by the build workers before a build is retried.
+
+    Args:
+        job (dict): Job claimed from the build queue.
+
+    Raises:
+        DeletePodError: Raised when a pod could not be deleted.
+    """
+    build_data = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client.find_one({"id": job["id"]})
+    )
+    shutil.rmtree(BASE_DIR + "/" + job["id"], ignore_errors=True)
+    if build_data is None:
+        return
+    for index, image in enumerate(build_data["images"]):
+        if image.get("status", "QUEUED") == "QUEUED":
+            delete_pod(get_pod_name(job["id"], index), "pubgrade-ns")
+
+
+def fail_queued_build(job: dict, error: Exception):
+    """Mark queued build as failed after all attempts are exhausted.
+
+    Kaniko pods of the build's unfinished images and the build directory
+    are deleted in the background.
+
+    Args:
+        job (dict): Job claimed from the build queue.
+        error (Exception): Exception raised by the last attempt.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    data = db_collection_builds.find_one({"id": job["id"]})
+    if data is None:
+        return
+    cleanup = {
+        "pod_names": [
+            image.get("pod_name", get_pod_name(job["id"], index))
+            for index, image in enumerate(data["images"])
+            if image.get("status") not in FINISHED_STATES
+        ],
+        "remove_directory": True,
+    }
+    # Steps of the build as a whole are recorded on its first image.
+    db_collection_builds.update_one(
+        {"id": job["id"]},
+        add_pending_steps(
+            {
+                "$set": {
+                    "status": "FAILED",
+                    "finished_at": str(datetime.datetime.now().isoformat()),
+                    "error": repr(error),
+                },
+                "$unset": {"active_build_key": ""},
+            },
+            0,
+            {"cleanup": cleanup},
+        ),
+    )
+    enqueue_task(job["id"], 0, "cleanup", cleanup)
+
+
 def create_build(
         repo_url: str,
         branch: str,
         commit: str,
         base_dir: str,
         build_id: str,
-        dockerfile_location: str,
-        intermediate_registry_path: str,
+        images: List[dict],
         dockerhub_token: str,
         project_access_token: str,
+        mirror_cache: Optional[MirrorCache] = None,
+        clone_strategy: str = "full",
 ):
     """
     Create build and push to DockerHub.
 
+    The repository is cloned once and one kaniko pod per image is created,
+    all building from the same clone. If all images specify a build
+    context, only the build contexts, the directories containing the
+    Dockerfiles and the included paths are checked out (sparse checkout).
+
     Args:
         repo_url (str): URL of git repository to be cloned.
         branch (str): Branch of git repository used for checkout to build
@@ -235,17 +838,40 @@ def create_build(
         commit (str): Commit used for checkout to build image.
         base_dir (str): Location of base directory to clone git repository.
         build_id (str): Build Identifier.
-        dockerfile_location (str): Location of dockerfile used for docker build
-        taking git repository as base.
-        intermediate_registry_path (str): Path of repository to push build image.
+        images (list): Images to build, each with `index` (position in the
+        build's images), `dockerfile_location` (relative to the repository
+        root), `intermediate_registry_path` (path to push the image to) and
+        optionally `build_context`, `include_paths`, `commit_image_path`
+        (additional path tagged with the commit sha), `cache_repository`,
+        `cache_ttl` (kaniko layer caching) and `timeout` (seconds after which
+        the pod is deleted).
         dockerhub_token (str): Base 64 encoded USER:PASSWORD to access
         dockerhub to push image `echo -n USER:PASSWD | base64`
         project_access_token (str): Secret used to verify source, will be used
         by callback_url to inform pubgrade for build completion.
+        mirror_cache (MirrorCache): Cache of git mirrors to check out the
+        repository from, clone it directly if not specified.
+        clone_strategy (str): Strategy used to clone the repository if no
+        mirror cache is specified, see `git_clone_and_checkout`.
+
+    Returns:
+        pod_names (list): Names of the kaniko pods created, in the order of
+        `images`.
     """
-    deployment_file_location = "%s/%s/%s.yaml" % (base_dir, build_id, build_id)
     config_file_location = "%s/%s/config.json" % (base_dir, build_id)
 
+    sparse_paths = None
+    if all(image.get("build_context") for image in images):
+        sparse_paths = []
+        for image in images:
+            for path in get_sparse_paths(
+                image["build_context"],
+                image["dockerfile_location"],
+                image.get("include_paths") or [],
+            ):
+                if path not in sparse_paths:
+                    sparse_paths.append(path)
+
     # Clone project repository.
     clone_path = git_clone_and_checkout(
         repo_url=repo_url,
@@ -253,16 +879,9 @@ def create_build(
         commit=commit,
         base_dir=base_dir,
         build_id=build_id,
-    )
-
-    # Create kaniko deployment file.
-    create_deployment_YAML(
-        "%s/%s" % (clone_path, dockerfile_location),
-        intermediate_registry_path,
-        clone_path,
-        deployment_file_location,
-        "%s/config.json" % build_id,
-        project_access_token,
+        mirror_cache=mirror_cache,
+        strategy=clone_strategy,
+        sparse_paths=sparse_paths,
     )
 
     # Create dockerhub config file
@@ -271,17 +890,77 @@ def create_build(
         config_file_location=config_file_location,
     )
 
-    # Create kaniko deployment to build and publish image.
-    build_push_image_using_kaniko(
-        deployment_file_location=deployment_file_location
-    )
+    pod_names = []
+    for image in images:
+        pod_name = get_pod_name(build_id, image["index"])
+        context_path = clone_path
+        if image.get("build_context"):
+            context_path = os.path.normpath(
+                "%s/%s" % (clone_path, image["build_context"])
+            )
+
+        pod_spec = create_pod_spec(
+            "%s/%s" % (clone_path, image["dockerfile_location"]),
+            image["intermediate_registry_path"],
+            context_path,
+            "%s/config.json" % build_id,
+            project_access_token,
+            pod_name,
+            build_id,
+            image.get("commit_image_path", ""),
+            image.get("cache_repository", ""),
+            image.get("cache_ttl", ""),
+            image["index"],
+            image.get("timeout", 0),
+        )
+        if current_app.config["FOCA"].endpoints["builds"]["dump_pod_specs"]:
+            # Written for debugging only, the pod is created from `pod_spec`.
+            deployment_file_location = "%s/%s/%s.yaml" % (
+                base_dir,
+                build_id,
+                pod_name,
+            )
+            with open(deployment_file_location, "w") as yaml_file:
+                yaml_file.write(
+                    yaml.dump(pod_spec, default_flow_style=False)
+                )
+
+        # Create kaniko pod to build and publish image.
+        build_push_image_using_kaniko(pod_spec=pod_spec)
+        pod_names.append(pod_name)
+    return pod_names
+
+
+def get_pod_name(build_id: str, image_index: int) -> str:
+    """Get name of the kaniko pod building an image of a build.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+
+    Returns:
+        Pod name.
+    """
+    return "%s-%s" % (build_id, image_index)
 
 
 def git_clone_and_checkout(
-        repo_url: str, branch: str, commit: str, base_dir: str, build_id: str
+        repo_url: str,
+        branch: str,
+        commit: str,
+        base_dir: str,
+        build_id: str,
+        mirror_cache: Optional[MirrorCache] = None,
+        strategy: str = "full",
+        sparse_paths: Optional[List[str]] = None,
 ):
     """Clone git repository and checkout to specified branch/commit/tag.
 
+    If a mirror cache is given, the repository is checked out as a worktree
+    of the cached mirror instead of being cloned and `strategy` is ignored.
+    Checkouts left behind by previous attempts of the build are replaced;
+    failed checkouts are removed.
+
     Args:
         repo_url (str): URL of git repository to be cloned.
         branch (str): Branch of git repository used for checkout to build
@@ -289,6 +968,15 @@ def git_clone_and_checkout(
         commit (str): Commit used for checkout to build image.
         base_dir (str): Location of base directory to clone git repository.
         build_id (str): Build Identifier.
+        mirror_cache (MirrorCache): Cache of git mirrors to check out the
+        repository from.
+        strategy (str): Clone strategy, one of `full` (complete clone),
+        `shallow` (fetch only the requested commit/tag/branch head with depth
+        1, deepening the history if the commit is not reachable) or `partial`
+        (complete history without file contents, which are fetched on
+        checkout).
+        sparse_paths (list): Directories to check out (sparse checkout, cone
+        mode), all files are checked out if not specified.
 
     Returns:
         clone_path (str): Path of the directory where git repository is cloned.
@@ -301,23 +989,154 @@ def git_clone_and_checkout(
         build_id,
         repo_url.split("/")[4].split(".")[0],
     )
+    # Retried builds are checked out again from scratch.
+    shutil.rmtree(clone_path, ignore_errors=True)
     try:
+        if mirror_cache is not None:
+            # Check out commit/tag if specified, otherwise HEAD of branch.
+            return mirror_cache.checkout_worktree(
+                repo_url, clone_path, commit or branch, sparse_paths
+            )
+        if strategy == "shallow":
+            shallow_clone(repo_url, clone_path, branch, commit, sparse_paths)
+            return clone_path
+        clone_options = {}
+        if strategy == "partial":
+            clone_options["filter"] = "blob:none"
+        if sparse_paths:
+            clone_options["no_checkout"] = True
         # Check if head commit is branch or tag.
         if branch != "":
             # If branch is specified.
-            repo = Repo.clone_from(repo_url, clone_path, branch=branch)
+            repo = Repo.clone_from(
+                repo_url, clone_path, branch=branch, **clone_options
+            )
         else:
             # If tag is specified.
-            repo = Repo.clone_from(repo_url, clone_path)
+            repo = Repo.clone_from(repo_url, clone_path, **clone_options)
+        if sparse_paths:
+            set_sparse_checkout(repo, sparse_paths)
+            repo.git.checkout(commit or branch or "HEAD")
+            return clone_path
         # Checkout only if tag or commit sha is specified, otherwise stay at
         # HEAD of branch.
         if commit != "":
             repo.git.checkout(commit)
         return clone_path
     except GitCommandError:
+        shutil.rmtree(clone_path, ignore_errors=True)
         raise GitCloningError
 
 
+def shallow_clone(
+        repo_url: str,
+        clone_path: str,
+        branch: str,
+        commit: str,
+        sparse_paths: Optional[List[str]] = None,
+):
+    """Fetch only the requested commit of a git repository and check it out.
+
+    The commit sha, tag or branch head is first fetched with depth 1. If that
+    is not possible (e.g. abbreviated commit sha, or server not allowing to
+    fetch unadvertised commits), the branch history is deepened step by step
+    until the commit is reachable, falling back to the complete history.
+
+    Args:
+        repo_url (str): URL of git repository to be cloned.
+        clone_path (str): Location to clone git repository.
+        branch (str): Branch containing the commit, empty if tag is
+        specified.
+        commit (str): Commit sha or tag to checkout, empty to checkout HEAD
+        of branch.
+        sparse_paths (list): Directories to check out, all files are checked
+        out if not specified.
+
+    Returns:
+        repo (Repo): Cloned repository.
+
+    Raises:
+        GitCommandError: Raised when commit could not be fetched.
+    """
+    repo = Repo.init(clone_path)
+    repo.create_remote("origin", repo_url)
+    if sparse_paths:
+        set_sparse_checkout(repo, sparse_paths)
+    if commit == "" or branch == "" or len(commit) == 40:
+        try:
+            repo.git.fetch("--depth", "1", "origin", commit or branch)
+            repo.git.checkout("FETCH_HEAD")
+            return repo
+        except GitCommandError:
+            logger.info(
+                f"Could not fetch {commit or branch} of {repo_url} directly, "
+                f"fetching more history."
+            )
+    if branch != "" and commit != "":
+        for depth in SHALLOW_FETCH_DEPTHS:
+            repo.git.fetch("--depth", str(depth), "origin", branch)
+            if commit_exists(repo, commit):
+                repo.git.checkout(commit)
+                return repo
+    # Last resort: complete history of all branches and tags.
+    if os.path.isfile(os.path.join(repo.git_dir, "shallow")):
+        repo.git.fetch("--unshallow", "--tags", "origin")
+    else:
+        repo.git.fetch("--tags", "origin")
+    repo.git.checkout(commit or branch)
+    return repo
+
+
+def get_sparse_paths(
+        build_context: str, dockerfile_location: str, include_paths: List[str]
+) -> List[str]:
+    """Get directories to check out for building an image.
+
+    Args:
+        build_context (str): Location of build context relative to the
+        repository root.
+        dockerfile_location (str): Location of Dockerfile relative to the
+        repository root.
+        include_paths (list): Additional directories relative to the
+        repository root.
+
+    Returns:
+        sparse_paths (list): Directories to check out, without duplicates and
+        the repository root (which is always checked out).
+
+    Raises:
+        GitCloningError: Raised when a path points outside the repository.
+    """
+    paths = [build_context, os.path.dirname(dockerfile_location)]
+    paths.extend(include_paths)
+    sparse_paths = []
+    for path in paths:
+        path = os.path.normpath(path).lstrip("/")
+        if path == ".." or path.startswith("../"):
+            logger.error(f"Path {path} is outside of the repository.")
+            raise GitCloningError
+        if path not in (".", "") and path not in sparse_paths:
+            sparse_paths.append(path)
+    return sparse_paths
+
+
+def commit_exists(repo: Repo, commit: str) -> bool:
+    """Check whether commit is available in local repository.
+
+    Args:
+        repo (Repo): Git repository.
+        commit (str): Commit sha (full or abbreviated) or tag.
+
+    Returns:
+        `True` if commit is available, otherwise `False`.
+    """
+    try:
+        repo.git.rev_parse("--verify", "--quiet", "%s^{commit}" % commit)
+        return True
+    except GitCommandError:
+        return False
+
+
 def create_deployment_YAML(
         dockerfile_location: str,
         intermediate_registry_path: str,
@@ -325,6 +1144,11 @@ def create_deployment_YAML(
         deployment_file_location: str,
         config_file_location: str,
         project_access_token: str,
+        commit_image_path: str = "",
+        cache_repository: str = "",
+        cache_ttl: str = "",
+        pod_name: str = "",
+        image_index: int = 0,
 ):
     """Create kaniko deployment file.
 
@@ -341,6 +1165,15 @@ def create_deployment_YAML(
         dockerhub access token.
         project_access_token (str): Secret used to verify source, will be used
         by callback_url to inform pubgrade for build completion.
+        commit_image_path (str): Additional path to push build image to,
+        tagged with the commit sha.
+        cache_repository (str): Repository for kaniko to cache layers in,
+        layer caching is disabled if not specified.
+        cache_ttl (str): Time after which cached layers expire, kaniko's
+        default if not specified.
+        pod_name (str): Name of kaniko pod, defaults to the build identifier.
+        image_index (int): Position of the image in the build's images,
+        reported back on completion.
 
     Returns:
         deployment_file_location (str): Location of kaniko deployment file
@@ -352,47 +1185,146 @@ def create_deployment_YAML(
     """
     try:
         build_id = deployment_file_location.split("/")[2]
-        file_stream = open(template_file, "r")
-        data = yaml.load(file_stream, Loader=yaml.FullLoader)
-        data["metadata"]["name"] = build_id
-        data["spec"]["containers"][0]["args"] = [
-            f"--dockerfile={dockerfile_location}",
-            f"--destination={intermediate_registry_path}",
-            f"--context={build_context}",
-            "--cleanup",
-        ]
-        data["spec"]["containers"][0]["volumeMounts"][1][
-            "mountPath"
-        ] = "/kaniko/.docker/config.json"
-        data["spec"]["volumes"][0]["persistentVolumeClaim"][
-            "claimName"
-        ] = os.getenv("PV_NAME")
-        data["spec"]["containers"][0]["volumeMounts"][1][
-            "subPath"
-        ] = config_file_location
-        data["spec"]["containers"][0]["env"][0][
-            "value"
-        ] = build_id  # BUILDNAME
-        data["spec"]["containers"][0]["env"][1][
-            "value"
-        ] = project_access_token  # ACCESSTOKEN
-        if os.getenv("NAMESPACE"):
-            data["spec"]["containers"][0]["env"][2]["value"] = os.getenv(
-                "NAMESPACE"
-            )  # NAMESPACE
-        else:
-            data["spec"]["containers"][0]["env"][2]["value"] = "default"
-        data["spec"]["containers"][0]["env"][3][
-            "value"
-        ] = os.getenv("PUBGRADE_URL")
-        data["spec"]["containers"][0]["env"][4]["value"] = "8080"  # PORT
+        pod_spec = create_pod_spec(
+            dockerfile_location,
+            intermediate_registry_path,
+            build_context,
+            config_file_location,
+            project_access_token,
+            pod_name or build_id,
+            build_id,
+            commit_image_path,
+            cache_repository,
+            cache_ttl,
+            image_index,
+        )
         with open(deployment_file_location, "w") as yaml_file:
-            yaml_file.write(yaml.dump(data, default_flow_style=False))
+            yaml_file.write(yaml.dump(pod_spec, default_flow_style=False))
         return deployment_file_location
     except OSError:
         raise OSError
 
 
+@functools.lru_cache(maxsize=None)
+def load_pod_template(template_location: str) -> str:
+    """Parse kaniko pod template once per process.
+
+    Args:
+        template_location (str): Location of kaniko pod template.
+
+    Returns:
+        Parsed template, serialized as JSON so that it cannot be modified;
+        see `get_pod_template`.
+    """
+    with open(template_location) as f:
+        return json.dumps(yaml.safe_load(f))
+
+
+def get_pod_template() -> dict:
+    """Get a fresh copy of the kaniko pod template.
+
+    Returns:
+        Pod spec parsed from `template_file`.
+    """
+    return json.loads(load_pod_template(template_file))
+
+
+def set_env(container: dict, name: str, value: str):
+    """Set value of environment variable of container, add it if missing.
+
+    Args:
+        container (dict): Container spec.
+        name (str): Name of environment variable.
+        value (str): Value of environment variable.
+    """
+    env = container.setdefault("env", [])
+    for var in env:
+        if var["name"] == name:
+            var["value"] = value
+            return
+    env.append({"name": name, "value": value})
+
+
+def create_pod_spec(
+        dockerfile_location: str,
+        intermediate_registry_path: str,
+        build_context: str,
+        config_file_location: str,
+        project_access_token: str,
+        pod_name: str,
+        build_id: str,
+        commit_image_path: str = "",
+        cache_repository: str = "",
+        cache_ttl: str = "",
+        image_index: int = 0,
+        timeout: int = 0,
+) -> dict:
+    """Create kaniko pod spec from template.
+
+    Args:
+        dockerfile_location (str): Location of dockerfile used for docker build
+        taking git repository as base.
+        intermediate_registry_path (str): Path of repository to push build image.
+        build_context: Location of build context.
+        config_file_location (str): Dockerhub config file location, contains
+        dockerhub access token.
+        project_access_token (str): Secret used to verify source, will be used
+        by callback_url to inform pubgrade for build completion.
+        pod_name (str): Name of kaniko pod.
+        build_id (str): Build identifier, reported back on completion.
+        commit_image_path (str): Additional path to push build image to,
+        tagged with the commit sha.
+        cache_repository (str): Repository for kaniko to cache layers in,
+        layer caching is disabled if not specified.
+        cache_ttl (str): Time after which cached layers expire, kaniko's
+        default if not specified.
+        image_index (int): Position of the image in the build's images,
+        reported back on completion.
+        timeout (int): Seconds after which build-complete-updater deletes
+        the pod and reports the build as timed out, no timeout if zero.
+
+    Returns:
+        pod_spec (dict): Kaniko pod spec.
+    """
+    pod_spec = get_pod_template()
+    pod_spec["metadata"]["name"] = pod_name
+    container = pod_spec["spec"]["containers"][0]
+    container["args"] = [
+        f"--dockerfile={dockerfile_location}",
+        f"--destination={intermediate_registry_path}",
+        f"--context={build_context}",
+        "--cleanup",
+    ]
+    if commit_image_path:
+        container["args"].insert(2, f"--destination={commit_image_path}")
+    if cache_repository:
+        container["args"] += [
+            "--cache=true",
+            f"--cache-repo={cache_repository}",
+        ]
+        if cache_ttl:
+            container["args"].append(f"--cache-ttl={cache_ttl}")
+    for volume_mount in container["volumeMounts"]:
+        if volume_mount["mountPath"] == "/kaniko/.docker/config.json":
+            volume_mount["subPath"] = config_file_location
+    for volume in pod_spec["spec"]["volumes"]:
+        if "persistentVolumeClaim" in volume:
+            volume["persistentVolumeClaim"]["claimName"] = os.getenv(
+                "PV_NAME"
+            )
+    set_env(container, "BUILDNAME", build_id)
+    set_env(container, "ACCESSTOKEN", project_access_token)
+    set_env(container, "NAMESPACE", os.getenv("NAMESPACE") or "default")
+    set_env(container, "PUBGRADE_URL", os.getenv("PUBGRADE_URL"))
+    set_env(container, "PUBGRADE_PORT", "8080")
+    set_env(container, "IMAGE_INDEX", str(image_index))
+    if timeout:
+        pod_spec["metadata"].setdefault("annotations", {})[
+            TIMEOUT_ANNOTATION
+        ] = str(timeout)
+    return pod_spec
+
+
 def create_dockerhub_config_file(
         dockerhub_token: str, config_file_location: str
 ):
@@ -420,52 +1352,113 @@ def create_dockerhub_config_file(
     f.close()
 
 
-def build_push_image_using_kaniko(deployment_file_location: str):
+def build_push_image_using_kaniko(
+        deployment_file_location: str = "", pod_spec: Optional[dict] = None
+):
     """Create kaniko deployment. Build and push image.
 
     Args:
-        deployment_file_location (str): Location of kaniko deployment file.
+        deployment_file_location (str): Location of kaniko deployment file,
+        only read if `pod_spec` is not specified.
+        pod_spec (dict): Kaniko pod spec.
+
+    Pods which already exist, e.g. because they were created by a previous
+    attempt of the build, are left as they are.
 
     Raises:
         CreatePodError: Raised when unable to create deployment.
     """
-    # Retrieve values of NAMESPACE and KUBERNETES_SERVICE_HOST from
-    # environment variables.
+    # Retrieve value of NAMESPACE from environment variables.
     if os.getenv("NAMESPACE"):
         namespace = os.getenv("NAMESPACE")
     else:
         namespace = "default"
-    if os.getenv("KUBERNETES_SERVICE_HOST"):
-        config.load_incluster_config()
-    else:
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
+    kubernetes_client = get_kubernetes_client()
 
-    # Create namespaced pod using kubernetes CoreV1Api from kaniko
-    # deployment file.
-    with open(deployment_file_location) as f:
-        dep = yaml.safe_load(f)
-        try:
-            resp = v1.create_namespaced_pod(body=dep, namespace=namespace)
-        except ApiException as e:
-            logger.error(
-                "Exception when calling "
-                "AppsV1Api->create_namespaced_pod: "
-                "%s\n" % e
+    if pod_spec is None:
+        with open(deployment_file_location) as f:
+            pod_spec = yaml.safe_load(f)
+
+    # Create namespaced pod using kubernetes CoreV1Api from kaniko pod spec.
+    try:
+        resp = kubernetes_client.core_v1().create_namespaced_pod(
+            body=pod_spec,
+            namespace=namespace,
+            _request_timeout=kubernetes_client.request_timeout,
+        )
+    except ApiException as e:
+        if e.status == 409:
+            logger.info(
+                "Pod '%s' already exists." % pod_spec["metadata"]["name"]
             )
-            raise CreatePodError
-        logger.info("Deployment created. status='%s'" % resp)
+            return
+        kubernetes_client.reset_if_unauthorized(e)
+        logger.error(
+            "Exception when calling "
+            "AppsV1Api->create_namespaced_pod: "
+            "%s\n" % e
+        )
+        raise CreatePodError
+    logger.info("Deployment created. status='%s'" % resp)
+
+
+def get_build_image(
+        build_id: str, image_index: int, build: Optional[dict] = None
+):
+    """Get build and one of its images.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        build (dict): Build with its `status` and `images`, loaded if not
+        specified.
+
+    Returns:
+        build (dict): Build with its `status` and `images`.
+        image (dict): Image at `image_index`.
+
+    Raises:
+        BuildNotFound: Raised when object with given build identifier or
+        image was not found.
+    """
+    if build is None:
+        db_collection_builds = (
+            current_app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        build = db_collection_builds.find_one(
+            {"id": build_id}, BUILD_STATUS_PROJECTION
+        )
+    if build is None:
+        raise BuildNotFound
+    try:
+        return build, build["images"][image_index]
+    except IndexError:
+        raise BuildNotFound
 
 
 def build_completed(
-        repository_id: str, build_id: str, project_access_token: str
+        repository_id: str,
+        build_id: str,
+        project_access_token: str,
+        image_index: int = 0,
+        status: str = "SUCCEEDED",
+        reason: str = "",
+        exit_code: Optional[int] = None,
 ):
-    """Update build completion.
+    """Update build completion of an image.
 
     Args:
         repository_id (str): Repository identifier.
         build_id (str): Build identifier.
         project_access_token (str): Secret to verify source of the request.
+        image_index (int): Position of the built image in the build's images.
+        status (str): `SUCCEEDED` if the image was built and pushed, `FAILED`
+        or `TIMED_OUT` if its kaniko pod failed or ran out of time.
+        reason (str): Why the image could not be built.
+        exit_code (int): Exit code of the kaniko container, if it terminated.
 
     Returns:
         build_id (str): Build identifier of completed build.
@@ -482,51 +1475,495 @@ def build_completed(
         .collections["repositories"]
         .client
     )
+
+    data_from_db = db_collection_repositories.find_one({"id": repository_id})
+    if data_from_db is None:
+        raise RepositoryNotFound
+    if data_from_db["access_token"] != project_access_token:
+        raise Unauthorized
+    if status != "SUCCEEDED":
+        return fail_image(build_id, image_index, status, reason, exit_code)
+    return complete_image(data_from_db, build_id, image_index)
+
+
+def complete_builds(completions: List[dict]):
+    """Update build completion of many images at once.
+
+    Repositories and builds of all completions are loaded with one query
+    each; completions are then processed in parallel, at most
+    `completion_workers` (see builds configuration) at a time.
+
+    Args:
+        completions (list): Completions, each with `repository_id`,
+        `build_id`, `access_token` and optionally `image_index`, `status`,
+        `reason` and `exit_code`, see `build_completed`.
+
+    Returns:
+        Result of each completion, in the order of `completions`, with its
+        `repository_id`, `build_id`, `image_index`, `status_code` (`200` if
+        the completion was recorded) and `error` if it was not.
+    """
+    db_collection_repositories = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["repositories"]
+        .client
+    )
     db_collection_builds = (
         current_app.config["FOCA"]
         .db.dbs["pubgradeStore"]
         .collections["builds"]
         .client
     )
+    repositories = {
+        repository["id"]: repository
+        for repository in db_collection_repositories.find(
+            {
+                "id": {
+                    "$in": list(
+                        {item["repository_id"] for item in completions}
+                    )
+                }
+            }
+        )
+    }
+    loaded_builds = {
+        build["id"]: build
+        for build in db_collection_builds.find(
+            {"id": {"$in": list({item["build_id"] for item in completions})}},
+            BUILD_STATUS_PROJECTION,
+        )
+    }
 
-    data_from_db = db_collection_repositories.find_one({"id": repository_id})
-    if data_from_db is None:
-        raise RepositoryNotFound
-    if data_from_db["access_token"] != project_access_token:
-        raise Unauthorized
-    try:
-        data = db_collection_builds.find(
-            {'id': build_id}, {'_id': False}
-        ).limit(1).next()
-        data['status'] = "SUCCEEDED"
-        data['finished_at'] = str(
-            datetime.datetime.now().isoformat())
-
-        intermediate_registry_format = current_app.config["FOCA"].endpoints["builds"]["intermediate_registery_format"]
-        trigger_signing_image(
-            image_path=data["images"][0]["name"],
-            cosign_private_key=cosign_private_key,
-            dockerhub_token=data["dockerhub_token"],
-            cosign_password=cosign_password,
-            pull_tag=intermediate_registry_format.format(data["images"][0]["name"].split("/")[1].split(":")[0]),
-            push_tag=data["images"][0]["name"]
-        )
-
-        db_collection_builds.update_one({"id": data['id']},
-                                        {"$set": data})
-        remove_files(BASE_DIR + "/" + build_id, build_id, "pubgrade-ns")
-
-        # Notifies available subscriptions registered for the repository.
-        if "subscription_list" in data_from_db:
-            subscription_list = data_from_db["subscription_list"]
-            for subscription in subscription_list:
-                # for image_name in data['images']:
-                notify_subscriptions(
-                    subscription, data["images"][0]["name"], build_id
-                )
+    def complete(app, item):
+        result = {
+            "repository_id": item["repository_id"],
+            "build_id": item["build_id"],
+            "image_index": item.get("image_index", 0),
+            "status_code": 200,
+        }
+        try:
+            with app.app_context():
+                repository = repositories.get(item["repository_id"])
+                if repository is None:
+                    raise RepositoryNotFound
+                if repository["access_token"] != item["access_token"]:
+                    raise Unauthorized
+                build = loaded_builds.get(item["build_id"])
+                if build is None:
+                    raise BuildNotFound
+                if item.get("status", "SUCCEEDED") != "SUCCEEDED":
+                    fail_image(
+                        item["build_id"],
+                        result["image_index"],
+                        item["status"],
+                        item.get("reason", ""),
+                        item.get("exit_code"),
+                        build=build,
+                    )
+                else:
+                    complete_image(
+                        repository,
+                        item["build_id"],
+                        result["image_index"],
+                        build=build,
+                    )
+        except HTTPException as e:
+            result.update(status_code=e.code, error=e.description)
+        except Exception as e:
+            logger.exception(
+                f"Could not complete image {result['image_index']} of build "
+                f"{item['build_id']}."
+            )
+            result.update(status_code=500, error=repr(e))
+        return result
+
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(
+        max_workers=current_app.config["FOCA"].endpoints["builds"][
+            "completion_workers"
+        ]
+    ) as executor:
+        return {
+            "results": list(
+                executor.map(lambda item: complete(app, item), completions)
+            )
+        }
+
+
+def fail_image(
+        build_id: str,
+        image_index: int,
+        status: str,
+        reason: str = "",
+        exit_code: Optional[int] = None,
+        build: Optional[dict] = None,
+):
+    """Mark image and its build as failed or timed out and queue clean up.
+
+    Kaniko pods of the build's other images still running are deleted in
+    the background and those images get the same state. Reporting an image
+    which already finished does nothing.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        status (str): `FAILED` or `TIMED_OUT`.
+        reason (str): Why the image could not be built.
+        exit_code (int): Exit code of the kaniko container, if it terminated.
+        build (dict): Build with its `status` and `images`, if already loaded.
+
+    Returns:
+        build_id (str): Build identifier of failed build.
+
+    Raises:
+        BuildNotFound: Raised when object with given build identifier was
+        not found.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    data, image = get_build_image(build_id, image_index, build)
+    if image.get("status") in FINISHED_STATES:
         return {"id": build_id}
-    except StopIteration:
-        raise BuildNotFound
+    finished_at = str(datetime.datetime.now().isoformat())
+    # Clone directory and kaniko pods are reclaimed in the background; the
+    # clean up of each image is recorded with its state.
+    cleanup = {
+        "pod_names": [image.get("pod_name", build_id)],
+        "remove_directory": True,
+    }
+    data = db_collection_builds.find_one_and_update(
+        {
+            "id": build_id,
+            f"images.{image_index}.status": {"$nin": list(FINISHED_STATES)},
+        },
+        add_pending_steps(
+            {
+                "$set": {
+                    f"images.{image_index}.status": status,
+                    f"images.{image_index}.finished_at": finished_at,
+                    f"images.{image_index}.reason": reason,
+                    f"images.{image_index}.exit_code": exit_code,
+                }
+            },
+            image_index,
+            {"cleanup": cleanup},
+        ),
+    )
+    if data is None:
+        # Completion was reported concurrently.
+        return {"id": build_id}
+    logger.warning(
+        f"Image {image_index} of build {build_id} {status.lower()}: "
+        f"{reason} (exit code {exit_code})."
+    )
+    cleanups = {image_index: cleanup}
+    for index, other_image in enumerate(data["images"]):
+        if index == image_index:
+            continue
+        if other_image.get("status") in FINISHED_STATES:
+            continue
+        update = {
+            "$set": {
+                f"images.{index}.status": status,
+                f"images.{index}.finished_at": finished_at,
+                f"images.{index}.reason": (
+                    "Image %s of the build did not succeed." % image_index
+                ),
+            }
+        }
+        if "pod_name" in other_image:
+            cleanups[index] = {"pod_names": [other_image["pod_name"]]}
+            add_pending_steps(update, index, {"cleanup": cleanups[index]})
+        # Each image is guarded by its own state, so that images completed
+        # since the build was read keep their state and pod.
+        result = db_collection_builds.update_one(
+            {
+                "id": build_id,
+                f"images.{index}.status": {"$nin": list(FINISHED_STATES)},
+            },
+            update,
+        )
+        if not result.modified_count:
+            cleanups.pop(index, None)
+    result = db_collection_builds.update_one(
+        {"id": build_id, "status": {"$nin": list(FINISHED_STATES)}},
+        {
+            "$set": {
+                "status": status,
+                "finished_at": finished_at,
+                "error": reason,
+            },
+            "$unset": {"active_build_key": ""},
+        },
+    )
+    if result.modified_count:
+        release_slot(build_id)
+
+    for index, payload in cleanups.items():
+        enqueue_task(build_id, index, "cleanup", payload)
+    return {"id": build_id}
+
+
+def complete_image(
+        repository: dict,
+        build_id: str,
+        image_index: int,
+        remove_pod: bool = True,
+        build: Optional[dict] = None,
+):
+    """Mark image as built and queue signing, clean up and notifications.
+
+    The build succeeds once all of its images are built. Signing the image
+    and cleaning up are run by background workers, see
+    `pubgrade.modules.build_tasks`. Notifications of matching subscriptions
+    are written to the outbox, see `pubgrade.modules.outbox`, or by
+    background workers if that fails. Completing an image which already
+    finished, or an image of a build which already finished, does nothing.
+
+    Args:
+        repository (dict): Repository the build belongs to.
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        remove_pod (bool): Whether to remove the image's kaniko pod; images
+        reused from the registry have none.
+        build (dict): Build with its `status` and `images`, if already loaded.
+
+    Returns:
+        build_id (str): Build identifier of completed build.
+
+    Raises:
+        BuildNotFound: Raised when object with given build identifier was
+        not found.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    data, image = get_build_image(build_id, image_index, build)
+    if (
+        data.get("status") in FINISHED_STATES
+        or image.get("status") in FINISHED_STATES
+    ):
+        return {"id": build_id}
+    pod_name = image.get("pod_name", build_id)
+    # Whether to remove the build directory is decided when the clean up is
+    # run, once it is known whether the build finished.
+    steps = {
+        "sign": None,
+        "cleanup": {
+            "pod_names": [pod_name] if remove_pod else [],
+            "cache_stats": remove_pod,
+        },
+    }
+    if repository.get("subscription_list"):
+        steps["notify"] = {"repository_id": repository["id"]}
+
+    # Mark image as built first, so that repeated or concurrent completions
+    # of the same image neither queue signing nor notifications twice. Its
+    # steps are recorded in the same update, so that they are run even if
+    # they could not be queued below.
+    data = db_collection_builds.find_one_and_update(
+        {
+            "id": build_id,
+            f"images.{image_index}.status": {"$nin": list(FINISHED_STATES)},
+        },
+        add_pending_steps(
+            {
+                "$set": {
+                    f"images.{image_index}.status": "SUCCEEDED",
+                    f"images.{image_index}.finished_at": str(
+                        datetime.datetime.now().isoformat()
+                    ),
+                },
+                "$inc": {"images_succeeded": 1},
+            },
+            image_index,
+            steps,
+        ),
+        return_document=ReturnDocument.AFTER,
+    )
+    if data is None:
+        # Completion was reported concurrently.
+        return {"id": build_id}
+
+    build_succeeded = data["images_succeeded"] >= len(data["images"])
+    if build_succeeded:
+        db_collection_builds.update_one(
+            {"id": build_id},
+            {
+                "$set": {
+                    "status": "SUCCEEDED",
+                    "finished_at": str(datetime.datetime.now().isoformat()),
+                },
+                "$unset": {"active_build_key": ""},
+            },
+        )
+        release_slot(build_id)
+
+    # Signing and clean up are run by background workers.
+    for step in ("sign", "cleanup"):
+        enqueue_task(build_id, image_index, step, steps[step])
+    if "notify" in steps:
+        # Notifications are written right away; if that fails, the step is
+        # left pending and run by background workers later on.
+        try:
+            add_image_notifications(repository, data, image_index)
+        except Exception:
+            logger.exception(
+                f"Could not notify subscriptions of image {image_index} of "
+                f"build {build_id}."
+            )
+        else:
+            complete_pending_step(build_id, image_index, "notify")
+    return {"id": build_id}
+
+
+def add_image_notifications(repository: dict, build: dict, image_index: int):
+    """Record built image for the subscriptions matching its build.
+
+    Subscriptions without `callback_url` poll their update log, see
+    `pubgrade.modules.endpoints.subscriptions`. Notifications of the others
+    are delivered from the outbox by background workers, see
+    `pubgrade.modules.outbox`. Both are written at most once per image.
+
+    Args:
+        repository (dict): Repository the build belongs to.
+        build (dict): Build with its `images` and head commits.
+        image_index (int): Position of the image in the build's images.
+    """
+    subscriptions = find_matching_subscriptions(repository["id"], build)
+    image = build["images"][image_index]["name"]
+    add_subscription_updates(build["id"], image, subscriptions)
+    # Builds are ordered by when they started; build identifiers break ties.
+    add_notifications(
+        build["id"],
+        image_index,
+        image,
+        [
+            subscription
+            for subscription in subscriptions
+            if subscription.get("callback_url")
+        ],
+        sequence=f"{build.get('started_at', '')} {build['id']}",
+        delivery_policy=repository.get("delivery_policy"),
+    )
+
+
+def notify_subscriptions_of_image(task: dict):
+    """Record built image for the subscriptions matching its build.
+
+    Run by background workers if it failed when the image was completed,
+    see `add_image_notifications`.
+
+    Args:
+        task (dict): `notify` task of the image, see
+        `pubgrade.modules.build_tasks`, with the `repository_id` of the
+        build.
+
+    Raises:
+        BuildNotFound: Raised when the build or image was not found.
+    """
+    repository = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["repositories"]
+        .client.find_one({"id": task["payload"]["repository_id"]})
+    )
+    if repository is None:
+        # Repository was deleted meanwhile.
+        return
+    build = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client.find_one({"id": task["build_id"]})
+    )
+    data, _ = get_build_image(task["build_id"], task["image_index"], build)
+    add_image_notifications(repository, data, task["image_index"])
+
+
+def sign_image(task: dict):
+    """Trigger signing of a built image.
+
+    Args:
+        task (dict): `sign` task of the image, see
+        `pubgrade.modules.build_tasks`.
+
+    Raises:
+        BuildNotFound: Raised when the build or image was not found.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    build = db_collection_builds.find_one({"id": task["build_id"]})
+    data, image = get_build_image(task["build_id"], task["image_index"], build)
+    intermediate_registry_format = current_app.config["FOCA"].endpoints[
+        "builds"
+    ]["intermediate_registery_format"]
+    trigger_signing_image(
+        image_path=image["name"],
+        cosign_private_key=cosign_private_key,
+        dockerhub_token=data["dockerhub_token"],
+        cosign_password=cosign_password,
+        pull_tag=image.get("intermediate_image")
+        or intermediate_registry_format.format(
+            image["name"].split("/")[1].split(":")[0]
+        ),
+        push_tag=image["name"],
+    )
+
+
+def clean_up_image(task: dict):
+    """Delete kaniko pods and build directory of a finished image.
+
+    Cache statistics are read from the image's kaniko pod before it is
+    deleted, if requested. Unless `remove_directory` is given, the build
+    directory is removed if the build finished.
+
+    Args:
+        task (dict): `cleanup` task of the image, see
+        `pubgrade.modules.build_tasks`, with `pod_names` to delete and
+        whether to store `cache_stats` and to `remove_directory`.
+
+    Raises:
+        DeletePodError: Raised when a pod could not be deleted.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    build_id = task["build_id"]
+    payload = task["payload"]
+    pod_names = payload.get("pod_names", [])
+    if payload.get("cache_stats") and pod_names:
+        cache_stats = get_cache_stats(pod_names[0], "pubgrade-ns")
+        if cache_stats is not None:
+            db_collection_builds.update_one(
+                {"id": build_id},
+                {"$set": {f"images.{task['image_index']}.cache": cache_stats}},
+            )
+    remove_directory = payload.get("remove_directory")
+    if remove_directory is None:
+        build = db_collection_builds.find_one({"id": build_id}, {"status": 1})
+        remove_directory = (
+            build is not None and build.get("status") in FINISHED_STATES
+        )
+    if remove_directory:
+        shutil.rmtree(BASE_DIR + "/" + build_id, ignore_errors=True)
+    for pod_name in pod_names:
+        delete_pod(pod_name, "pubgrade-ns")
 
 
 def remove_files(dir_location: str, pod_name: str, namespace: str):
@@ -538,7 +1975,8 @@ def remove_files(dir_location: str, pod_name: str, namespace: str):
         deleted.
         namespace (str): Namespace of pod.
     """
-    shutil.rmtree(dir_location)
+    # Missing directories must not keep the pod from being deleted.
+    shutil.rmtree(dir_location, ignore_errors=True)
     delete_pod(pod_name, namespace)
 
 
@@ -551,16 +1989,25 @@ def delete_pod(name: str, namespace: str):
         namespace (str): Namespace of pod.
 
     Returns:
-        Response of CoreV1Api on deleting pod.
+        Response of CoreV1Api on deleting pod, `None` if the pod did not
+        exist.
 
     Raises:
         DeletePodError: Raised when encountered an error while deleting pod.
     """
+    kubernetes_client = get_kubernetes_client()
     try:
-        api_instance = client.CoreV1Api()
-        api_response = api_instance.delete_namespaced_pod(name, namespace)
+        api_response = kubernetes_client.core_v1().delete_namespaced_pod(
+            name,
+            namespace,
+            _request_timeout=kubernetes_client.request_timeout,
+        )
         return api_response
     except ApiException as e:
+        if e.status == 404:
+            # Deleted already, e.g. by an earlier attempt to clean up.
+            return None
+        kubernetes_client.reset_if_unauthorized(e)
         logger.error(
             "Exception when calling "
             "AppsV1Api->delete_namespaced_deployment: "
@@ -593,4 +2040,17 @@ def trigger_signing_image(cosign_private_key: str, cosign_password: str, dockerh
         'X-GitHub-Api-Version': '2022-11-28',
         'Content-Type': 'application/json'
     }
-    response = requests.request("POST", url, headers=headers, data=payload)
+    try:
+        response = get_http_client().request(
+            "POST", url, headers=headers, data=payload
+        )
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Could not trigger signing of {image_path}: {e}")
+        raise SigningError
+    # GitHub answers accepted dispatches with `204 No Content`.
+    if not response.ok:
+        logger.error(
+            f"Triggering signing of {image_path} failed with status "
+            f"{response.status_code}: {response.text}"
+        )
+        raise SigningError
@@ -14,6 +14,16 @@ from pubgrade.errors.exceptions import (
 
 logger = logging.getLogger(__name__)
 
+# Optional per-repository build settings accepted on registering/modifying a
+# repository.
+REPOSITORY_SETTINGS = (
+    "clone_strategy",
+    "cache",
+    "max_concurrent_builds",
+    "build_timeout",
+    "delivery_policy",
+)
+
 
 def register_repository(data: dict):
     """Register a new repository object.
@@ -36,6 +46,9 @@ def register_repository(data: dict):
         # Needs to verify validity of repository url.
     except KeyError:
         raise URLNotFound
+    for setting in REPOSITORY_SETTINGS:
+        if setting in data:
+            repository_object[setting] = data[setting]
 
     db_collection = (
         current_app.config["FOCA"]
@@ -96,6 +109,8 @@ def register_repository(data: dict):
     if "_id" in repository_object:
         del repository_object["_id"]
     del repository_object["url"]
+    for setting in REPOSITORY_SETTINGS:
+        repository_object.pop(setting, None)
     logger.info(f"Added object with '{repository_object}'.")
     return repository_object
 
@@ -232,6 +247,8 @@ def modify_repository_info(repo_id: str, access_token: str, data: dict):
         filter={"id": repo_id}, replacement=data
     )
     del data["url"]
+    for setting in REPOSITORY_SETTINGS:
+        data.pop(setting, None)
     return data
 
 
@@ -1,19 +1,25 @@
 import datetime
 import logging
+import time
+from typing import List, Optional
+from urllib.parse import urlparse
 
 import requests
 from pubgrade.errors.exceptions import (
     RepositoryNotFound,
     UserNotFound,
     SubscriptionNotFound,
-    BuildNotFound,
     RequestNotSent,
     InternalServerError,
     UserNotVerified,
 )
 from pubgrade.modules.endpoints.repositories import generate_id
+from pubgrade.modules.callback_hosts import get_callback_hosts
+from pubgrade.modules.http_client import get_http_client
+from pubgrade.modules.outbox import DeliveryDeferred
 from flask import current_app
 import json
+from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
 from werkzeug.exceptions import Unauthorized
 
@@ -247,26 +253,216 @@ def delete_subscription(
         raise SubscriptionNotFound
 
 
-def notify_subscriptions(subscription_id: str, image: str, build_id: str):
-    """Notifies subscriptions.
+def get_head_commits(build: dict) -> List[dict]:
+    """Get head commits a build was requested for.
 
-    Function sends request on callback URL set by user on registering
-    build after build completion (called at
-    `pubgrade.modules.endpoints.builds`) if subscription type is equal
-    to build type.
+    Args:
+        build (dict): Build with its `head_commit`.
+
+    Returns:
+        Head commit of the build and of builds requested again for the same
+        commit (e.g. tag and branch push), which are attached to the first
+        build as head commit aliases.
+    """
+    return [build["head_commit"]] + build.get("head_commit_aliases", [])
+
+
+def find_matching_subscriptions(repository_id: str, build: dict) -> List[dict]:
+    """Find subscriptions of a repository matching a build.
+
+    A subscription matches if its `type` (e.g. `branch`) and `value` equal
+    one of the build's head commits. Subscriptions are found with a single
+    query on the `(repository_id, type, value)` index.
 
     Args:
-        subscription_id (str): Identifier for subscription.
+        repository_id (str): Identifier of repository the build belongs to.
+        build (dict): Build with its `head_commit` and `head_commit_aliases`.
+
+    Returns:
+        Matching subscriptions.
+    """
+    db_collection_subscriptions = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["subscriptions"]
+        .client
+    )
+    clauses = [
+        {"repository_id": repository_id, "type": key, "value": value}
+        for head_commit in get_head_commits(build)
+        for key, value in head_commit.items()
+    ]
+    if not clauses:
+        return []
+    return list(db_collection_subscriptions.find({"$or": clauses}))
+
+
+def add_subscription_updates(
+    build_id: str, image: str, subscriptions: List[dict]
+):
+    """Append built image to the update logs of matching subscriptions.
+
+    Updates of a subscription are numbered consecutively by a counter on
+    the subscription, so that readers can tell whether an update being
+    written is still missing, see `get_subscription_updates`. Images
+    already in the update log of a subscription are not appended again.
+
+    Args:
+        build_id (str): Build identifier.
         image (str): Docker image to be updated at deployment.
-        build_id (str): Build Identifier for build to be used for subscription.
+        subscriptions (list): Subscriptions matching the build.
+    """
+    db_collection_subscriptions = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["subscriptions"]
+        .client
+    )
+    db_collection_updates = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["subscription_updates"]
+        .client
+    )
+    for subscription in subscriptions:
+        if db_collection_updates.find_one(
+            {
+                "subscription_id": subscription["id"],
+                "build_id": build_id,
+                "image": image,
+            }
+        ):
+            continue
+        counter = db_collection_subscriptions.find_one_and_update(
+            {"id": subscription["id"]},
+            {"$inc": {"update_seq": 1}},
+            projection={"update_seq": True},
+            return_document=ReturnDocument.AFTER,
+        )
+        if counter is None:
+            # Subscription was deleted meanwhile.
+            continue
+        db_collection_updates.insert_one(
+            {
+                "subscription_id": subscription["id"],
+                "seq": counter["update_seq"],
+                "build_id": build_id,
+                "image": image,
+                "created_at": datetime.datetime.utcnow(),
+            }
+        )
+
+
+def read_subscription_updates(subscription_id: str, since: int) -> List[dict]:
+    """Read updates of a subscription following a cursor.
+
+    Only consecutive updates are read, so that an update still being
+    written is not skipped; updates missing for longer than `gap_timeout`
+    seconds, e.g. because the writer stopped, are skipped.
+
+    Args:
+        subscription_id (str): Identifier for subscription.
+        since (int): Number of the last update read.
+
+    Returns:
+        Updates, oldest first.
+    """
+    db_collection_updates = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["subscription_updates"]
+        .client
+    )
+    updates_config = current_app.config["FOCA"].endpoints["subscriptions"][
+        "updates"
+    ]
+    gap_deadline = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=updates_config["gap_timeout"]
+    )
+    updates = []
+    expected = since + 1
+    for update in (
+        db_collection_updates.find(
+            {"subscription_id": subscription_id, "seq": {"$gt": since}},
+            {"_id": False},
+        )
+        .sort("seq", 1)
+        .limit(updates_config["limit"])
+    ):
+        if update["seq"] != expected and update["created_at"] > gap_deadline:
+            break
+        expected = update["seq"] + 1
+        update["created_at"] = update["created_at"].isoformat()
+        updates.append(update)
+    return updates
+
+
+def get_subscription_updates(
+    uid: str,
+    user_access_token: str,
+    subscription_id: str,
+    since: int = 0,
+    wait: float = 0,
+) -> dict:
+    """Get images built for a subscription since a cursor.
+
+    Lets deployments without a `callback_url` poll for updates. If there are
+    no updates yet, the request is held for up to `wait` seconds (at most
+    `max_wait`) until there are.
+
+    Args:
+        uid (str): Unique identifier for user.
+        user_access_token (str): Secret to verify user.
+        subscription_id (str): Identifier for subscriptions.
+        since (int): Cursor returned by the previous request; all updates
+        are returned if not specified.
+        wait (float): Seconds to wait for updates.
+
+    Returns:
+        `updates`, oldest first, and the `cursor` to get the following
+        updates with.
 
     Raises:
-        RequestException: Raised when something unexpected happen while
-        requesting side-car service for deploying updates.
         SubscriptionNotFound: Raised when no subscription is available for
         the user.
-        BuildNotFound: Raised when object with given build identifier was not
-        found.
+        Unauthorized: Raised when access_token is invalid or not specified
+        in request.
+        UserNotFound: Raised when there is no user with specified uid.
+    """
+    get_subscription_info(uid, user_access_token, subscription_id)
+    updates_config = current_app.config["FOCA"].endpoints["subscriptions"][
+        "updates"
+    ]
+    deadline = time.monotonic() + min(wait, updates_config["max_wait"])
+    while True:
+        updates = read_subscription_updates(subscription_id, since)
+        remaining = deadline - time.monotonic()
+        if updates or remaining <= 0:
+            break
+        time.sleep(min(updates_config["poll_interval"], remaining))
+    return {
+        "updates": updates,
+        "cursor": updates[-1]["seq"] if updates else since,
+    }
+
+
+def send_notification(
+    subscription: dict, image: str, build_id: str, deactivate: bool = True
+):
+    """Send image to be deployed to the callback URL of a subscription.
+
+    The subscription becomes `Active` and refers to the build.
+
+    Args:
+        subscription (dict): Subscription matching the build.
+        image (str): Docker image to be updated at deployment.
+        build_id (str): Build Identifier for build to be used for subscription.
+        deactivate (bool): Whether the subscription becomes `Inactive` if the
+        callback could not be sent.
+
+    Raises:
+        RequestNotSent: Raised when the side-car service for deploying
+        updates could not be reached or answered with an error.
     """
     db_collection_subscriptions = (
         current_app.config["FOCA"]
@@ -274,80 +470,118 @@ def notify_subscriptions(subscription_id: str, image: str, build_id: str):
         .collections["subscriptions"]
         .client
     )
-    db_collection_builds = (
+    db_collection_subscriptions.update_one(
+        {"id": subscription["id"]},
+        {
+            "$set": {
+                "state": "Active",
+                "build_id": build_id,
+                "updated_at": str(datetime.datetime.now().isoformat()),
+            }
+        },
+    )
+    # Build payload and send request to the callback URL of the side-car
+    # service (at deployment).
+    payload = json.dumps(
+        {
+            "image_name": image.split(":")[0],
+            "tag": image.split(":")[1],
+        }
+    )
+    headers = {
+        "X-Access-Token": subscription["access_token"],
+        "Content-Type": "application/json",
+    }
+    try:
+        response = get_http_client().request(
+            "PUT", subscription["callback_url"], headers=headers, data=payload
+        )
+        # Callbacks answered with an error count as not sent.
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        if deactivate:
+            db_collection_subscriptions.update_one(
+                {"id": subscription["id"]},
+                {
+                    "$set": {
+                        "state": "Inactive",
+                        "updated_at": str(
+                            datetime.datetime.now().isoformat()
+                        ),
+                    }
+                },
+            )
+        raise RequestNotSent from e
+
+
+def is_host_failure(error: Optional[BaseException]) -> bool:
+    """Check whether a callback failed because of its host.
+
+    Args:
+        error (Exception): Why the callback could not be sent.
+
+    Returns:
+        `False` if the host answered with a client error other than `429`,
+        i.e. it is up but rejected the callback.
+    """
+    if (
+        isinstance(error, requests.exceptions.HTTPError)
+        and error.response is not None
+    ):
+        status_code = error.response.status_code
+        return not (400 <= status_code < 500 and status_code != 429)
+    return True
+
+
+def deliver_notification(delivery: dict):
+    """Deliver notification from the outbox, see `pubgrade.modules.outbox`.
+
+    The subscription is only marked `Inactive` once the notification is
+    given up on. Notifications to callback hosts whose circuit breaker is
+    open or which exceeded their rate limit are postponed, see
+    `pubgrade.modules.callback_hosts`.
+
+    Args:
+        delivery (dict): Claimed notification with the `subscription_id`,
+        `image` and `build_id`.
+
+    Raises:
+        RequestNotSent: Raised when the side-car service for deploying
+        updates could not be reached or answered with an error.
+        DeliveryDeferred: Raised when the callback may not be sent to its
+        host yet.
+    """
+    db_collection_subscriptions = (
         current_app.config["FOCA"]
         .db.dbs["pubgradeStore"]
-        .collections["builds"]
+        .collections["subscriptions"]
         .client
     )
-    build_object = db_collection_builds.find_one({"id": build_id})
-    if build_object is None:
-        raise BuildNotFound
+    subscription = db_collection_subscriptions.find_one(
+        {"id": delivery["subscription_id"]}
+    )
+    if subscription is None:
+        logger.info(
+            f"Subscription {delivery['subscription_id']} was deleted; "
+            f"dropping notification about build {delivery['build_id']}."
+        )
+        return
+    host = urlparse(subscription["callback_url"]).netloc
+    callback_hosts = get_callback_hosts()
+    delay = callback_hosts.acquire(host)
+    if delay is not None:
+        raise DeliveryDeferred(delay)
     try:
-        subscription_object = db_collection_subscriptions.find_one(
-            {"id": subscription_id}
+        send_notification(
+            subscription,
+            delivery["image"],
+            delivery["build_id"],
+            deactivate=False,
         )
-        subscription_type = subscription_object["type"]
-        value = subscription_object["value"]
-        if subscription_type in build_object["head_commit"]:
-            # Check if subscription type is equal to build type.
-            if build_object["head_commit"][subscription_type] == value:
-                # Update subscription object
-                subscription_object["state"] = "Active"
-                subscription_object["build_id"] = build_id
-                subscription_object["updated_at"] = str(
-                    datetime.datetime.now().isoformat()
-                )
-                del subscription_object["_id"]
-                db_collection_subscriptions.update_one(
-                    {"id": subscription_id}, {"$set": subscription_object}
-                )
-                # Retrieve callback URL for the side-car service (at
-                # deployment) from subscription collection, build payload
-                # and send request.
-                url = subscription_object["callback_url"]
-                payload = json.dumps(
-                    {
-                        "image_name": image.split(":")[0],
-                        "tag": image.split(":")[1],
-                    }
-                )
-                headers = {
-                    "X-Access-Token": subscription_object["access_token"],
-                    "Content-Type": "application/json",
-                }
-                try:
-                    requests.request("PUT", url, headers=headers, data=payload)
-                except requests.exceptions.Timeout:
-                    subscription_object["state"] = "Inactive"
-                    subscription_object["updated_at"] = str(
-                        datetime.datetime.now().isoformat()
-                    )
-                    db_collection_subscriptions.update_one(
-                        {"id": subscription_id}, {"$set": subscription_object}
-                    )
-                    raise RequestNotSent
-                except requests.exceptions.TooManyRedirects:
-                    subscription_object["state"] = "Inactive"
-                    subscription_object["updated_at"] = str(
-                        datetime.datetime.now().isoformat()
-                    )
-                    db_collection_subscriptions.update_one(
-                        {"id": subscription_id}, {"$set": subscription_object}
-                    )
-                    raise RequestNotSent
-                except requests.exceptions.RequestException:
-                    subscription_object["state"] = "Inactive"
-                    subscription_object["updated_at"] = str(
-                        datetime.datetime.now().isoformat()
-                    )
-                    db_collection_subscriptions.update_one(
-                        {"id": subscription_id}, {"$set": subscription_object}
-                    )
-                    raise RequestNotSent
-            else:
-                print("Value not matched")
-        else:
-            print("Type not matched")
-    except TypeError:
-        raise SubscriptionNotFound
+    except RequestNotSent as e:
+        callback_hosts.record(host, success=not is_host_failure(e.__cause__))
+        raise
+    except Exception:
+        callback_hosts.release(host)
+        raise
+    callback_hosts.record(host, success=True)
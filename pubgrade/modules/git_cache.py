@@ -0,0 +1,276 @@
+"""Shared cache of bare git mirrors.
+
+Instead of cloning the whole repository for every build, a bare mirror per
+repository is kept in the cache directory and updated with incremental
+`git fetch`. Each build then checks out a lightweight worktree from the
+mirror. Mirrors are locked per repository (within and across processes) while
+being fetched, and the least recently used mirrors are evicted once the cache
+grows beyond its size cap.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+from git import GitCommandError, Repo
+
+logger = logging.getLogger(__name__)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def normalize_repository_url(repo_url: str) -> str:
+    """Normalize git repository URL to be used as cache key.
+
+    Scheme, credentials, trailing slashes and `.git` suffix are dropped and
+    the host is lowercased, so that e.g.
+    `https://user@GitHub.com/org/repo.git` and `git@github.com:org/repo` map
+    to the same mirror.
+
+    Args:
+        repo_url (str): URL of git repository.
+
+    Returns:
+        Normalized repository URL.
+    """
+    repo_url = repo_url.strip()
+    if "://" not in repo_url and ":" in repo_url.split("/")[0]:
+        # scp-like syntax, e.g. `git@github.com:org/repo.git`
+        host, path = repo_url.split(":", 1)
+        repo_url = "ssh://%s/%s" % (host, path)
+    parts = urlsplit(repo_url)
+    netloc = (parts.hostname or "").lower()
+    if parts.port:
+        netloc = "%s:%s" % (netloc, parts.port)
+    path = parts.path.rstrip("/")
+    if path.endswith(".git"):
+        path = path[: -len(".git")]
+    return netloc + path
+
+
+class MirrorCache:
+    """Cache of bare git mirrors with per-build worktrees.
+
+    Args:
+        cache_dir (str): Directory holding the mirrors.
+        max_size_mb (int): Size cap of the cache in megabytes.
+    """
+
+    def __init__(self, cache_dir: str, max_size_mb: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def mirror_path(self, repo_url: str) -> str:
+        """Get location of the mirror for a repository.
+
+        Args:
+            repo_url (str): URL of git repository.
+
+        Returns:
+            Path of the bare mirror.
+        """
+        key = hashlib.sha256(
+            normalize_repository_url(repo_url).encode("utf-8")
+        ).hexdigest()[:32]
+        return os.path.join(self.cache_dir, "%s.git" % key)
+
+    @contextmanager
+    def _lock(self, mirror_path: str, blocking: bool = True):
+        """Lock mirror against concurrent use.
+
+        A thread lock guards against other build workers of this process, an
+        exclusive `flock` on `<mirror>.lock` against other processes sharing
+        the cache directory.
+
+        Yields:
+            `True` if the lock was acquired, `False` if `blocking` is `False`
+            and the mirror is in use.
+        """
+        with self._locks_lock:
+            thread_lock = self._locks.setdefault(mirror_path, threading.Lock())
+        if not thread_lock.acquire(blocking):
+            yield False
+            return
+        try:
+            with open("%s.lock" % mirror_path, "w") as lock_file:
+                flags = fcntl.LOCK_EX
+                if not blocking:
+                    flags |= fcntl.LOCK_NB
+                try:
+                    fcntl.flock(lock_file, flags)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            thread_lock.release()
+
+    def _update(self, repo_url: str, mirror_path: str, ref: str = ""):
+        """Create or fetch mirror; caller must hold the mirror lock."""
+        if os.path.isdir(mirror_path):
+            repo = Repo(mirror_path)
+            if ref and _has_commit(repo, ref):
+                # Requested commit is already in the mirror.
+                return repo
+            logger.debug(f"Fetching mirror {mirror_path} of {repo_url}.")
+            repo.git.fetch("--prune", "origin")
+            return repo
+        logger.info(f"Creating mirror {mirror_path} of {repo_url}.")
+        tmp_path = "%s.tmp" % mirror_path
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        Repo.clone_from(repo_url, tmp_path, mirror=True)
+        os.rename(tmp_path, mirror_path)
+        return Repo(mirror_path)
+
+    def update(self, repo_url: str) -> str:
+        """Create mirror or fetch latest changes into it.
+
+        Args:
+            repo_url (str): URL of git repository.
+
+        Returns:
+            Path of the bare mirror.
+
+        Raises:
+            GitCommandError: Raised when cloning or fetching failed.
+        """
+        mirror_path = self.mirror_path(repo_url)
+        with self._lock(mirror_path):
+            self._update(repo_url, mirror_path)
+            os.utime(mirror_path)
+        self.evict()
+        return mirror_path
+
+    def checkout_worktree(
+        self,
+        repo_url: str,
+        clone_path: str,
+        ref: str,
+        sparse_paths: Optional[List[str]] = None,
+    ):
+        """Check out worktree of repository at given reference.
+
+        Args:
+            repo_url (str): URL of git repository.
+            clone_path (str): Location of the worktree to create.
+            ref (str): Branch, tag or commit to check out.
+            sparse_paths (list): Directories to check out, check out all
+            files if not specified.
+
+        Returns:
+            clone_path (str): Location of the created worktree.
+
+        Raises:
+            GitCommandError: Raised when fetching or checking out failed.
+        """
+        mirror_path = self.mirror_path(repo_url)
+        with self._lock(mirror_path):
+            repo = self._update(repo_url, mirror_path, ref)
+            repo.git.worktree("prune")
+            if sparse_paths:
+                repo.git.worktree(
+                    "add", "--no-checkout", "--detach", clone_path, ref
+                )
+                worktree = Repo(clone_path)
+                set_sparse_checkout(worktree, sparse_paths)
+                worktree.git.read_tree("-mu", "HEAD")
+            else:
+                repo.git.worktree("add", "--detach", clone_path, ref)
+            os.utime(mirror_path)
+        self.evict()
+        return clone_path
+
+    def evict(self):
+        """Remove least recently used mirrors until cache fits its size cap.
+
+        Mirrors that are locked or still have worktrees checked out for
+        running builds are skipped.
+        """
+        mirrors = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".git") and os.path.isdir(path):
+                mirrors.append((os.path.getmtime(path), _dir_size(path), path))
+        total = sum(size for _, size, _ in mirrors)
+        for _, size, path in sorted(mirrors):
+            if total <= self.max_size:
+                break
+            with self._lock(path, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                try:
+                    Repo(path).git.worktree("prune")
+                except GitCommandError:
+                    pass
+                worktrees = os.path.join(path, "worktrees")
+                if os.path.isdir(worktrees) and os.listdir(worktrees):
+                    continue
+                logger.info(f"Evicting mirror {path} ({size} bytes).")
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def get_mirror_cache(cache_dir: str, max_size_mb: int) -> MirrorCache:
+    """Get process-wide mirror cache for a cache directory.
+
+    Args:
+        cache_dir (str): Directory holding the mirrors.
+        max_size_mb (int): Size cap of the cache in megabytes.
+
+    Returns:
+        Mirror cache shared by all build workers of the process.
+    """
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = MirrorCache(cache_dir, max_size_mb)
+        return _caches[cache_dir]
+
+
+def set_sparse_checkout(repo: Repo, paths: List[str]):
+    """Restrict working tree of repository to given directories.
+
+    Uses cone mode, so files in the repository root are always checked out
+    in addition to the given directories. Applies to subsequent checkouts.
+
+    Args:
+        repo (Repo): Git repository or worktree.
+        paths (list): Directories relative to the repository root.
+    """
+    repo.git.sparse_checkout("init", "--cone")
+    repo.git.sparse_checkout("set", *paths)
+
+
+def _has_commit(repo: Repo, ref: str) -> bool:
+    """Check whether `ref` is a full commit sha present in the repository."""
+    if len(ref) != 40:
+        return False
+    try:
+        repo.git.cat_file("-e", "%s^{commit}" % ref)
+        return True
+    except GitCommandError:
+        return False
+
+
+def _dir_size(path: str) -> int:
+    """Get size of directory tree in bytes."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
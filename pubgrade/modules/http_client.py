@@ -0,0 +1,312 @@
+"""Shared client for outgoing HTTP requests.
+
+Signing dispatches to GitHub and subscription callbacks are sent through one
+`HttpClient`, which keeps a pool of keep-alive connections per host and
+applies connect and read timeouts to every request. Requests that failed
+without being processed, or that are safe to repeat, are retried with
+exponential backoff; `Retry-After` and GitHub's rate limit headers are
+honoured. Latency and errors are recorded per destination host.
+"""
+
+import datetime
+import email.utils
+import http.cookiejar
+import logging
+import random
+import threading
+import time
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+class HttpClient:
+    """Thread-safe client with connection pooling, timeouts and retries.
+
+    Args:
+        pool_connections (int): Number of hosts for which connections are
+        kept open.
+        pool_maxsize (int): Maximum number of connections kept open per host.
+        connect_timeout (float): Seconds to wait for connecting to a host.
+        read_timeout (float): Seconds to wait for a host to respond.
+        max_retries (int): Number of times a failed request is retried.
+        backoff_base (float): Upper bound of the seconds to wait before the
+        first retry, doubled for every further retry.
+        backoff_max (float): Maximum number of seconds to wait before a
+        retry.
+        max_retry_after (float): Maximum number of seconds to wait for a
+        rate limit to reset; responses asking to wait longer are returned.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+        max_retry_after: float = 120,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.session = requests.Session()
+        # Callbacks of different subscribers must not share cookies.
+        self.session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        """Connect and read timeout of requests."""
+        return self.connect_timeout, self.read_timeout
+
+    @property
+    def max_duration(self) -> float:
+        """Upper bound of the seconds a request takes, including retries."""
+        return (self.max_retries + 1) * (
+            self.connect_timeout + self.read_timeout
+        ) + self.max_retries * max(self.backoff_max, self.max_retry_after)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        idempotent: Optional[bool] = None,
+        **kwargs,
+    ) -> requests.Response:
+        """Send request, retrying it if it failed.
+
+        Rate limited requests (`429`, or `403` with rate limit headers) and
+        requests which could not connect are retried for all methods, as
+        they were not processed. Other connection errors, timeouts and
+        `5xx` responses are only retried for idempotent requests.
+
+        Args:
+            method (str): HTTP method.
+            url (str): URL to send the request to.
+            idempotent (bool): Whether the request is safe to repeat;
+            derived from `method` if not specified.
+            **kwargs: Passed to `requests.Session.request`.
+
+        Returns:
+            Response of the last attempt.
+
+        Raises:
+            RequestException: Raised when the last attempt failed without
+            response.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            started_at = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self._record(host, time.monotonic() - started_at, error=e)
+                retry = isinstance(e, requests.exceptions.ConnectTimeout) or (
+                    idempotent
+                    and isinstance(
+                        e,
+                        (
+                            requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout,
+                        ),
+                    )
+                )
+                if not retry or attempt >= self.max_retries:
+                    raise
+                delay = self.get_backoff(attempt)
+                logger.warning(
+                    f"{method} {host} failed: {e}; retrying in {delay:.1f}s."
+                )
+            else:
+                self._record(
+                    host,
+                    time.monotonic() - started_at,
+                    status_code=response.status_code,
+                )
+                delay = self.get_retry_delay(response, attempt, idempotent)
+                if delay is None or attempt >= self.max_retries:
+                    return response
+                logger.warning(
+                    f"{method} {host} returned {response.status_code}; "
+                    f"retrying in {delay:.1f}s."
+                )
+                response.close()
+            with self._lock:
+                self._stats[host]["retries"] += 1
+            time.sleep(delay)
+            attempt += 1
+
+    def get_backoff(self, attempt: int) -> float:
+        """Get seconds to wait before a retry, with full jitter.
+
+        Args:
+            attempt (int): Number of retries so far.
+
+        Returns:
+            Random delay up to an exponentially growing bound.
+        """
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        )
+
+    def get_retry_delay(
+        self, response: requests.Response, attempt: int, idempotent: bool
+    ) -> Optional[float]:
+        """Get seconds to wait before retrying a request.
+
+        Args:
+            response (Response): Response to the request.
+            attempt (int): Number of retries so far.
+            idempotent (bool): Whether the request is safe to repeat.
+
+        Returns:
+            Delay, or `None` if the request is not to be retried.
+        """
+        rate_limit_delay = get_rate_limit_delay(response)
+        if rate_limit_delay is not None:
+            if rate_limit_delay > self.max_retry_after:
+                return None
+            return rate_limit_delay
+        # Rate limited requests were not processed and are safe to repeat.
+        if response.status_code == 429 or (
+            idempotent and response.status_code in RETRY_STATUS_CODES
+        ):
+            return self.get_backoff(attempt)
+        return None
+
+    def _record(
+        self,
+        host: str,
+        seconds: float,
+        status_code: Optional[int] = None,
+        error: Optional[Exception] = None,
+    ):
+        with self._lock:
+            stats = self._stats.setdefault(
+                host,
+                {
+                    "requests": 0,
+                    "errors": 0,
+                    "retries": 0,
+                    "total_seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "last_status_code": None,
+                    "last_error": None,
+                },
+            )
+            stats["requests"] += 1
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["last_status_code"] = status_code
+            if error is not None or status_code >= 500 or status_code == 429:
+                stats["errors"] += 1
+                stats["last_error"] = (
+                    repr(error) if error is not None else str(status_code)
+                )
+
+    def get_stats(self) -> dict:
+        """Get latency and error statistics per destination host.
+
+        Returns:
+            Number of requests, errors and retries, average and maximum
+            latency in seconds, and the last status code and error, by host.
+        """
+        with self._lock:
+            return {
+                host: {
+                    "requests": stats["requests"],
+                    "errors": stats["errors"],
+                    "retries": stats["retries"],
+                    "average_seconds": stats["total_seconds"]
+                    / stats["requests"],
+                    "max_seconds": stats["max_seconds"],
+                    "last_status_code": stats["last_status_code"],
+                    "last_error": stats["last_error"],
+                }
+                for host, stats in self._stats.items()
+            }
+
+
+def get_rate_limit_delay(response: requests.Response) -> Optional[float]:
+    """Get seconds until a rate limited request may be sent again.
+
+    Understands `Retry-After` (seconds or HTTP date) on `429`, `403` and
+    `503` responses, and GitHub's `X-RateLimit-Remaining` and
+    `X-RateLimit-Reset` headers.
+
+    Args:
+        response (Response): Response to the request.
+
+    Returns:
+        Delay, or `None` if the request was not rate limited.
+    """
+    if response.status_code not in (403, 429, 503):
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return max((retry_at - now).total_seconds(), 0)
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        reset = response.headers.get("X-RateLimit-Reset")
+        try:
+            return max(float(reset) - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def get_http_client(settings: Optional[dict] = None) -> HttpClient:
+    """Get process-wide HTTP client.
+
+    Args:
+        settings (dict): Settings of the client, see `HttpClient`, read from
+        the `http` endpoint configuration if not specified. Only used when
+        the client is created.
+
+    Returns:
+        HTTP client shared by all threads.
+    """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            if settings is None:
+                settings = current_app.config["FOCA"].endpoints["http"]
+            _http_client = HttpClient(**settings)
+        return _http_client
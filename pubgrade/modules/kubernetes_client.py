@@ -0,0 +1,143 @@
+"""Process-wide Kubernetes API client.
+
+Cluster configuration is loaded once and a single `ApiClient`, and with it
+one pool of connections to the API server, is shared by all threads. The
+service account token of in-cluster configuration is re-read by the client
+whenever it is rotated; in addition, configuration is reloaded periodically
+so that short-lived credentials from kubeconfig files are renewed as well.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from flask import current_app
+from kubernetes import client, config
+
+logger = logging.getLogger(__name__)
+
+_kubernetes_client = None
+_kubernetes_client_lock = threading.Lock()
+
+
+class KubernetesClient:
+    """Lazily initialized, thread-safe holder of a Kubernetes `ApiClient`.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open to the API
+        server.
+        connect_timeout (float): Seconds to wait for connecting to the API
+        server.
+        read_timeout (float): Seconds to wait for the API server to respond.
+        config_refresh_interval (int): Seconds after which configuration is
+        reloaded.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 4,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        config_refresh_interval: int = 3600,
+    ):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.config_refresh_interval = config_refresh_interval
+        self._api_client = None
+        self._loaded_at = 0.0
+        self._reload = False
+        self._lock = threading.Lock()
+
+    @property
+    def request_timeout(self) -> Tuple[float, float]:
+        """Connect and read timeout, to be passed as `_request_timeout`."""
+        return self.connect_timeout, self.read_timeout
+
+    def _load_configuration(self) -> client.Configuration:
+        configuration = client.Configuration()
+        if os.getenv("KUBERNETES_SERVICE_HOST"):
+            config.load_incluster_config(client_configuration=configuration)
+        else:
+            config.load_kube_config(client_configuration=configuration)
+        configuration.connection_pool_maxsize = self.pool_size
+        return configuration
+
+    def get_api_client(self) -> client.ApiClient:
+        """Get shared API client, loading configuration if necessary.
+
+        The client replaced when configuration is reloaded is closed; its
+        connections are closed once requests still using them finish.
+
+        Returns:
+            API client.
+        """
+        old_api_client = None
+        with self._lock:
+            expired = (
+                time.monotonic() - self._loaded_at
+                > self.config_refresh_interval
+            )
+            if self._api_client is None or self._reload or expired:
+                old_api_client = self._api_client
+                self._api_client = client.ApiClient(
+                    self._load_configuration()
+                )
+                self._loaded_at = time.monotonic()
+                self._reload = False
+                logger.debug("Loaded Kubernetes configuration.")
+            api_client = self._api_client
+        if old_api_client is not None:
+            old_api_client.close()
+            old_api_client.rest_client.pool_manager.clear()
+        return api_client
+
+    def core_v1(self) -> client.CoreV1Api:
+        """Get `CoreV1Api` using the shared API client.
+
+        Returns:
+            CoreV1Api instance.
+        """
+        return client.CoreV1Api(self.get_api_client())
+
+    def reset(self):
+        """Reload configuration on next use."""
+        with self._lock:
+            self._reload = True
+
+    def reset_if_unauthorized(self, error: Exception):
+        """Reload configuration on next use if credentials were rejected.
+
+        Args:
+            error (Exception): Error raised by an API call.
+        """
+        if getattr(error, "status", None) == 401:
+            logger.warning("Kubernetes API rejected credentials.")
+            self.reset()
+
+
+def get_kubernetes_client(
+    settings: Optional[dict] = None,
+) -> KubernetesClient:
+    """Get process-wide Kubernetes client.
+
+    Args:
+        settings (dict): Settings of the client (`pool_size`,
+        `connect_timeout`, `read_timeout`, `config_refresh_interval`), read
+        from the `kubernetes` section of the builds configuration if not
+        specified. Only used when the client is created.
+
+    Returns:
+        Kubernetes client shared by all threads.
+    """
+    global _kubernetes_client
+    with _kubernetes_client_lock:
+        if _kubernetes_client is None:
+            if settings is None:
+                settings = current_app.config["FOCA"].endpoints["builds"][
+                    "kubernetes"
+                ]
+            _kubernetes_client = KubernetesClient(**settings)
+        return _kubernetes_client
@@ -0,0 +1,999 @@
+"""Outbox of notifications about built images.
+
+When an image was built, a notification for each matching subscription is
+written to the `notification_outbox` collection right after the image is
+marked as built. A pool of delivery workers sends them to the callback URLs
+of the subscriptions, independently of builds and of each other. Failed
+deliveries are retried with exponential backoff; deliveries failing
+`max_attempts` times are moved to the `notification_dead_letters`
+collection, from where admins can replay them. Notifications are delivered
+at least once. The state of each notification is recorded in
+`notifications` of the image on the build document.
+
+Delivery workers run in the API process or in any number of standalone
+`pubgrade-notifier` processes, see `pubgrade.notifier`. A worker leases the
+notification it sends: the notification is invisible to other workers
+until its lease expires after `visibility_timeout` seconds. Leases of
+notifications still being sent are renewed; expired leases of workers
+which stopped are taken over by other workers.
+
+Notifications of a subscription about the same image repository are
+coalesced: a notification is sent `debounce` seconds (per subscription, or
+from the `notifications` configuration) after the first notification
+pending for the subscription and image, and a newer build's notification
+supersedes pending ones of older builds. Builds are ordered by when they
+started, so that a notification about an older build is never sent after
+one about a newer build.
+
+To keep subscribers from pulling a rebuilt image all at once, notifications
+about an image are sent in waves according to the repository's delivery
+policy (see `get_waves`), each wave `wave_delay` seconds plus up to
+`jitter` random seconds after the previous one. With `gate_on_acks`, a wave
+is only sent once every notification of the previous wave was acknowledged
+by its callback; if any of them failed, the rest of the rollout is halted
+and moved to the dead letters.
+"""
+
+import datetime
+import logging
+import math
+import random
+import socket
+import threading
+from typing import Callable, Dict, List, Optional
+
+from flask import Flask, current_app
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from pubgrade.modules.build_tasks import TaskWorkerPool
+from pubgrade.modules.registry import without_tag
+
+logger = logging.getLogger(__name__)
+
+PENDING = "PENDING"
+SENDING = "SENDING"
+SENT = "SENT"
+FAILED = "FAILED"
+SUPERSEDED = "SUPERSEDED"
+WAITING = "WAITING"
+
+
+class DeliveryDeferred(Exception):
+    """Notification is to be sent later, without counting the attempt.
+
+    Raised by `deliver`, e.g. because the callback host is unavailable.
+
+    Args:
+        delay (float): Seconds to wait before the notification is sent.
+    """
+
+    def __init__(self, delay: float):
+        super().__init__(delay)
+        self.delay = delay
+
+
+def get_delivery_id(
+    build_id: str, image_index: int, subscription_id: str
+) -> str:
+    """Get identifier of the notification of a subscription about an image.
+
+    Identifiers are derived from the notification, so that writing the same
+    notification again does not deliver it twice.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        subscription_id (str): Identifier of the subscription.
+
+    Returns:
+        Identifier of the notification.
+    """
+    return f"{build_id}.{image_index}.{subscription_id}"
+
+
+def set_notification_state(
+    delivery: dict,
+    state: str,
+    error: Optional[str] = None,
+):
+    """Record state of a notification on the build document.
+
+    Args:
+        delivery (dict): Notification in the outbox or dead letters.
+        state (str): `WAITING`, `PENDING`, `SENDING`, `SENT`, `FAILED` or
+        `SUPERSEDED`.
+        error (str): Error of the last attempt, if it failed.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    db_collection_builds.update_one(
+        {"id": delivery["build_id"]},
+        {
+            "$set": {
+                f"images.{delivery['image_index']}.notifications."
+                f"{delivery['notification_index']}": {
+                    "subscription_id": delivery["subscription_id"],
+                    "status": state,
+                    "attempts": delivery["attempts"],
+                    "error": error,
+                    "finished_at": str(datetime.datetime.now().isoformat())
+                    if state in (SENT, FAILED, SUPERSEDED)
+                    else None,
+                }
+            }
+        },
+    )
+
+
+def get_coalesce_key(subscription_id: str, image: str) -> str:
+    """Get key of notifications which supersede each other.
+
+    Args:
+        subscription_id (str): Identifier of the subscription.
+        image (str): Docker image to be updated at deployment.
+
+    Returns:
+        Key shared by notifications of the subscription about any tag of the
+        image repository.
+    """
+    return f"{subscription_id} {without_tag(image)}"
+
+
+def is_superseded(delivery: dict) -> bool:
+    """Check whether a newer build's notification is pending or was sent.
+
+    Args:
+        delivery (dict): Notification in the outbox.
+
+    Returns:
+        `True` if the notification is not to be sent anymore.
+    """
+    if delivery.get("coalesce_key") is None:
+        return False
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    db_collection_sequences = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_sequences"]
+        .client
+    )
+    newer = db_collection_outbox.find_one(
+        {
+            "coalesce_key": delivery["coalesce_key"],
+            "state": {"$in": [WAITING, PENDING, SENDING]},
+            "sequence": {"$gt": delivery["sequence"]},
+        }
+    )
+    if newer is not None:
+        return True
+    sent = db_collection_sequences.find_one(
+        {
+            "key": delivery["coalesce_key"],
+            "sequence": {"$gte": delivery["sequence"]},
+        }
+    )
+    return sent is not None
+
+
+def supersede_delivery(
+    delivery: dict, worker_id: Optional[str] = None
+) -> bool:
+    """Remove notification superseded by a newer build's from the outbox.
+
+    Args:
+        delivery (dict): Notification in the outbox.
+        worker_id (str): Identifier of the worker holding the lease, if
+        the notification is leased; pending notifications otherwise.
+
+    Returns:
+        `False` if the notification was leased or removed meanwhile.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    query = {"id": delivery["id"], "state": {"$in": [WAITING, PENDING]}}
+    if worker_id is not None:
+        query.update(state=SENDING, leased_by=worker_id)
+    if db_collection_outbox.delete_one(query).deleted_count == 0:
+        return False
+    set_notification_state(delivery, SUPERSEDED)
+    release_next_wave(delivery)
+    return True
+
+
+def record_sent_sequence(delivery: dict):
+    """Record that a build's notification was sent.
+
+    Args:
+        delivery (dict): Delivered notification.
+    """
+    if delivery.get("coalesce_key") is None:
+        return
+    db_collection_sequences = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_sequences"]
+        .client
+    )
+    try:
+        db_collection_sequences.update_one(
+            {
+                "key": delivery["coalesce_key"],
+                "sequence": {"$lt": delivery["sequence"]},
+            },
+            {
+                "$set": {
+                    "sequence": delivery["sequence"],
+                    "build_id": delivery["build_id"],
+                    "sent_at": datetime.datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # A newer build's notification was sent meanwhile.
+        pass
+
+
+def get_waves(count: int, delivery_policy: dict) -> List[int]:
+    """Assign notifications to the waves of a rollout.
+
+    Args:
+        count (int): Number of notifications.
+        delivery_policy (dict): `canary_percent` of the notifications sent
+        in the first wave, at least one, and `wave_size` of the following
+        waves; notifications are sent in a single wave if neither is set.
+
+    Returns:
+        Wave of each notification.
+    """
+    sizes = []
+    canary_percent = delivery_policy.get("canary_percent")
+    if canary_percent and count > 0:
+        sizes.append(min(count, math.ceil(count * canary_percent / 100)))
+    remaining = count - sum(sizes)
+    wave_size = delivery_policy.get("wave_size") or remaining
+    while remaining > 0:
+        sizes.append(min(wave_size, remaining))
+        remaining -= sizes[-1]
+    return [wave for wave, size in enumerate(sizes) for _ in range(size)]
+
+
+def get_wave_delay(rollout: dict) -> datetime.timedelta:
+    """Get delay of a notification after the previous wave of its rollout.
+
+    Args:
+        rollout (dict): Rollout of the notification.
+
+    Returns:
+        `delay` seconds, plus up to `jitter` random seconds.
+    """
+    return datetime.timedelta(
+        seconds=rollout["delay"] + random.uniform(0, rollout["jitter"])
+    )
+
+
+def add_notifications(
+    build_id: str,
+    image_index: int,
+    image: str,
+    subscriptions: List[dict],
+    sequence: str,
+    delivery_policy: Optional[dict] = None,
+):
+    """Write notifications about a built image to the outbox.
+
+    Pending notifications of older builds for the same subscription and
+    image repository are superseded; the new notification is sent when the
+    first of them would have been.
+
+    Args:
+        build_id (str): Build identifier.
+        image_index (int): Position of the image in the build's images.
+        image (str): Docker image to be updated at deployment.
+        subscriptions (list): Subscriptions to notify, with their `id` and
+        optionally their `debounce` in seconds.
+        sequence (str): Position of the build in the order of builds, e.g.
+        when it started.
+        delivery_policy (dict): Settings of the rollout overriding the
+        `delivery_policy` of the `notifications` configuration.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    notifications_config = current_app.config["FOCA"].endpoints[
+        "notifications"
+    ]
+    # States are recorded by position in the image's `notifications`, which
+    # has to exist as an array for that.
+    db_collection_builds.update_one(
+        {
+            "id": build_id,
+            f"images.{image_index}.notifications": {"$exists": False},
+        },
+        {
+            "$set": {
+                f"images.{image_index}.notifications": [
+                    {
+                        "subscription_id": subscription["id"],
+                        "status": PENDING,
+                        "attempts": 0,
+                        "error": None,
+                        "finished_at": None,
+                    }
+                    for subscription in subscriptions
+                ]
+            }
+        },
+    )
+    delivery_policy = {
+        **notifications_config["delivery_policy"],
+        **(delivery_policy or {}),
+    }
+    now = datetime.datetime.utcnow()
+    deliveries = []
+    for notification_index, subscription in enumerate(subscriptions):
+        debounce = subscription.get(
+            "debounce", notifications_config["debounce"]
+        )
+        delivery = {
+            "id": get_delivery_id(build_id, image_index, subscription["id"]),
+            "build_id": build_id,
+            "image_index": image_index,
+            "notification_index": notification_index,
+            "image": image,
+            "subscription_id": subscription["id"],
+            "coalesce_key": get_coalesce_key(subscription["id"], image),
+            "sequence": sequence,
+            "state": PENDING,
+            "created_at": now,
+            "run_after": now + datetime.timedelta(seconds=debounce),
+            "leased_by": None,
+            "leased_host": None,
+            "lease_expires_at": None,
+            "attempts": 0,
+            "error": None,
+        }
+        if is_superseded(delivery):
+            set_notification_state(delivery, SUPERSEDED)
+            continue
+        deliveries.append(delivery)
+    waves = get_waves(len(deliveries), delivery_policy)
+    for delivery, wave in zip(deliveries, waves):
+        delivery["rollout"] = {
+            "id": f"{build_id}.{image_index}",
+            "wave": wave,
+            "gated": bool(delivery_policy["gate_on_acks"]),
+            "delay": delivery_policy["wave_delay"],
+            "jitter": delivery_policy["jitter"],
+        }
+        if wave > 0 and delivery["rollout"]["gated"]:
+            # Released once the previous wave was acknowledged.
+            delivery["state"] = WAITING
+        elif wave > 0:
+            delivery["run_after"] += wave * datetime.timedelta(
+                seconds=delivery_policy["wave_delay"]
+            )
+        if delivery["rollout"]["jitter"]:
+            delivery["run_after"] += datetime.timedelta(
+                seconds=random.uniform(0, delivery["rollout"]["jitter"])
+            )
+        for older in db_collection_outbox.find(
+            {
+                "coalesce_key": delivery["coalesce_key"],
+                "state": {"$in": [WAITING, PENDING]},
+                "sequence": {"$lt": sequence},
+            }
+        ):
+            if supersede_delivery(older) and wave == 0:
+                delivery["run_after"] = min(
+                    delivery["run_after"], older["run_after"]
+                )
+        db_collection_outbox.update_one(
+            {"id": delivery["id"]}, {"$setOnInsert": delivery}, upsert=True
+        )
+        set_notification_state(delivery, delivery["state"])
+
+
+def release_next_wave(delivery: dict):
+    """Send next wave of a gated rollout once the current wave is finished.
+
+    The rollout is halted if a notification of the current wave failed.
+
+    Args:
+        delivery (dict): Notification of the rollout which was finished.
+    """
+    rollout = delivery.get("rollout")
+    if rollout is None or not rollout["gated"]:
+        return
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    db_collection_dead_letters = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_dead_letters"]
+        .client
+    )
+    # Only a single wave of a rollout is sent at a time.
+    if (
+        db_collection_outbox.find_one(
+            {"rollout.id": rollout["id"], "state": {"$ne": WAITING}}
+        )
+        is not None
+    ):
+        return
+    failed = db_collection_dead_letters.find_one(
+        {"rollout.id": rollout["id"]}
+    )
+    if failed is not None:
+        error = (
+            f"Rollout halted: notification '{failed['id']}' of wave "
+            f"{failed['rollout']['wave']} failed."
+        )
+        for waiting in db_collection_outbox.find(
+            {"rollout.id": rollout["id"], "state": WAITING}
+        ):
+            dead_letter = {
+                key: value
+                for key, value in waiting.items()
+                if key
+                not in (
+                    "_id",
+                    "state",
+                    "leased_by",
+                    "leased_host",
+                    "lease_expires_at",
+                )
+            }
+            dead_letter.update(
+                error=error, dead_lettered_at=datetime.datetime.utcnow()
+            )
+            db_collection_dead_letters.replace_one(
+                {"id": waiting["id"]}, dead_letter, upsert=True
+            )
+            if (
+                db_collection_outbox.delete_one(
+                    {"id": waiting["id"], "state": WAITING}
+                ).deleted_count
+                > 0
+            ):
+                set_notification_state(waiting, FAILED, error)
+        return
+    next_wave = db_collection_outbox.find_one(
+        {"rollout.id": rollout["id"], "state": WAITING},
+        sort=[("rollout.wave", 1)],
+    )
+    if next_wave is None:
+        return
+    now = datetime.datetime.utcnow()
+    for waiting in db_collection_outbox.find(
+        {
+            "rollout.id": rollout["id"],
+            "rollout.wave": next_wave["rollout"]["wave"],
+            "state": WAITING,
+        }
+    ):
+        result = db_collection_outbox.update_one(
+            {"id": waiting["id"], "state": WAITING},
+            {
+                "$set": {
+                    "state": PENDING,
+                    "run_after": now + get_wave_delay(waiting["rollout"]),
+                }
+            },
+        )
+        if result.matched_count > 0:
+            set_notification_state(waiting, PENDING)
+
+
+def lease_delivery(
+    worker_id: str, visibility_timeout: float
+) -> Optional[dict]:
+    """Atomically lease the notification that is due longest.
+
+    Notifications whose lease expired, because the worker holding it
+    stopped, are leased again.
+
+    Args:
+        worker_id (str): Identifier of the leasing worker.
+        visibility_timeout (float): Seconds for which the notification is
+        leased.
+
+    Returns:
+        delivery (dict): Leased notification or `None` if none is due.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    now = datetime.datetime.utcnow()
+    return db_collection_outbox.find_one_and_update(
+        {
+            "$or": [
+                {"state": PENDING, "run_after": {"$lte": now}},
+                {"state": SENDING, "lease_expires_at": {"$lt": now}},
+            ]
+        },
+        {
+            "$set": {
+                "state": SENDING,
+                "leased_by": worker_id,
+                "leased_host": socket.gethostname(),
+                "lease_expires_at": now
+                + datetime.timedelta(seconds=visibility_timeout),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_after", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def renew_lease(
+    delivery_id: str, worker_id: str, visibility_timeout: float
+) -> bool:
+    """Extend lease of a notification which is still being sent.
+
+    Args:
+        delivery_id (str): Identifier of the leased notification.
+        worker_id (str): Identifier of the worker holding the lease.
+        visibility_timeout (float): Seconds from now for which the
+        notification stays leased.
+
+    Returns:
+        `False` if the lease expired and was taken over by another worker.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    result = db_collection_outbox.update_one(
+        {"id": delivery_id, "state": SENDING, "leased_by": worker_id},
+        {
+            "$set": {
+                "lease_expires_at": datetime.datetime.utcnow()
+                + datetime.timedelta(seconds=visibility_timeout)
+            }
+        },
+    )
+    return result.matched_count == 1
+
+
+def complete_delivery(delivery: dict, worker_id: str) -> bool:
+    """Remove delivered notification from the outbox.
+
+    Args:
+        delivery (dict): Leased notification.
+        worker_id (str): Identifier of the worker holding the lease.
+
+    Returns:
+        `False` if the lease was taken over by another worker, which sends
+        the notification again.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    result = db_collection_outbox.delete_one(
+        {"id": delivery["id"], "state": SENDING, "leased_by": worker_id}
+    )
+    if result.deleted_count == 0:
+        return False
+    record_sent_sequence(delivery)
+    set_notification_state(delivery, SENT)
+    release_next_wave(delivery)
+    return True
+
+
+def retry_delivery(
+    delivery: dict, worker_id: str, error: str, delay: float
+) -> bool:
+    """Release leased notification to be sent again later.
+
+    Args:
+        delivery (dict): Leased notification.
+        worker_id (str): Identifier of the worker holding the lease.
+        error (str): Why the attempt failed.
+        delay (float): Seconds to wait before the notification is sent
+        again.
+
+    Returns:
+        `False` if the lease was taken over by another worker.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    result = db_collection_outbox.update_one(
+        {"id": delivery["id"], "state": SENDING, "leased_by": worker_id},
+        {
+            "$set": {
+                "state": PENDING,
+                "run_after": datetime.datetime.utcnow()
+                + datetime.timedelta(seconds=delay),
+                "leased_by": None,
+                "leased_host": None,
+                "lease_expires_at": None,
+                "error": error,
+            }
+        },
+    )
+    if result.matched_count == 0:
+        return False
+    set_notification_state(delivery, PENDING, error)
+    return True
+
+
+def defer_delivery(delivery: dict, worker_id: str, delay: float) -> bool:
+    """Release leased notification which was not sent.
+
+    The attempt is not counted.
+
+    Args:
+        delivery (dict): Leased notification.
+        worker_id (str): Identifier of the worker holding the lease.
+        delay (float): Seconds to wait before the notification is sent.
+
+    Returns:
+        `False` if the lease was taken over by another worker.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    result = db_collection_outbox.update_one(
+        {"id": delivery["id"], "state": SENDING, "leased_by": worker_id},
+        {
+            "$set": {
+                "state": PENDING,
+                "run_after": datetime.datetime.utcnow()
+                + datetime.timedelta(seconds=delay),
+                "leased_by": None,
+                "leased_host": None,
+                "lease_expires_at": None,
+            },
+            "$inc": {"attempts": -1},
+        },
+    )
+    if result.matched_count == 0:
+        return False
+    set_notification_state(
+        {**delivery, "attempts": delivery["attempts"] - 1},
+        PENDING,
+        delivery.get("error"),
+    )
+    return True
+
+
+def dead_letter_delivery(delivery: dict, worker_id: str, error: str) -> bool:
+    """Move notification which could not be delivered to the dead letters.
+
+    The subscription becomes `Inactive`.
+
+    Args:
+        delivery (dict): Leased notification.
+        worker_id (str): Identifier of the worker holding the lease.
+        error (str): Why the last attempt failed.
+
+    Returns:
+        `False` if the lease was taken over by another worker.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    db_collection_dead_letters = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_dead_letters"]
+        .client
+    )
+    db_collection_subscriptions = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["subscriptions"]
+        .client
+    )
+    dead_letter = {
+        key: value
+        for key, value in delivery.items()
+        if key
+        not in ("_id", "state", "leased_by", "leased_host", "lease_expires_at")
+    }
+    dead_letter.update(
+        error=error, dead_lettered_at=datetime.datetime.utcnow()
+    )
+    # The dead letter is written before the notification is removed from
+    # the outbox, so that it is not lost if the worker stops in between.
+    db_collection_dead_letters.replace_one(
+        {"id": delivery["id"]}, dead_letter, upsert=True
+    )
+    if (
+        db_collection_outbox.delete_one(
+            {"id": delivery["id"], "state": SENDING, "leased_by": worker_id}
+        ).deleted_count
+        == 0
+    ):
+        db_collection_dead_letters.delete_one(
+            {
+                "id": delivery["id"],
+                "dead_lettered_at": dead_letter["dead_lettered_at"],
+            }
+        )
+        return False
+    db_collection_subscriptions.update_one(
+        {"id": delivery["subscription_id"]},
+        {
+            "$set": {
+                "state": "Inactive",
+                "updated_at": str(datetime.datetime.now().isoformat()),
+            }
+        },
+    )
+    set_notification_state(delivery, FAILED, error)
+    release_next_wave(delivery)
+    return True
+
+
+def get_dead_letters() -> List[dict]:
+    """Get notifications which could not be delivered.
+
+    Returns:
+        Dead letters, oldest first.
+    """
+    db_collection_dead_letters = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_dead_letters"]
+        .client
+    )
+    return list(
+        db_collection_dead_letters.find({}, {"_id": False}).sort(
+            "dead_lettered_at", 1
+        )
+    )
+
+
+def replay_dead_letters(ids: Optional[List[str]] = None) -> List[str]:
+    """Move dead letters back into the outbox to be delivered again.
+
+    Their subscriptions become `Active` again.
+
+    Args:
+        ids (list): Identifiers of the dead letters to replay; all dead
+        letters are replayed if not specified.
+
+    Returns:
+        Identifiers of the replayed notifications.
+    """
+    db_collection_outbox = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client
+    )
+    db_collection_dead_letters = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_dead_letters"]
+        .client
+    )
+    db_collection_subscriptions = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["subscriptions"]
+        .client
+    )
+    query = {} if ids is None else {"id": {"$in": ids}}
+    replayed = []
+    for dead_letter in db_collection_dead_letters.find(query):
+        now = datetime.datetime.utcnow()
+        delivery = {
+            key: value
+            for key, value in dead_letter.items()
+            if key not in ("_id", "dead_lettered_at")
+        }
+        delivery.update(
+            state=PENDING,
+            run_after=now,
+            leased_by=None,
+            leased_host=None,
+            lease_expires_at=None,
+            attempts=0,
+            replayed_at=now,
+        )
+        db_collection_outbox.update_one(
+            {"id": delivery["id"]}, {"$setOnInsert": delivery}, upsert=True
+        )
+        db_collection_dead_letters.delete_one({"id": delivery["id"]})
+        db_collection_subscriptions.update_one(
+            {"id": delivery["subscription_id"]},
+            {
+                "$set": {
+                    "state": "Active",
+                    "updated_at": str(datetime.datetime.now().isoformat()),
+                }
+            },
+        )
+        set_notification_state(delivery, PENDING, delivery["error"])
+        replayed.append(delivery["id"])
+    return replayed
+
+
+class DeliveryWorkerPool(TaskWorkerPool):
+    """Pool of background threads delivering notifications from the outbox.
+
+    Leases of notifications being sent are renewed by a separate thread
+    every `renew_interval` seconds.
+
+    Args:
+        app: Flask application, used to push an application context in each
+        worker thread.
+        deliver: Called with the leased notification; raise to have it
+        retried, or raise `DeliveryDeferred` to have it sent later without
+        counting the attempt.
+        workers: Number of worker threads, i.e. notifications sent at a time.
+        poll_interval: Seconds to wait before polling again if no
+        notification is due.
+        visibility_timeout: Seconds for which a notification is leased;
+        notifications whose lease was not renewed are sent again by another
+        worker.
+        renew_interval: Seconds between renewals of leases; defaults to a
+        third of `visibility_timeout`.
+        max_attempts: Number of times a notification is sent before it is
+        moved to the dead letters.
+        backoff_base: Seconds to wait before the first retry; doubled for
+        every further attempt.
+        backoff_max: Maximum number of seconds to wait before a retry.
+    """
+
+    thread_name = "delivery-worker"
+
+    def __init__(
+        self,
+        app: Flask,
+        deliver: Callable[[dict], None],
+        workers: int = 16,
+        poll_interval: float = 1,
+        visibility_timeout: float = 60,
+        renew_interval: Optional[float] = None,
+        max_attempts: int = 8,
+        backoff_base: float = 5,
+        backoff_max: float = 3600,
+    ):
+        super().__init__(
+            app,
+            handlers={},
+            workers=workers,
+            poll_interval=poll_interval,
+            max_attempts=max_attempts,
+            backoff_base=backoff_base,
+            backoff_max=backoff_max,
+        )
+        self.deliver = deliver
+        self.visibility_timeout = visibility_timeout
+        self.renew_interval = renew_interval or visibility_timeout / 3
+        # Worker holding the lease, by identifier of the notification.
+        self._leases: Dict[str, str] = {}
+        self._leases_lock = threading.Lock()
+
+    def start(self):
+        """Start worker threads and the thread renewing their leases."""
+        super().start()
+        thread = threading.Thread(
+            target=self._renew, name="lease-renewer", daemon=True
+        )
+        thread.start()
+        self._threads.append(thread)
+
+    def renew_leases(self):
+        """Renew leases of all notifications being sent."""
+        with self._leases_lock:
+            leases = list(self._leases.items())
+        with self.app.app_context():
+            for delivery_id, worker_id in leases:
+                if not renew_lease(
+                    delivery_id, worker_id, self.visibility_timeout
+                ):
+                    logger.warning(
+                        f"Lease of notification {delivery_id} expired and "
+                        f"was taken over; it may be delivered twice."
+                    )
+
+    def run_once(self, worker_id: str) -> bool:
+        """Lease and deliver a single notification.
+
+        Args:
+            worker_id (str): Identifier of the worker.
+
+        Returns:
+            `True` if a notification was sent, `False` if none was due.
+        """
+        with self.app.app_context():
+            delivery = lease_delivery(worker_id, self.visibility_timeout)
+            if delivery is None:
+                return False
+            with self._leases_lock:
+                self._leases[delivery["id"]] = worker_id
+            try:
+                self._deliver(delivery, worker_id)
+            finally:
+                with self._leases_lock:
+                    self._leases.pop(delivery["id"], None)
+            return True
+
+    def _deliver(self, delivery: dict, worker_id: str):
+        # Newer builds' notifications may have been written concurrently.
+        if is_superseded(delivery):
+            supersede_delivery(delivery, worker_id)
+            return
+        set_notification_state(delivery, SENDING)
+        try:
+            self.deliver(delivery)
+        except DeliveryDeferred as e:
+            defer_delivery(delivery, worker_id, e.delay)
+            return
+        except Exception as e:
+            logger.warning(
+                f"Could not notify subscription "
+                f"{delivery['subscription_id']} about image "
+                f"{delivery['image_index']} of build "
+                f"{delivery['build_id']} (attempt {delivery['attempts']})"
+                f": {e!r}"
+            )
+            if delivery["attempts"] < self.max_attempts:
+                retry_delivery(
+                    delivery,
+                    worker_id,
+                    repr(e),
+                    self.get_delay(delivery["attempts"]),
+                )
+            else:
+                dead_letter_delivery(delivery, worker_id, repr(e))
+            return
+        complete_delivery(delivery, worker_id)
+
+    def _renew(self):
+        while not self._stop.wait(self.renew_interval):
+            try:
+                self.renew_leases()
+            except Exception:
+                logger.exception("Unexpected error renewing leases.")
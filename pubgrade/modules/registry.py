@@ -0,0 +1,266 @@
+"""Client for the Docker Registry HTTP API v2.
+
+Used to check whether an image was already pushed to a registry, so that
+builds of commits that were built before can be skipped. Bearer tokens
+issued by the registry's token service are cached per repository scope until
+they expire.
+"""
+
+import logging
+import re
+import threading
+import time
+from typing import Optional, Tuple
+
+import requests
+
+from pubgrade.errors.exceptions import RegistryError
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_MEDIA_TYPES = ", ".join(
+    [
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json",
+    ]
+)
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+# Registries spoken to over plain HTTP, like docker does by default.
+INSECURE_REGISTRIES = ("localhost", "127.0.0.1")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def parse_image_reference(image: str) -> Tuple[str, str, str]:
+    """Split image reference into registry, repository and tag or digest.
+
+    Args:
+        image (str): Image reference, e.g. `ttl.sh/pubgrade:1h` or
+        `elixircloud/pubgrade`.
+
+    Returns:
+        registry (str): Registry host (and port).
+        repository (str): Repository within the registry.
+        reference (str): Tag or digest, `latest` if not specified.
+    """
+    name, reference = image, "latest"
+    if "@" in name:
+        name, reference = name.split("@", 1)
+    elif ":" in name.rsplit("/", 1)[-1]:
+        name, reference = name.rsplit(":", 1)
+    host, _, path = name.partition("/")
+    if path and ("." in host or ":" in host or host == "localhost"):
+        registry, repository = host, path
+    else:
+        registry, repository = "docker.io", name
+    if registry in ("docker.io", "index.docker.io"):
+        registry = DOCKER_HUB_REGISTRY
+        if "/" not in repository:
+            repository = "library/%s" % repository
+    return registry, repository, reference
+
+
+def without_tag(image: str) -> str:
+    """Strip tag or digest from image reference.
+
+    Args:
+        image (str): Image reference.
+
+    Returns:
+        Image repository, including the registry if present.
+    """
+    name = image.split("@", 1)[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    return name
+
+
+def with_tag(image: str, tag: str) -> str:
+    """Replace tag or digest of image reference.
+
+    Args:
+        image (str): Image reference.
+        tag (str): New tag.
+
+    Returns:
+        Image reference with given tag.
+    """
+    return "%s:%s" % (without_tag(image), tag)
+
+
+class RegistryClient:
+    """Client for a single registry.
+
+    Args:
+        registry (str): Registry host (and port).
+        auth (str): Base 64 encoded `USER:PASSWORD` used to obtain tokens,
+        anonymous access if not specified.
+        timeout (int): Seconds to wait for the registry to respond.
+        scheme (str): `https` or `http`.
+    """
+
+    def __init__(
+        self,
+        registry: str,
+        auth: Optional[str] = None,
+        timeout: int = 10,
+        scheme: str = "https",
+    ):
+        self.registry = registry
+        self.auth = auth
+        self.timeout = timeout
+        self.scheme = scheme
+        self.session = requests.Session()
+        self._authorizations = {}
+        self._lock = threading.Lock()
+
+    def manifest_exists(self, repository: str, reference: str) -> bool:
+        """Check whether manifest exists with a `HEAD` manifest request.
+
+        Args:
+            repository (str): Repository within the registry.
+            reference (str): Tag or digest.
+
+        Returns:
+            `True` if the manifest exists, otherwise `False`.
+
+        Raises:
+            RegistryError: Raised when the registry could not be reached or
+            returned an unexpected response.
+        """
+        url = "%s://%s/v2/%s/manifests/%s" % (
+            self.scheme,
+            self.registry,
+            repository,
+            reference,
+        )
+        scope = "repository:%s:pull" % repository
+        response = self._head(url, scope)
+        if response.status_code == 401:
+            self._authorize(
+                response.headers.get("WWW-Authenticate", ""), scope
+            )
+            response = self._head(url, scope)
+        if response.status_code == 200:
+            return True
+        if response.status_code == 404:
+            return False
+        logger.error(
+            f"Unexpected response {response.status_code} from registry for "
+            f"{self.registry}/{repository}:{reference}."
+        )
+        raise RegistryError
+
+    def _head(self, url: str, scope: str) -> requests.Response:
+        headers = {"Accept": MANIFEST_MEDIA_TYPES}
+        with self._lock:
+            authorization, expires_at = self._authorizations.get(
+                scope, (None, 0)
+            )
+        if authorization is not None and expires_at > time.monotonic():
+            headers["Authorization"] = authorization
+        try:
+            return self.session.head(
+                url, headers=headers, timeout=self.timeout
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Could not reach registry {self.registry}: {e}")
+            raise RegistryError
+
+    def _authorize(self, challenge: str, scope: str):
+        """Answer authentication challenge and cache the authorization."""
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() == "basic" and self.auth:
+            authorization, expires_in = "Basic %s" % self.auth, float("inf")
+        elif scheme.lower() == "bearer":
+            authorization, expires_in = self._fetch_token(
+                dict(re.findall(r'(\w+)="([^"]*)"', params)), scope
+            )
+        else:
+            logger.error(
+                f"Unsupported authentication challenge from registry "
+                f"{self.registry}: {challenge}"
+            )
+            raise RegistryError
+        with self._lock:
+            self._authorizations[scope] = (
+                authorization,
+                time.monotonic() + expires_in,
+            )
+
+    def _fetch_token(self, challenge: dict, scope: str):
+        """Fetch bearer token from the registry's token service."""
+        headers = {}
+        if self.auth:
+            headers["Authorization"] = "Basic %s" % self.auth
+        params = {"scope": challenge.get("scope", scope)}
+        if "service" in challenge:
+            params["service"] = challenge["service"]
+        try:
+            response = self.session.get(
+                challenge["realm"],
+                params=params,
+                headers=headers,
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            data = response.json()
+            token = data.get("token") or data["access_token"]
+        except (KeyError, ValueError, requests.exceptions.RequestException):
+            logger.error(
+                f"Could not obtain token for {scope} from registry "
+                f"{self.registry}."
+            )
+            raise RegistryError
+        # Renew tokens a little before they expire.
+        expires_in = max(int(data.get("expires_in", 60)) - 10, 0)
+        return "Bearer %s" % token, expires_in
+
+
+def get_registry_client(
+    registry: str, auth: Optional[str] = None, timeout: int = 10
+) -> RegistryClient:
+    """Get process-wide client for a registry.
+
+    Args:
+        registry (str): Registry host (and port).
+        auth (str): Base 64 encoded `USER:PASSWORD`.
+        timeout (int): Seconds to wait for the registry to respond.
+
+    Returns:
+        Registry client sharing connections and cached tokens.
+    """
+    with _clients_lock:
+        key = (registry, auth)
+        if key not in _clients:
+            scheme = "https"
+            if registry.split(":")[0] in INSECURE_REGISTRIES:
+                scheme = "http"
+            _clients[key] = RegistryClient(registry, auth, timeout, scheme)
+        return _clients[key]
+
+
+def image_exists(
+    image: str, auth: Optional[str] = None, timeout: int = 10
+) -> bool:
+    """Check whether image exists in its registry.
+
+    Args:
+        image (str): Image reference.
+        auth (str): Base 64 encoded `USER:PASSWORD` for the registry.
+        timeout (int): Seconds to wait for the registry to respond.
+
+    Returns:
+        `True` if the image exists, otherwise `False`.
+
+    Raises:
+        RegistryError: Raised when the registry could not be reached or
+        returned an unexpected response.
+    """
+    registry, repository, reference = parse_image_reference(image)
+    return get_registry_client(registry, auth, timeout).manifest_exists(
+        repository, reference
+    )
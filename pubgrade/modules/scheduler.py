@@ -0,0 +1,414 @@
+"""Admission control for queued builds.
+
+A build holds a slot from the moment a worker admits it until it succeeds or
+fails, i.e. while its repository is cloned and its kaniko pod runs. The
+number of slots is capped globally and per repository; running builds are
+counted in the `build_slots` collection and slots are taken with conditional
+atomic updates, so that several workers (or API replicas) never exceed the
+caps. Queued builds are admitted in fair-share order: repositories with the
+fewest running builds go first, ties are broken by the oldest queued build.
+"""
+
+import datetime
+import logging
+from typing import Optional
+
+from flask import current_app
+
+from pubgrade.modules.build_queue import (
+    CLAIMED,
+    QUEUED,
+    claim_build,
+    claimable_filter,
+    release_build,
+)
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_SLOTS = "global"
+# Builds admitted within this many seconds count towards the average wait.
+WAIT_TIME_WINDOW = 3600
+
+
+def _slots_key(repository_id: str) -> str:
+    return "repository:%s" % repository_id
+
+
+def _take_slot(key: str, limit: int) -> bool:
+    """Increment slot counter unless it reached `limit`."""
+    db_collection_slots = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_slots"]
+        .client
+    )
+    db_collection_slots.update_one(
+        {"id": key}, {"$setOnInsert": {"running": 0}}, upsert=True
+    )
+    return (
+        db_collection_slots.find_one_and_update(
+            {"id": key, "running": {"$lt": limit}},
+            {"$inc": {"running": 1}},
+        )
+        is not None
+    )
+
+
+def _give_slot(key: str):
+    """Decrement slot counter."""
+    db_collection_slots = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_slots"]
+        .client
+    )
+    db_collection_slots.update_one(
+        {"id": key, "running": {"$gt": 0}}, {"$inc": {"running": -1}}
+    )
+
+
+def get_running_builds(repository_ids: list) -> dict:
+    """Get number of builds holding a slot.
+
+    Args:
+        repository_ids (list): Repository identifiers.
+
+    Returns:
+        Number of running builds per repository identifier, and in total
+        under `GLOBAL_SLOTS`.
+    """
+    db_collection_slots = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_slots"]
+        .client
+    )
+    keys = {
+        _slots_key(repository_id): repository_id
+        for repository_id in repository_ids
+    }
+    keys[GLOBAL_SLOTS] = GLOBAL_SLOTS
+    running = dict.fromkeys(keys.values(), 0)
+    for slots in db_collection_slots.find({"id": {"$in": list(keys)}}):
+        running[keys[slots["id"]]] = slots["running"]
+    return running
+
+
+def acquire_slot(
+    job: dict, max_concurrent_builds: int, repository_limit: int
+) -> bool:
+    """Admit claimed build if there are free slots.
+
+    Builds already holding a slot (e.g. claimed again after a worker died)
+    are admitted without taking another one.
+
+    Args:
+        job (dict): Job claimed from the build queue.
+        max_concurrent_builds (int): Global number of slots.
+        repository_limit (int): Number of slots of the build's repository.
+
+    Returns:
+        `True` if the build was admitted, otherwise `False`.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    build = db_collection_builds.find_one({"id": job["id"]})
+    if build is None or build.get("slot_held"):
+        return True
+    if not _take_slot(GLOBAL_SLOTS, max_concurrent_builds):
+        return False
+    if not _take_slot(_slots_key(job["repository_id"]), repository_limit):
+        _give_slot(GLOBAL_SLOTS)
+        return False
+    wait = datetime.datetime.utcnow() - job["queued_at"]
+    db_collection_builds.update_one(
+        {"id": job["id"]},
+        {
+            "$set": {
+                "slot_held": True,
+                "slot_repository_id": job["repository_id"],
+                "admitted_at": str(datetime.datetime.now().isoformat()),
+                "queue_wait_seconds": round(wait.total_seconds(), 3),
+            }
+        },
+    )
+    logger.info(
+        f"Admitted build {job['id']} after {wait.total_seconds():.1f}s."
+    )
+    return True
+
+
+def release_slot(build_id: str):
+    """Free the slot held by a build; does nothing if it holds none.
+
+    Args:
+        build_id (str): Build identifier.
+    """
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    build = db_collection_builds.find_one_and_update(
+        {"id": build_id, "slot_held": True}, {"$set": {"slot_held": False}}
+    )
+    if build is None:
+        return
+    _give_slot(GLOBAL_SLOTS)
+    _give_slot(_slots_key(build["slot_repository_id"]))
+
+
+def get_repository_limits(repository_ids: list, default: int) -> dict:
+    """Get number of slots per repository.
+
+    Args:
+        repository_ids (list): Repository identifiers.
+        default (int): Slots of repositories without `max_concurrent_builds`
+        setting.
+
+    Returns:
+        Number of slots per repository identifier.
+    """
+    db_collection_repositories = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["repositories"]
+        .client
+    )
+    limits = dict.fromkeys(repository_ids, default)
+    for repository in db_collection_repositories.find(
+        {"id": {"$in": list(repository_ids)}},
+        {"id": True, "max_concurrent_builds": True},
+    ):
+        limits[repository["id"]] = repository.get(
+            "max_concurrent_builds", default
+        )
+    return limits
+
+
+class BuildScheduler:
+    """Claims queued builds in fair-share order while slots are free.
+
+    Args:
+        max_concurrent_builds: Global number of slots.
+        max_concurrent_builds_per_repository: Number of slots of
+        repositories without `max_concurrent_builds` setting.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_builds: int = 10,
+        max_concurrent_builds_per_repository: int = 3,
+    ):
+        self.max_concurrent_builds = max_concurrent_builds
+        self.max_concurrent_builds_per_repository = (
+            max_concurrent_builds_per_repository
+        )
+
+    def claim(self, worker_id: str, claim_timeout: int) -> Optional[dict]:
+        """Claim and admit the next build.
+
+        Args:
+            worker_id (str): Identifier of the claiming worker.
+            claim_timeout (int): Seconds after which a claimed job is
+            considered abandoned.
+
+        Returns:
+            job (dict): Admitted job, or `None` if the queue is empty or
+            there are no free slots.
+        """
+        # Abandoned builds still holding a slot are counted as running, so
+        # they are claimed again regardless of the caps.
+        job = self.claim_abandoned(worker_id, claim_timeout)
+        if job is not None:
+            return job
+        db_collection_queue = (
+            current_app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["build_queue"]
+            .client
+        )
+        candidates = list(
+            db_collection_queue.aggregate(
+                [
+                    {"$match": claimable_filter(claim_timeout)},
+                    {
+                        "$group": {
+                            "_id": "$repository_id",
+                            "queued_at": {"$min": "$queued_at"},
+                        }
+                    },
+                ]
+            )
+        )
+        repository_ids = [candidate["_id"] for candidate in candidates]
+        running = get_running_builds(repository_ids)
+        if running[GLOBAL_SLOTS] >= self.max_concurrent_builds:
+            return None
+        limits = get_repository_limits(
+            repository_ids, self.max_concurrent_builds_per_repository
+        )
+        for candidate in sorted(
+            candidates,
+            key=lambda c: (running[c["_id"]], c["queued_at"]),
+        ):
+            repository_id = candidate["_id"]
+            if running[repository_id] >= limits[repository_id]:
+                continue
+            job = claim_build(worker_id, claim_timeout, repository_id)
+            if job is None:
+                continue
+            if acquire_slot(
+                job, self.max_concurrent_builds, limits[repository_id]
+            ):
+                return job
+            release_build(job["id"], worker_id, count_attempt=False)
+        return None
+
+    def claim_abandoned(
+        self, worker_id: str, claim_timeout: int
+    ) -> Optional[dict]:
+        """Claim abandoned build which holds a slot.
+
+        Args:
+            worker_id (str): Identifier of the claiming worker.
+            claim_timeout (int): Seconds after which a claimed job is
+            considered abandoned.
+
+        Returns:
+            job (dict): Claimed job, or `None` if there is none.
+        """
+        db_collection_queue = (
+            current_app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["build_queue"]
+            .client
+        )
+        db_collection_builds = (
+            current_app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        abandoned = [
+            job["id"]
+            for job in db_collection_queue.find(
+                {
+                    "state": CLAIMED,
+                    "claimed_at": {
+                        "$lt": datetime.datetime.utcnow()
+                        - datetime.timedelta(seconds=claim_timeout)
+                    },
+                },
+                {"id": True},
+            )
+        ]
+        if not abandoned:
+            return None
+        for build in db_collection_builds.find(
+            {"id": {"$in": abandoned}, "slot_held": True}, {"id": True}
+        ):
+            job = claim_build(worker_id, claim_timeout, build_id=build["id"])
+            if job is not None:
+                return job
+        return None
+
+    def release(self, build_id: str):
+        """Free the slot held by a build.
+
+        Args:
+            build_id (str): Build identifier.
+        """
+        release_slot(build_id)
+
+
+def get_queue_status(max_concurrent_builds: int) -> dict:
+    """Get queue depth, running builds and wait times.
+
+    Args:
+        max_concurrent_builds (int): Global number of slots.
+
+    Returns:
+        Number of queued and running builds in total and per repository,
+        age of the oldest queued build and average wait of recently admitted
+        builds in seconds.
+    """
+    db_collection_queue = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_queue"]
+        .client
+    )
+    db_collection_builds = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["builds"]
+        .client
+    )
+    now = datetime.datetime.utcnow()
+    queued = {}
+    for job in db_collection_queue.find(
+        {"state": QUEUED}, {"repository_id": True, "queued_at": True}
+    ):
+        count, oldest = queued.get(job["repository_id"], (0, now))
+        queued[job["repository_id"]] = (
+            count + 1,
+            min(oldest, job["queued_at"]),
+        )
+    db_collection_slots = (
+        current_app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["build_slots"]
+        .client
+    )
+    running = {}
+    for slots in db_collection_slots.find({"running": {"$gt": 0}}):
+        running[slots["id"]] = slots["running"]
+    repository_ids = set(queued) | {
+        key.split(":", 1)[1] for key in running if key != GLOBAL_SLOTS
+    }
+    repositories = []
+    for repository_id in sorted(repository_ids):
+        count, oldest = queued.get(repository_id, (0, now))
+        repositories.append(
+            {
+                "repository_id": repository_id,
+                "queued": count,
+                "running": running.get(_slots_key(repository_id), 0),
+                "oldest_wait_seconds": round(
+                    (now - oldest).total_seconds(), 3
+                ),
+            }
+        )
+    admitted_after = (
+        datetime.datetime.now() - datetime.timedelta(seconds=WAIT_TIME_WINDOW)
+    ).isoformat()
+    waits = [
+        build["queue_wait_seconds"]
+        for build in db_collection_builds.find(
+            {"admitted_at": {"$gte": admitted_after}},
+            {"queue_wait_seconds": True},
+        )
+    ]
+    return {
+        "queued": sum(count for count, _ in queued.values()),
+        "running": running.get(GLOBAL_SLOTS, 0),
+        "max_concurrent_builds": max_concurrent_builds,
+        "oldest_wait_seconds": max(
+            [
+                repository["oldest_wait_seconds"]
+                for repository in repositories
+                if repository["queued"]
+            ],
+            default=0,
+        ),
+        "average_wait_seconds": round(sum(waits) / len(waits), 3)
+        if waits
+        else None,
+        "repositories": repositories,
+    }
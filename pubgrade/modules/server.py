@@ -3,9 +3,17 @@
 from flask import request
 from foca.utils.logging import log_traffic
 
+from pubgrade.modules.endpoints.admin import (
+    get_callback_host_states,
+    get_http_destinations,
+    get_notification_dead_letters,
+    replay_notification_dead_letters,
+)
 from pubgrade.modules.endpoints.builds import (
     build_completed,
+    complete_builds,
     get_build_info,
+    get_build_queue,
     get_builds,
     register_builds,
 )
@@ -19,6 +27,7 @@ from pubgrade.modules.endpoints.repositories import (
 from pubgrade.modules.endpoints.subscriptions import (
     delete_subscription,
     get_subscription_info,
+    get_subscription_updates,
     get_subscriptions,
     register_subscription,
 )
@@ -140,9 +149,24 @@ def getBuildInfo(id: str, build_id: str):
     return get_build_info(build_id)
 
 
+@log_traffic
+def getBuildQueue():
+    """Get build queue status.
+
+    Returns:
+        Queue depth, running builds and wait times, in total and per
+        repository.
+    """
+    return get_build_queue(
+        request.headers["X-Super-User-Id"],
+        request.headers["X-Super-User-Access-Token"],
+    )
+
+
 @log_traffic
 def updateBuild(id: str, build_id: str):
-    """Update build complete status.
+    """Update build complete status of an image, i.e. whether it was built
+    or its kaniko pod failed or timed out.
 
     Args:
         id: Identifier of Repository
@@ -152,10 +176,26 @@ def updateBuild(id: str, build_id: str):
         build_id: Identifier of Build updated.
     """
     return build_completed(
-        id, build_id, request.headers["X-Project-Access-Token"]
+        id,
+        build_id,
+        request.headers["X-Project-Access-Token"],
+        request.json.get("image_index", 0),
+        request.json.get("status", "SUCCEEDED"),
+        request.json.get("reason", ""),
+        request.json.get("exit_code"),
     )
 
 
+@log_traffic
+def postBuildCompletions():
+    """Update build complete status of many images at once.
+
+    Returns:
+        Result of each completion.
+    """
+    return complete_builds(request.json["completions"])
+
+
 @log_traffic
 def postSubscription():
     """Register new subscription.
@@ -200,6 +240,29 @@ def getSubscriptionInfo(subscription_id: str):
     )
 
 
+@log_traffic
+def getSubscriptionUpdates(
+    subscription_id: str, since: int = 0, wait: float = 0
+):
+    """Get images built for this subscription_id since a cursor.
+
+    Args:
+        subscription_id: Identifier of subscription to get updates of.
+        since: Cursor returned by the previous request.
+        wait: Seconds to hold the request for if there are no updates yet.
+
+    Returns:
+        Updates and the cursor to get the following updates with.
+    """
+    return get_subscription_updates(
+        request.headers["X-User-Id"],
+        request.headers["X-User-Access-Token"],
+        subscription_id,
+        since,
+        wait,
+    )
+
+
 @log_traffic
 def deleteSubscription(subscription_id: str):
     """Delete subscription.
@@ -292,3 +355,56 @@ def unverifyUser(uid: str):
         uid,
         False,
     )
+
+
+@log_traffic
+def getHttpDestinations():
+    """Get latency and error statistics of outgoing requests.
+
+    Returns:
+        Statistics of requests to each destination host.
+    """
+    return get_http_destinations(
+        request.headers["X-Super-User-Id"],
+        request.headers["X-Super-User-Access-Token"],
+    )
+
+
+@log_traffic
+def getCallbackHosts():
+    """Get circuit breaker and rate limit state of callback hosts.
+
+    Returns:
+        State of each callback host.
+    """
+    return get_callback_host_states(
+        request.headers["X-Super-User-Id"],
+        request.headers["X-Super-User-Access-Token"],
+    )
+
+
+@log_traffic
+def getDeadLetters():
+    """Get notifications which could not be delivered to subscriptions.
+
+    Returns:
+        Dead letters, oldest first.
+    """
+    return get_notification_dead_letters(
+        request.headers["X-Super-User-Id"],
+        request.headers["X-Super-User-Access-Token"],
+    )
+
+
+@log_traffic
+def postDeadLettersReplay():
+    """Deliver notifications which could not be delivered again.
+
+    Returns:
+        Identifiers of the replayed notifications.
+    """
+    return replay_notification_dead_letters(
+        request.headers["X-Super-User-Id"],
+        request.headers["X-Super-User-Access-Token"],
+        request.get_json(silent=True),
+    )
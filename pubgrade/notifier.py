@@ -0,0 +1,48 @@
+"""Standalone notification worker.
+
+`pubgrade-notifier` delivers notifications from the outbox (see
+`pubgrade.modules.outbox`) without serving the API, so that delivery can be
+scaled independently of the API by running it as any number of replicas.
+It reads the same `config.yaml` as the API, from the working directory.
+Replicas lease the notifications they send; on `SIGTERM` or `SIGINT`,
+notifications being sent are given as long as a callback may take with all
+of its retries to finish before the process exits, and notifications of
+replicas which crashed are taken over once their leases expire.
+"""
+
+import logging
+import signal
+import threading
+
+from foca.foca import foca
+
+from pubgrade.app import start_delivery_workers
+from pubgrade.modules.http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    app = foca("config.yaml")
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}; stopping.")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    pool = start_delivery_workers(app)
+    logger.info(f"Delivering notifications with {pool.workers} workers.")
+    stop.wait()
+    pool.stop()
+    # The pod's `terminationGracePeriodSeconds` has to be longer, see
+    # `Notifier` in deployment/values.yaml.
+    with app.app.app_context():
+        timeout = get_http_client().max_duration
+    logger.info(f"Waiting up to {timeout:.0f}s for notifications being sent.")
+    pool.join(timeout)
+
+
+if __name__ == "__main__":
+    main()
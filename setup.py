@@ -37,4 +37,9 @@ setup(
         "Programming Language :: Python :: 3.9",
     ],
     install_requires=[],
+    entry_points={
+        "console_scripts": [
+            "pubgrade-notifier=pubgrade.notifier:main",
+        ],
+    },
 )
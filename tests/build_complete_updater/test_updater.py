@@ -0,0 +1,243 @@
+"""Tests for build-complete-updater"""
+import datetime
+import importlib.util
+import itertools
+import os
+import queue
+from unittest.mock import MagicMock, patch
+
+import pytest
+from kubernetes.client import (
+    ApiException,
+    V1Container,
+    V1EnvVar,
+    V1ListMeta,
+    V1ObjectMeta,
+    V1Pod,
+    V1PodList,
+    V1PodSpec,
+    V1PodStatus,
+)
+
+UPDATER_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "..",
+    "build-complete-updater",
+    "updater.py",
+)
+
+# Cluster configuration is loaded on import.
+with patch("kubernetes.config.load_kube_config"), patch(
+    "kubernetes.config.load_incluster_config"
+):
+    spec = importlib.util.spec_from_file_location("updater", UPDATER_PATH)
+    updater = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(updater)
+
+
+def reset_state():
+    updater.reported_pods.clear()
+    updater.reporting_pods.clear()
+    updater.deadlines.clear()
+    updater.report_queue = queue.Queue()
+
+
+def get_pod(name, phase="Succeeded", annotations=None, age=0):
+    return V1Pod(
+        metadata=V1ObjectMeta(
+            name=name,
+            uid="uid-%s" % name,
+            annotations=annotations,
+            creation_timestamp=datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(seconds=age),
+            resource_version="1",
+        ),
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    name="kaniko",
+                    env=[
+                        V1EnvVar(name="BUILDNAME", value="eiic.gngdgrs"),
+                        V1EnvVar(name="ACCESSTOKEN", value="token"),
+                        V1EnvVar(name="IMAGE_INDEX", value="0"),
+                    ],
+                )
+            ]
+        ),
+        status=V1PodStatus(phase=phase),
+    )
+
+
+def get_event(event_type, resource_version, pod=None):
+    return {
+        "type": event_type,
+        "object": pod,
+        "raw_object": {"metadata": {"resourceVersion": resource_version}},
+    }
+
+
+def get_error_event(code):
+    return {
+        "type": "ERROR",
+        "object": None,
+        "raw_object": {"kind": "Status", "code": code, "message": "error"},
+    }
+
+
+def get_v1():
+    v1 = MagicMock()
+    v1.list_namespaced_pod.return_value = V1PodList(
+        items=[], metadata=V1ListMeta(resource_version="10")
+    )
+    return v1
+
+
+def get_response(status_codes):
+    response = MagicMock(status_code=200)
+    response.json.return_value = {
+        "results": [
+            {"status_code": status_code, "error": None}
+            for status_code in status_codes
+        ]
+    }
+    return response
+
+
+def test_watch_pods_bookmark():
+    reset_state()
+    mock_watch = MagicMock()
+    mock_watch.return_value.stream.return_value = iter(
+        [
+            get_event("BOOKMARK", "12"),
+            get_event("MODIFIED", "13", get_pod("pod-1")),
+            get_event("BOOKMARK", "14"),
+        ]
+    )
+    with patch.object(updater.watch, "Watch", mock_watch):
+        assert updater.watch_pods(get_v1(), "10", 60) == "14"
+    assert updater.report_queue.qsize() == 1
+
+
+def test_watch_pods_error():
+    reset_state()
+    mock_watch = MagicMock()
+    mock_watch.return_value.stream.return_value = iter(
+        [get_error_event(500)]
+    )
+    with patch.object(updater.watch, "Watch", mock_watch):
+        with pytest.raises(ApiException) as e:
+            updater.watch_pods(get_v1(), "10", 60)
+    assert e.value.status == 500
+
+
+@patch.object(updater.time, "sleep", MagicMock())
+def test_sync_pods_relists_expired():
+    reset_state()
+    v1 = get_v1()
+    mock_watch = MagicMock()
+    mock_watch.return_value.stream.side_effect = [
+        iter([get_event("BOOKMARK", "11"), get_error_event(410)]),
+        iter([get_event("BOOKMARK", "12")]),
+    ]
+    with patch.object(updater.watch, "Watch", mock_watch):
+        resource_version, resync_at = updater.sync_pods(v1, None, 0)
+        assert resource_version is None
+        resource_version, _ = updater.sync_pods(
+            v1, resource_version, resync_at
+        )
+    assert resource_version == "12"
+    assert v1.list_namespaced_pod.call_count == 2
+
+
+@patch.object(updater.time, "sleep", MagicMock())
+def test_sync_pods_unexpected_error():
+    reset_state()
+    v1 = get_v1()
+    mock_watch = MagicMock()
+    mock_watch.return_value.stream.side_effect = ValueError
+    with patch.object(updater.watch, "Watch", mock_watch):
+        resource_version, _ = updater.sync_pods(v1, None, 0)
+    # Pods are listed again after unexpected errors.
+    assert resource_version is None
+
+
+def test_handle_pod_timed_out():
+    reset_state()
+    v1 = get_v1()
+    pod = get_pod(
+        "pod-1",
+        phase="Running",
+        annotations={updater.TIMEOUT_ANNOTATION: "60"},
+        age=120,
+    )
+    updater.handle_pod(v1, pod)
+    v1.delete_namespaced_pod.assert_called_once_with(
+        "pod-1", updater.NAMESPACE
+    )
+    reported_pod, outcome, annotate, _ = updater.report_queue.get_nowait()
+    assert reported_pod is pod
+    assert outcome[0] == "TIMED_OUT"
+    assert not annotate
+    assert updater.deadlines == {}
+
+
+def test_handle_pod_not_timed_out():
+    reset_state()
+    v1 = get_v1()
+    updater.handle_pod(
+        v1,
+        get_pod(
+            "pod-1",
+            phase="Running",
+            annotations={updater.TIMEOUT_ANNOTATION: "60"},
+        ),
+    )
+    v1.delete_namespaced_pod.assert_not_called()
+    assert "uid-pod-1" in updater.deadlines
+    assert updater.report_queue.empty()
+
+
+@patch.object(updater, "BATCH_INTERVAL", 0)
+@patch.object(updater.random, "uniform", MagicMock(return_value=0))
+def test_report_batch_retries():
+    reset_state()
+    v1 = get_v1()
+    updater.report(get_pod("pod-1"), updater.get_outcome(get_pod("pod-1")))
+    updater.report(get_pod("pod-2"), ("FAILED", "Error", 1))
+    retries = []
+    sequence = itertools.count()
+    mock_request = MagicMock(
+        side_effect=[get_response([200, 503]), get_response([200])]
+    )
+    with patch.object(updater.requests, "request", mock_request):
+        updater.report_batch(v1, retries, sequence)
+        # Both completions are flushed in one request.
+        assert mock_request.call_count == 1
+        assert v1.patch_namespaced_pod.call_count == 1
+        assert updater.reported_pods == {"uid-pod-1"}
+        assert len(retries) == 1
+        updater.report_batch(v1, retries, sequence)
+    assert mock_request.call_count == 2
+    assert '"reason": "Error"' in mock_request.call_args[1]["data"]
+    assert retries == []
+    assert updater.reported_pods == {"uid-pod-1", "uid-pod-2"}
+    assert updater.reporting_pods == set()
+
+
+@patch.object(updater, "MAX_REPORT_ATTEMPTS", 1)
+@patch.object(updater, "BATCH_INTERVAL", 0)
+def test_report_batch_gives_up():
+    reset_state()
+    v1 = get_v1()
+    updater.report(get_pod("pod-1"), ("SUCCEEDED", "", None))
+    retries = []
+    with patch.object(
+        updater.requests,
+        "request",
+        MagicMock(side_effect=updater.requests.exceptions.ConnectionError),
+    ):
+        updater.report_batch(v1, retries, itertools.count())
+    assert retries == []
+    assert updater.reported_pods == {"uid-pod-1"}
+    v1.patch_namespaced_pod.assert_not_called()
@@ -1,4 +1,5 @@
 """Mock data for testing"""
+import datetime
 
 INDEX_CONFIG = {"keys": [("id", -1)]}
 INDEX_CONFIG_USERS = {"keys": [("uid", -1)]}
@@ -21,6 +22,14 @@ DB_CONFIG = {
         "subscriptions": COLLECTION_CONFIG,
         "users": COLLECTION_CONFIG_USERS,
         "admin_users": COLLECTION_CONFIG_ADMIN_USERS,
+        "build_queue": COLLECTION_CONFIG,
+        "build_slots": COLLECTION_CONFIG,
+        "build_tasks": COLLECTION_CONFIG,
+        "notification_outbox": COLLECTION_CONFIG,
+        "notification_dead_letters": COLLECTION_CONFIG,
+        "notification_sequences": COLLECTION_CONFIG,
+        "subscription_updates": COLLECTION_CONFIG,
+        "callback_hosts": COLLECTION_CONFIG,
     },
 }
 
@@ -51,11 +60,103 @@ ENDPOINT_CONFIG = {
             "name": "Akash Saini",
             "uid": "9fe2c4e93f654fdbb24c02b15259716c",
             "user_access_token": "c42a6d44e3d0",
-        }
+        },
+        "updates": {
+            "limit": 100,
+            "max_wait": 30,
+            "poll_interval": 0,
+            "gap_timeout": 10,
+        },
+    },
+    "http": {
+        "pool_connections": 2,
+        "pool_maxsize": 2,
+        "connect_timeout": 5,
+        "read_timeout": 30,
+        "max_retries": 2,
+        "backoff_base": 0,
+        "backoff_max": 0,
+        "max_retry_after": 1,
+    },
+    "notifications": {
+        "run_in_api": True,
+        "workers": 1,
+        "poll_interval": 0,
+        "visibility_timeout": 60,
+        "renew_interval": None,
+        "max_attempts": 2,
+        "backoff_base": 0,
+        "backoff_max": 0,
+        "circuit_breaker": {
+            "failure_threshold": 2,
+            "recovery_timeout": 30,
+            "half_open_max_calls": 1,
+        },
+        "rate_limit": {
+            "rate": 10,
+            "burst": 20,
+        },
+        "debounce": 0,
+        "delivery_policy": {
+            "canary_percent": None,
+            "wave_size": None,
+            "wave_delay": 0,
+            "jitter": 0,
+            "gate_on_acks": False,
+        },
     },
     "builds": {
             "gh_action_path": "akash2237778/pubgrade-signer",
-            "intermediate_registery_format": "ttl.sh/{}:1h"
+            "intermediate_registery_format": "ttl.sh/{}:1h",
+            "queue": {
+                "workers": 1,
+                "poll_interval": 0,
+                "claim_timeout": 900,
+                "max_attempts": 2,
+            },
+            "tasks": {
+                "workers": 1,
+                "poll_interval": 0,
+                "claim_timeout": 300,
+                "max_attempts": 2,
+                "backoff_base": 0,
+                "backoff_max": 0,
+                "sweep_interval": 0,
+            },
+            "scheduler": {
+                "max_concurrent_builds": 2,
+                "max_concurrent_builds_per_repository": 1,
+            },
+            "timeout": 3600,
+            "completion_workers": 2,
+            "clone_strategy": "full",
+            "git_cache": {
+                "enabled": False,
+                "directory": None,
+                "max_size_mb": 1024,
+            },
+            "dedup": {
+                "enabled": False,
+                "window": 3600,
+                "resolve_refs": False,
+                "resolve_timeout": 10,
+            },
+            "cache": {
+                "enabled": True,
+                "repository_format": None,
+                "ttl": "336h",
+            },
+            "kubernetes": {
+                "pool_size": 2,
+                "connect_timeout": 5,
+                "read_timeout": 60,
+                "config_refresh_interval": 3600,
+            },
+            "dump_pod_specs": False,
+            "skip_existing_images": {
+                "enabled": False,
+                "timeout": 10,
+            },
         },
 }
 
@@ -174,3 +275,15 @@ MOCK_ENDPOINT = {
         "id_length": 1,
     }
 }
+MOCK_DEAD_LETTER = {
+    "id": "eiic.gngdgrs.0.tnglot",
+    "build_id": "eiic.gngdgrs",
+    "image_index": 0,
+    "notification_index": 0,
+    "image": "akash7778/test-updater:0.0.1",
+    "subscription_id": "tnglot",
+    "created_at": datetime.datetime(2021, 8, 5, 9, 0),
+    "attempts": 8,
+    "error": "RequestNotSent()",
+    "dead_lettered_at": datetime.datetime(2021, 8, 5, 10, 0),
+}
@@ -1,14 +1,18 @@
 """Tests for /builds endpoint """
+import datetime
 import os
 import shutil
 from unittest.mock import patch, MagicMock
 
 import mongomock
 import pytest
+import requests
+import yaml
 from flask import Flask
 from foca.models.config import Config, MongoConfig
 from typing import Any
 
+from git import GitCommandError, Repo
 from kubernetes.client import ApiException
 from pymongo.errors import DuplicateKeyError
 from werkzeug.exceptions import Unauthorized, InternalServerError
@@ -19,20 +23,41 @@ from pubgrade.errors.exceptions import (
     CreatePodError,
     DeletePodError,
     GitCloningError,
+    RequestNotSent,
+    SigningError,
 )
 from pubgrade.modules.endpoints.builds import (
     register_builds,
     get_builds,
     get_build_info,
+    get_build_key,
+    get_cache_settings,
+    get_checkout_reference,
+    get_sparse_paths,
+    run_queued_build,
+    fail_queued_build,
+    reset_queued_build,
     git_clone_and_checkout,
+    parse_cache_stats,
+    resolve_commit_sha,
     create_deployment_YAML,
     create_dockerhub_config_file,
+    create_pod_spec,
+    get_pod_template,
+    load_pod_template,
     create_build,
     build_completed,
+    complete_builds,
     remove_files,
     build_push_image_using_kaniko,
+    trigger_signing_image,
 )
+import pubgrade.modules.callback_hosts as callback_hosts
 import pubgrade.modules.endpoints.builds as builds
+from pubgrade.modules.build_tasks import TaskWorkerPool
+from pubgrade.modules.endpoints.subscriptions import deliver_notification
+from pubgrade.modules.kubernetes_client import KubernetesClient
+from pubgrade.modules.outbox import DeliveryWorkerPool
 from tests.mock_data import (
     ENDPOINT_CONFIG,
     MONGO_CONFIG,
@@ -59,7 +84,9 @@ def mocked_create_build(
     return "working fine"
 
 
-def mocked_build_push_image_using_kaniko(deployment_file_location):
+def mocked_build_push_image_using_kaniko(
+    deployment_file_location="", pod_spec=None
+):
     return 0
 
 
@@ -67,8 +94,8 @@ def mocked_remove_files(dir_location: str, pod_name: str, namespace: str):
     return "removed"
 
 
-def mocked_notify_subscriptions(
-    subscription_id: str, image: str, build_id: str
+def mocked_send_notification(
+    subscription: dict, image: str, build_id: str, deactivate: bool = True
 ):
     return "Notified"
 
@@ -89,8 +116,10 @@ def mocked_delete_namespaced_pod_error(
     raise ApiException
 
 
-def mocked_request_api(method, url, data, headers):
-    return "successful"
+def mocked_request_api(self, method, url, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    return response
 
 
 def mocked_load_cluster_config(
@@ -102,7 +131,9 @@ def mocked_load_cluster_config(
     return "Loaded successfully"
 
 
-def mocked_load_incluster_config():
+def mocked_load_incluster_config(
+    client_configuration=None, try_refresh_token=True
+):
     return "Loaded successfully"
 
 
@@ -122,6 +153,12 @@ def mocked_create_namespaced_pod_error(
     raise ApiException
 
 
+def mocked_create_namespaced_pod_conflict(
+    self, namespace: str, body: Any, **kwargs: Any
+):
+    raise ApiException(status=409)
+
+
 def mocked_load_kube_config(
     config_file=None,
     context=None,
@@ -165,6 +202,47 @@ class TestBuild:
         self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
             "builds"
         ].client = mongomock.MongoClient().db.collection
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "build_queue"
+        ].client = mongomock.MongoClient().db.collection
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "build_tasks"
+        ].client = mongomock.MongoClient().db.collection
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "subscriptions"
+        ].client = mongomock.MongoClient().db.collection
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "subscriptions"
+        ].client.insert_one(dict(MOCK_SUBSCRIPTION_INFO))
+        for collection in [
+            "notification_outbox",
+            "notification_dead_letters",
+            "notification_sequences",
+            "subscription_updates",
+            "callback_hosts",
+        ]:
+            self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+                collection
+            ].client = mongomock.MongoClient().db.collection
+        callback_hosts._callback_hosts = None
+
+    def run_tasks(self):
+        pool = TaskWorkerPool(
+            self.app,
+            handlers={
+                "sign": builds.sign_image,
+                "cleanup": builds.clean_up_image,
+                "notify": builds.notify_subscriptions_of_image,
+            },
+            backoff_base=0,
+        )
+        while pool.run_once("worker-1"):
+            pass
+        delivery_pool = DeliveryWorkerPool(
+            self.app, deliver=deliver_notification, backoff_base=0
+        )
+        while delivery_pool.run_once("worker-1"):
+            pass
 
     def setup_with_build(self):
         self.setup()
@@ -193,6 +271,23 @@ class TestBuild:
                 and res["id"][: self.id_length] == MOCK_REPOSITORIES[1]["id"]
             )
 
+    def test_register_builds_enqueues_build(self):
+        self.setup()
+        with self.app.app_context():
+            res = register_builds(
+                MOCK_REPOSITORIES[1]["id"],
+                MOCK_REPOSITORIES[1]["access_token"],
+                dict(MOCK_BUILD_PAYLOAD),
+            )
+            job = (
+                self.app.config["FOCA"]
+                .db.dbs["pubgradeStore"]
+                .collections["build_queue"]
+                .client.find_one({"id": res["id"]})
+            )
+            assert job["state"] == "QUEUED"
+            assert job["repository_id"] == MOCK_REPOSITORIES[1]["id"]
+
     @patch(
         "pubgrade.modules.endpoints.builds.create_build", mocked_create_build
     )
@@ -276,6 +371,169 @@ class TestBuild:
                     MOCK_BUILD_PAYLOAD,
                 )
 
+    def register_dedup_build(self, head_commit):
+        with patch(
+            "pubgrade.modules.endpoints.builds.resolve_commit_sha",
+            MagicMock(return_value="8cd58eb160014c91e4f181562352c693d3442c52"),
+        ):
+            return register_builds(
+                MOCK_REPOSITORIES[1]["id"],
+                MOCK_REPOSITORIES[1]["access_token"],
+                {
+                    "images": [
+                        dict(image) for image in MOCK_BUILD_INFO["images"]
+                    ],
+                    "head_commit": head_commit,
+                    "dockerhub_token": "dockerhub token",
+                },
+            )
+
+    @patch.dict(
+        ENDPOINT_CONFIG["builds"]["dedup"],
+        {"enabled": True, "resolve_refs": True},
+    )
+    def test_register_builds_dedup_in_flight(self):
+        self.setup()
+        builds_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        with self.app.app_context():
+            res = self.register_dedup_build({"branch": "main"})
+            res_2 = self.register_dedup_build({"tag": "0.4.2"})
+            assert res_2["id"] == res["id"]
+            assert builds_collection.count_documents({}) == 1
+            build = builds_collection.find_one({"id": res["id"]})
+            assert build["head_commit_aliases"] == [{"tag": "0.4.2"}]
+            assert build["resolved_commit_sha"] == (
+                "8cd58eb160014c91e4f181562352c693d3442c52"
+            )
+
+    @patch.dict(
+        ENDPOINT_CONFIG["builds"]["dedup"],
+        {"enabled": True, "resolve_refs": True},
+    )
+    def test_register_builds_dedup_recently_succeeded(self):
+        self.setup()
+        builds_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        with self.app.app_context():
+            res = self.register_dedup_build({"branch": "main"})
+            builds_collection.update_one(
+                {"id": res["id"]},
+                {
+                    "$set": {
+                        "status": "SUCCEEDED",
+                        "finished_at": datetime.datetime.now().isoformat(),
+                    },
+                    "$unset": {"active_build_key": ""},
+                },
+            )
+            assert self.register_dedup_build({"branch": "main"}) == res
+            # Subscriptions on the tag were not notified by the first build.
+            assert self.register_dedup_build({"tag": "0.4.2"}) != res
+
+    @patch.dict(
+        ENDPOINT_CONFIG["builds"]["dedup"],
+        {"enabled": True, "resolve_refs": True},
+    )
+    def test_register_builds_dedup_commit_not_resolved(self):
+        self.setup()
+        with self.app.app_context():
+            with patch(
+                "pubgrade.modules.endpoints.builds.resolve_commit_sha",
+                MagicMock(return_value=None),
+            ):
+                res = register_builds(
+                    MOCK_REPOSITORIES[1]["id"],
+                    MOCK_REPOSITORIES[1]["access_token"],
+                    {
+                        "images": MOCK_BUILD_INFO["images"],
+                        "head_commit": {"branch": "main"},
+                        "dockerhub_token": "dockerhub token",
+                    },
+                )
+                res_2 = register_builds(
+                    MOCK_REPOSITORIES[1]["id"],
+                    MOCK_REPOSITORIES[1]["access_token"],
+                    {
+                        "images": MOCK_BUILD_INFO["images"],
+                        "head_commit": {"branch": "main"},
+                        "dockerhub_token": "dockerhub token",
+                    },
+                )
+            assert res["id"] != res_2["id"]
+
+    @patch.dict(ENDPOINT_CONFIG["builds"]["dedup"], {"enabled": True})
+    def test_register_builds_dedup_refs_not_resolved(self):
+        self.setup()
+        mock_resolve_commit_sha = MagicMock()
+        with self.app.app_context():
+            with patch(
+                "pubgrade.modules.endpoints.builds.resolve_commit_sha",
+                mock_resolve_commit_sha,
+            ):
+                res = register_builds(
+                    MOCK_REPOSITORIES[1]["id"],
+                    MOCK_REPOSITORIES[1]["access_token"],
+                    {
+                        "images": MOCK_BUILD_INFO["images"],
+                        "head_commit": {"branch": "main"},
+                        "dockerhub_token": "dockerhub token",
+                    },
+                )
+            # Branch heads are not resolved while registering the build.
+            mock_resolve_commit_sha.assert_not_called()
+            build = (
+                self.app.config["FOCA"]
+                .db.dbs["pubgradeStore"]
+                .collections["builds"]
+                .client.find_one({"id": res["id"]})
+            )
+            assert "build_key" not in build
+
+    def test_resolve_commit_sha(self):
+        assert resolve_commit_sha(
+            self.repository_url,
+            {"branch": "main", "commit_sha": "8CD58EB"},
+            10,
+        ) == "8cd58eb"
+        ls_remote = MagicMock(
+            return_value="1111111111111111111111111111111111111111\t"
+            "refs/tags/0.4.2\n"
+            "2222222222222222222222222222222222222222\t"
+            "refs/tags/0.4.2^{}"
+        )
+        with patch(
+            "pubgrade.modules.endpoints.builds.Git.ls_remote", ls_remote
+        ):
+            assert resolve_commit_sha(
+                self.repository_url, {"tag": "0.4.2"}, 10
+            ) == "2222222222222222222222222222222222222222"
+        ls_remote = MagicMock(side_effect=GitCommandError("ls-remote"))
+        with patch(
+            "pubgrade.modules.endpoints.builds.Git.ls_remote", ls_remote
+        ):
+            assert resolve_commit_sha(
+                self.repository_url, {"branch": "main"}, 10
+            ) is None
+
+    def test_get_build_key(self):
+        images = [
+            {"name": "akash7778/api:0.0.1", "location": "./Dockerfile"},
+            {"name": "akash7778/web:0.0.1", "location": "web/Dockerfile"},
+        ]
+        build_key = get_build_key("eiic.g", "8cd58eb", images)
+        assert build_key == get_build_key("eiic.g", "8cd58eb", images[::-1])
+        assert build_key != get_build_key("eiic.g", "2222222", images)
+        assert build_key != get_build_key("eiic.g", "8cd58eb", images[:1])
+
     def test_get_builds(self):
         self.setup_with_build()
         with self.app.app_context():
@@ -311,6 +569,274 @@ class TestBuild:
             with pytest.raises(BuildNotFound):
                 get_build_info("abcd")
 
+    def test_get_checkout_reference(self):
+        assert get_checkout_reference(
+            {"branch": "main", "commit_sha": "8cd58eb"}
+        ) == ("main", "8cd58eb")
+        assert get_checkout_reference({"branch": "main"}) == ("main", "")
+        assert get_checkout_reference({"tag": "0.4.2"}) == ("", "0.4.2")
+
+    def test_run_queued_build(self):
+        self.setup_with_build()
+        mock_create_build = MagicMock()
+        with patch(
+            "pubgrade.modules.endpoints.builds.create_build",
+            mock_create_build,
+        ):
+            with self.app.app_context():
+                run_queued_build(
+                    {
+                        "id": MOCK_BUILD_INFO["id"],
+                        "repository_id": MOCK_REPOSITORY_2["id"],
+                    }
+                )
+        kwargs = mock_create_build.call_args[1]
+        assert kwargs["branch"] == "main"
+        assert kwargs["commit"] == MOCK_BUILD_INFO["head_commit"][
+            "commit_sha"]
+        assert kwargs["project_access_token"] == MOCK_REPOSITORY_2[
+            "access_token"]
+        assert kwargs["clone_strategy"] == "full"
+        image = kwargs["images"][0]
+        assert image["index"] == 0
+        assert image["dockerfile_location"] == "./Dockerfile"
+        assert image["cache_repository"] == "ttl.sh/test-updater-cache"
+        assert image["cache_ttl"] == "336h"
+        assert image["timeout"] == 3600
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_BUILD_INFO["id"]})
+        )
+        assert data["status"] == "RUNNING"
+
+    @patch.dict(
+        ENDPOINT_CONFIG["builds"]["skip_existing_images"], {"enabled": True}
+    )
+    @patch(
+        "pubgrade.modules.endpoints.subscriptions.send_notification",
+        mocked_send_notification,
+    )
+    @patch("requests.Session.request", mocked_request_api)
+    def test_run_queued_build_image_exists(self):
+        self.setup_with_build()
+        mock_create_build = MagicMock()
+        mock_remove_files = MagicMock()
+        mock_image_exists = MagicMock(return_value=True)
+        with patch(
+            "pubgrade.modules.endpoints.builds.create_build",
+            mock_create_build,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.remove_files",
+            mock_remove_files,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.intermediate_image_exists",
+            mock_image_exists,
+        ):
+            with self.app.app_context():
+                run_queued_build(
+                    {
+                        "id": MOCK_BUILD_INFO["id"],
+                        "repository_id": MOCK_REPOSITORY_2["id"],
+                    }
+                )
+        assert mock_image_exists.call_args[0][0] == (
+            "ttl.sh/test-updater:"
+            + MOCK_BUILD_INFO["head_commit"]["commit_sha"]
+        )
+        mock_create_build.assert_not_called()
+        mock_remove_files.assert_not_called()
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_BUILD_INFO["id"]})
+        )
+        assert data["status"] == "SUCCEEDED"
+        assert data["images"][0]["image_reused"]
+        assert data["images"][0]["status"] == "SUCCEEDED"
+
+    @patch.dict(
+        ENDPOINT_CONFIG["builds"]["skip_existing_images"], {"enabled": True}
+    )
+    def test_run_queued_build_image_not_found(self):
+        self.setup_with_build()
+        mock_create_build = MagicMock()
+        with patch(
+            "pubgrade.modules.endpoints.builds.create_build",
+            mock_create_build,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.intermediate_image_exists",
+            MagicMock(return_value=False),
+        ):
+            with self.app.app_context():
+                run_queued_build(
+                    {
+                        "id": MOCK_BUILD_INFO["id"],
+                        "repository_id": MOCK_REPOSITORY_2["id"],
+                    }
+                )
+        images = mock_create_build.call_args[1]["images"]
+        assert images[0]["commit_image_path"] == (
+            "ttl.sh/test-updater:"
+            + MOCK_BUILD_INFO["head_commit"]["commit_sha"]
+        )
+
+    def setup_with_multi_image_build(self):
+        self.setup_with_build()
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "builds"
+        ].client.update_one(
+            {"id": MOCK_BUILD_INFO["id"]},
+            {
+                "$set": {
+                    "images": [
+                        {
+                            "name": "akash7778/test-updater:0.0.1",
+                            "location": "./Dockerfile",
+                        },
+                        {
+                            "name": "akash7778/test-worker:0.0.1",
+                            "location": "./worker/Dockerfile",
+                        },
+                    ]
+                }
+            },
+        )
+
+    def test_run_queued_build_multiple_images(self):
+        self.setup_with_multi_image_build()
+        mock_create_build = MagicMock(
+            return_value=["eiic.gngdgrs-0", "eiic.gngdgrs-1"]
+        )
+        with patch(
+            "pubgrade.modules.endpoints.builds.create_build",
+            mock_create_build,
+        ):
+            with self.app.app_context():
+                run_queued_build(
+                    {
+                        "id": MOCK_BUILD_INFO["id"],
+                        "repository_id": MOCK_REPOSITORY_2["id"],
+                    }
+                )
+        mock_create_build.assert_called_once()
+        images = mock_create_build.call_args[1]["images"]
+        assert [image["index"] for image in images] == [0, 1]
+        assert images[1]["dockerfile_location"] == "./worker/Dockerfile"
+        assert images[1]["intermediate_registry_path"] == (
+            "ttl.sh/test-worker:1h"
+        )
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_BUILD_INFO["id"]})
+        )
+        assert data["status"] == "RUNNING"
+        for index, image in enumerate(data["images"]):
+            assert image["status"] == "RUNNING"
+            assert image["pod_name"] == "eiic.gngdgrs-%s" % index
+            assert "started_at" in image
+
+    def test_run_queued_build_build_not_found(self):
+        self.setup()
+        mock_create_build = MagicMock()
+        with patch(
+            "pubgrade.modules.endpoints.builds.create_build",
+            mock_create_build,
+        ):
+            with self.app.app_context():
+                run_queued_build(
+                    {"id": "build12", "repository_id": "eiic.g"}
+                )
+        mock_create_build.assert_not_called()
+
+    def test_get_cache_settings(self):
+        self.setup()
+        with self.app.app_context():
+            assert get_cache_settings(
+                MOCK_REPOSITORY_2, "akash7778/test-updater:0.0.1"
+            ) == ("ttl.sh/test-updater-cache", "336h")
+            assert get_cache_settings(
+                {"cache": {"repository": "ttl.sh/cache", "ttl": "24h"}},
+                "akash7778/test-updater:0.0.1",
+            ) == ("ttl.sh/cache", "24h")
+            assert get_cache_settings(
+                {"cache": {"enabled": False}},
+                "akash7778/test-updater:0.0.1",
+            ) == ("", "")
+
+    def test_parse_cache_stats(self):
+        logs = (
+            "INFO[0002] Using caching version of cmd: RUN pip install .\n"
+            "INFO[0003] Using caching version of cmd: RUN apt-get update\n"
+            "INFO[0004] Using caching version of cmd: RUN mkdir /app\n"
+            "INFO[0005] No cached layer found for cmd RUN make\n"
+        )
+        assert parse_cache_stats(logs) == {
+            "hits": 3,
+            "misses": 1,
+            "hit_ratio": 0.75,
+        }
+        assert parse_cache_stats("")["hit_ratio"] is None
+
+    def test_fail_queued_build(self):
+        self.setup_with_build()
+        with self.app.app_context():
+            fail_queued_build(
+                {"id": MOCK_BUILD_INFO["id"]}, GitCloningError()
+            )
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_BUILD_INFO["id"]})
+        )
+        assert data["status"] == "FAILED"
+        assert data["finished_at"] != "NULL"
+        mock_delete_pod = MagicMock()
+        with patch(
+            "pubgrade.modules.endpoints.builds.delete_pod", mock_delete_pod
+        ):
+            self.run_tasks()
+        mock_delete_pod.assert_called_once_with(
+            "%s-0" % MOCK_BUILD_INFO["id"], "pubgrade-ns"
+        )
+
+    def test_reset_queued_build(self):
+        self.setup()
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "builds"
+        ].client.insert_one(
+            {
+                **MOCK_BUILD_INFO,
+                "images": [
+                    {"name": "akash7778/test-updater:0.0.1"},
+                    {
+                        "name": "akash7778/updater:0.0.1",
+                        "status": "RUNNING",
+                        "pod_name": "%s-1" % MOCK_BUILD_INFO["id"],
+                    },
+                ],
+            }
+        )
+        os.makedirs("%s/%s" % (builds.BASE_DIR, MOCK_BUILD_INFO["id"]))
+        mock_delete_pod = MagicMock()
+        with patch(
+            "pubgrade.modules.endpoints.builds.delete_pod", mock_delete_pod
+        ):
+            with self.app.app_context():
+                reset_queued_build({"id": MOCK_BUILD_INFO["id"]})
+        # Pods of images started by earlier attempts are kept.
+        mock_delete_pod.assert_called_once_with(
+            "%s-0" % MOCK_BUILD_INFO["id"], "pubgrade-ns"
+        )
+        assert not os.path.exists(
+            "%s/%s" % (builds.BASE_DIR, MOCK_BUILD_INFO["id"])
+        )
+
     def test_git_clone_and_checkout(self):
         clone_path = git_clone_and_checkout(
             repo_url=self.repository_url,
@@ -333,6 +859,103 @@ class TestBuild:
         assert clone_path == "./build123/drs-filer"
         shutil.rmtree("./build123")
 
+    def test_git_clone_and_checkout_retried(self):
+        # Checkout left behind by a previous attempt.
+        os.makedirs("./build123/drs-filer/.git")
+        mock_clone_from = MagicMock(side_effect=GitCommandError("clone"))
+        with patch(
+            "pubgrade.modules.endpoints.builds.Repo.clone_from",
+            mock_clone_from,
+        ):
+            with pytest.raises(GitCloningError):
+                git_clone_and_checkout(
+                    repo_url=self.repository_url,
+                    branch="dev",
+                    commit="122c34d",
+                    base_dir=".",
+                    build_id="build123",
+                )
+        mock_clone_from.assert_called_once()
+        # Failed checkouts are removed.
+        assert not os.path.exists("./build123/drs-filer")
+        shutil.rmtree("./build123")
+
+    def test_git_clone_and_checkout_shallow(self):
+        clone_path = git_clone_and_checkout(
+            repo_url=self.repository_url,
+            branch="dev",
+            commit="122c34d",
+            base_dir=".",
+            build_id="build123",
+            strategy="shallow",
+        )
+        assert clone_path == "./build123/drs-filer"
+        assert builds.commit_exists(Repo(clone_path), "122c34d")
+        shutil.rmtree("./build123")
+
+    def test_git_clone_and_checkout_shallow_branch_head(self):
+        clone_path = git_clone_and_checkout(
+            repo_url=self.repository_url,
+            branch="dev",
+            commit="",
+            base_dir=".",
+            build_id="build123",
+            strategy="shallow",
+        )
+        assert os.path.isfile("%s/.git/shallow" % clone_path)
+        shutil.rmtree("./build123")
+
+    def test_git_clone_and_checkout_partial(self):
+        clone_path = git_clone_and_checkout(
+            repo_url=self.repository_url,
+            branch="",
+            commit="122c34d",
+            base_dir=".",
+            build_id="build123",
+            strategy="partial",
+        )
+        assert clone_path == "./build123/drs-filer"
+        shutil.rmtree("./build123")
+
+    def test_git_clone_and_checkout_sparse(self):
+        clone_path = git_clone_and_checkout(
+            repo_url=self.repository_url,
+            branch="dev",
+            commit="122c34d",
+            base_dir=".",
+            build_id="build123",
+            sparse_paths=["drs_filer"],
+        )
+        assert os.path.isdir("%s/drs_filer" % clone_path)
+        assert not os.path.isdir("%s/tests" % clone_path)
+        shutil.rmtree("./build123")
+
+    def test_get_sparse_paths(self):
+        assert get_sparse_paths(
+            "services/api", "./services/api/docker/Dockerfile", ["common/"]
+        ) == ["services/api", "services/api/docker", "common"]
+        assert get_sparse_paths(".", "./Dockerfile", []) == []
+
+    def test_get_sparse_paths_outside_repository(self):
+        with pytest.raises(GitCloningError):
+            get_sparse_paths("services/../..", "./Dockerfile", [])
+
+    def test_git_clone_and_checkout_mirror_cache(self):
+        mirror_cache = MagicMock()
+        mirror_cache.checkout_worktree.return_value = "./build123/drs-filer"
+        clone_path = git_clone_and_checkout(
+            repo_url=self.repository_url,
+            branch="dev",
+            commit="122c34d",
+            base_dir=".",
+            build_id="build123",
+            mirror_cache=mirror_cache,
+        )
+        assert clone_path == "./build123/drs-filer"
+        mirror_cache.checkout_worktree.assert_called_once_with(
+            self.repository_url, "./build123/drs-filer", "122c34d", None
+        )
+
     def test_git_clone_and_checkout_type_error(self):
         with pytest.raises(GitCloningError):
             git_clone_and_checkout(
@@ -383,6 +1006,50 @@ class TestBuild:
         assert os.path.isfile(deployment_file_location)
         shutil.rmtree("./build123")
 
+    def test_create_deployment_yaml_commit_image(self):
+        builds.template_file = (
+            "pubgrade/modules/endpoints/kaniko" "/template.yaml"
+        )
+        os.mkdir("build123")
+        os.mkdir("build123/drs-filer")
+        deployment_file_location = create_deployment_YAML(
+            "./build123/drs-filer/dockerfile_location",
+            "registry_destination:1h",
+            "clone_path",
+            "./build123/drs-filer/deployment_file",
+            "build_id/config.json",
+            "project_access_token",
+            "registry_destination:8cd58eb",
+        )
+        with open(deployment_file_location) as f:
+            args = yaml.safe_load(f)["spec"]["containers"][0]["args"]
+        shutil.rmtree("./build123")
+        assert "--destination=registry_destination:1h" in args
+        assert "--destination=registry_destination:8cd58eb" in args
+
+    def test_create_deployment_yaml_cache(self):
+        builds.template_file = (
+            "pubgrade/modules/endpoints/kaniko" "/template.yaml"
+        )
+        os.mkdir("build123")
+        os.mkdir("build123/drs-filer")
+        deployment_file_location = create_deployment_YAML(
+            "./build123/drs-filer/dockerfile_location",
+            "registry_destination:1h",
+            "clone_path",
+            "./build123/drs-filer/deployment_file",
+            "build_id/config.json",
+            "project_access_token",
+            cache_repository="registry_destination-cache",
+            cache_ttl="336h",
+        )
+        with open(deployment_file_location) as f:
+            args = yaml.safe_load(f)["spec"]["containers"][0]["args"]
+        shutil.rmtree("./build123")
+        assert "--cache=true" in args
+        assert "--cache-repo=registry_destination-cache" in args
+        assert "--cache-ttl=336h" in args
+
     def test_create_deployment_yaml_if_env_present(self):
         os.environ["NAMESPACE"] = "pubgrade"
         builds.template_file = (
@@ -426,6 +1093,70 @@ class TestBuild:
             assert os.path.isfile(deployment_file_location)
             shutil.rmtree("./build123")
 
+    def test_create_pod_spec(self):
+        builds.template_file = (
+            "pubgrade/modules/endpoints/kaniko" "/template.yaml"
+        )
+        pod_spec = create_pod_spec(
+            "clone_path/Dockerfile",
+            "registry_destination:1h",
+            "clone_path",
+            "build123/config.json",
+            "project_access_token",
+            "build123-1",
+            "build123",
+            image_index=1,
+        )
+        assert pod_spec["metadata"]["name"] == "build123-1"
+        assert pod_spec["metadata"]["labels"] == {
+            "app.kubernetes.io/component": "kaniko",
+            "app.kubernetes.io/managed-by": "pubgrade",
+        }
+        env = {
+            var["name"]: var["value"]
+            for var in pod_spec["spec"]["containers"][0]["env"]
+        }
+        assert env["BUILDNAME"] == "build123"
+        assert env["ACCESSTOKEN"] == "project_access_token"
+        assert env["NAMESPACE"] == "default"
+        assert env["PUBGRADE_PORT"] == "8080"
+        assert env["IMAGE_INDEX"] == "1"
+        assert "annotations" not in pod_spec["metadata"]
+        assert {
+            "mountPath": "/kaniko/.docker/config.json",
+            "name": "pv-storage",
+            "subPath": "build123/config.json",
+        } in pod_spec["spec"]["containers"][0]["volumeMounts"]
+
+    def test_create_pod_spec_timeout(self):
+        builds.template_file = (
+            "pubgrade/modules/endpoints/kaniko" "/template.yaml"
+        )
+        pod_spec = create_pod_spec(
+            "clone_path/Dockerfile",
+            "registry_destination:1h",
+            "clone_path",
+            "build123/config.json",
+            "project_access_token",
+            "build123-0",
+            "build123",
+            timeout=1800,
+        )
+        assert pod_spec["metadata"]["annotations"] == {
+            "pubgrade/timeout-seconds": "1800"
+        }
+
+    def test_get_pod_template(self):
+        builds.template_file = (
+            "pubgrade/modules/endpoints/kaniko" "/template.yaml"
+        )
+        load_pod_template.cache_clear()
+        pod_template = get_pod_template()
+        pod_template["spec"]["containers"][0]["env"].clear()
+        # Template is parsed once and every caller gets its own copy.
+        assert get_pod_template()["spec"]["containers"][0]["env"]
+        assert load_pod_template.cache_info().misses == 1
+
     def test_create_dockerhub_config_file(self):
         create_dockerhub_config_file("token", "config.json")
         assert os.path.isfile("config.json")
@@ -444,23 +1175,35 @@ class TestBuild:
         f = open("basedir/drs-filer/Dockerfile", "w")
         f.write("test dockerfile")
         f.close()
-        create_build(
+        pod_names = create_build(
             repo_url=self.repository_url,
             branch="dev",
             commit="122c34d",
             base_dir="basedir",
             build_id="build123",
-            dockerfile_location="basedir/drs-filer/Dockerfile",
-            intermediate_registry_path="test_intermediate_registry_path",
+            images=[
+                {
+                    "index": 0,
+                    "dockerfile_location": "basedir/drs-filer/Dockerfile",
+                    "intermediate_registry_path": "test_intermediate_path",
+                },
+                {
+                    "index": 1,
+                    "dockerfile_location": "basedir/drs-filer/Dockerfile",
+                    "intermediate_registry_path": "test_intermediate_path",
+                },
+            ],
             dockerhub_token="dockerhub_token",
             project_access_token="access_token",
         )
+        assert pod_names == ["build123-0", "build123-1"]
+        assert not os.path.isfile("basedir/build123/build123-1.yaml")
         shutil.rmtree("basedir")
 
     @patch(
         "pubgrade.modules.endpoints.builds.remove_files", mocked_remove_files
     )
-    @patch("requests.request", mocked_request_api)
+    @patch("requests.Session.request", mocked_request_api)
     def test_build_completed(self):
         self.setup_with_build()
         self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
@@ -484,6 +1227,534 @@ class TestBuild:
             assert data["status"] == "SUCCEEDED"
             assert res["id"] == MOCK_REPOSITORY_2["build_list"][0]
 
+    @patch(
+        "pubgrade.modules.endpoints.builds.remove_files", mocked_remove_files
+    )
+    @patch(
+        "pubgrade.modules.endpoints.subscriptions.send_notification",
+        mocked_send_notification,
+    )
+    @patch("requests.Session.request", mocked_request_api)
+    def test_build_completed_cache_stats(self):
+        self.setup_with_build()
+        cache_stats = {"hits": 3, "misses": 1, "hit_ratio": 0.75}
+        with patch(
+            "pubgrade.modules.endpoints.builds.get_cache_stats",
+            MagicMock(return_value=cache_stats),
+        ), patch(
+            "pubgrade.modules.endpoints.builds.delete_pod", mocked_delete_pod
+        ):
+            with self.app.app_context():
+                res = build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_REPOSITORY_2["build_list"][0],
+                    MOCK_REPOSITORY_2["access_token"],
+                )
+            self.run_tasks()
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one(res)
+        )
+        assert data["images"][0]["cache"] == cache_stats
+
+    @patch(
+        "pubgrade.modules.endpoints.builds.remove_files", mocked_remove_files
+    )
+    @patch("pubgrade.modules.endpoints.builds.delete_pod", mocked_delete_pod)
+    @patch("requests.Session.request", mocked_request_api)
+    def test_build_completed_multiple_images(self):
+        self.setup_with_multi_image_build()
+        mock_notify = MagicMock()
+        builds_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        with patch(
+            "pubgrade.modules.endpoints.subscriptions"
+            ".send_notification",
+            mock_notify,
+        ):
+            with self.app.app_context():
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                    1,
+                )
+                data = builds_collection.find_one(
+                    {"id": MOCK_BUILD_INFO["id"]}
+                )
+                assert data["images"][1]["status"] == "SUCCEEDED"
+                assert data["status"] != "SUCCEEDED"
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                    0,
+                )
+                # Repeated completion of an image is a no-op.
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                    0,
+                )
+            # Subscriptions are notified in the background.
+            mock_notify.assert_not_called()
+            self.run_tasks()
+        data = builds_collection.find_one({"id": MOCK_BUILD_INFO["id"]})
+        assert data["status"] == "SUCCEEDED"
+        assert data["images_succeeded"] == 2
+        for image in data["images"]:
+            assert image["notifications"][0]["subscription_id"] == "tnglot"
+            assert image["notifications"][0]["status"] == "SENT"
+        notified = [call[0][1] for call in mock_notify.call_args_list]
+        assert notified == [
+            "akash7778/test-worker:0.0.1",
+            "akash7778/test-updater:0.0.1",
+        ]
+
+    @patch(
+        "pubgrade.modules.endpoints.builds.remove_files", mocked_remove_files
+    )
+    @patch("pubgrade.modules.endpoints.builds.delete_pod", mocked_delete_pod)
+    @patch("requests.Session.request", mocked_request_api)
+    def test_build_completed_notification_failures(self):
+        self.setup_with_build()
+        subscriptions_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["subscriptions"]
+            .client
+        )
+        for subscription_id, value in [("sub123", "main"), ("sub456", "dev")]:
+            subscriptions_collection.insert_one(
+                {
+                    **MOCK_SUBSCRIPTION_INFO,
+                    "_id": subscription_id,
+                    "id": subscription_id,
+                    "value": value,
+                    "callback_url": "https://broken.example.org/update",
+                }
+            )
+
+        def send(subscription, image, build_id, deactivate=True):
+            if subscription["id"] == "sub123":
+                raise RequestNotSent
+
+        mock_send = MagicMock(side_effect=send)
+        with patch(
+            "pubgrade.modules.endpoints.subscriptions.send_notification",
+            mock_send,
+        ):
+            with self.app.app_context():
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                )
+            self.run_tasks()
+        # One failure does not keep the others from being notified;
+        # subscriptions to other branches are not notified at all. Failed
+        # notifications are retried until the circuit breaker of their
+        # callback host opens.
+        assert mock_send.call_count == 3
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_BUILD_INFO["id"]})
+        )
+        assert data["status"] == "SUCCEEDED"
+        notifications = {
+            notification["subscription_id"]: notification
+            for notification in data["images"][0]["notifications"]
+        }
+        assert notifications["tnglot"]["status"] == "SENT"
+        assert notifications["sub123"]["status"] == "PENDING"
+        assert notifications["sub123"]["attempts"] == 2
+        assert "sub456" not in notifications
+        with self.app.app_context():
+            states = callback_hosts.get_callback_hosts().get_states()
+        assert states["broken.example.org"]["state"] == "OPEN"
+        delivery = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["notification_outbox"]
+            .client.find_one()
+        )
+        # Postponed until the host is probed again.
+        assert delivery["subscription_id"] == "sub123"
+        assert delivery["attempts"] == 2
+        assert delivery["run_after"] > datetime.datetime.utcnow()
+
+    def test_build_completed_subscription_updates(self):
+        self.setup_with_build()
+        subscriptions_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["subscriptions"]
+            .client
+        )
+        subscriptions_collection.update_one(
+            {"id": MOCK_SUBSCRIPTION_INFO["id"]},
+            {"$unset": {"callback_url": ""}},
+        )
+        mock_send = MagicMock()
+        with patch(
+            "pubgrade.modules.endpoints.subscriptions.send_notification",
+            mock_send,
+        ):
+            with self.app.app_context():
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                )
+            self.run_tasks()
+        # Subscriptions without callback URL poll for updates instead.
+        mock_send.assert_not_called()
+        update = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["subscription_updates"]
+            .client.find_one()
+        )
+        assert update["subscription_id"] == MOCK_SUBSCRIPTION_INFO["id"]
+        assert update["seq"] == 1
+        assert update["build_id"] == MOCK_BUILD_INFO["id"]
+
+    @patch(
+        "pubgrade.modules.endpoints.subscriptions.send_notification",
+        mocked_send_notification,
+    )
+    def test_build_completed_repeated(self):
+        self.setup_with_build()
+        mock_trigger_signing_image = MagicMock()
+        mock_delete_pod = MagicMock(side_effect=DeletePodError)
+        with patch(
+            "pubgrade.modules.endpoints.builds.trigger_signing_image",
+            mock_trigger_signing_image,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.delete_pod",
+            mock_delete_pod,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.get_cache_stats",
+            MagicMock(return_value=None),
+        ):
+            with self.app.app_context():
+                for _ in range(3):
+                    res = build_completed(
+                        MOCK_REPOSITORY_2["id"],
+                        MOCK_BUILD_INFO["id"],
+                        MOCK_REPOSITORY_2["access_token"],
+                    )
+                    assert res == {"id": MOCK_BUILD_INFO["id"]}
+            self.run_tasks()
+        mock_trigger_signing_image.assert_called_once()
+        # Failed cleanup is retried and does not fail the build.
+        assert mock_delete_pod.call_count == 5
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_BUILD_INFO["id"]})
+        )
+        assert data["status"] == "SUCCEEDED"
+        assert data["images_succeeded"] == 1
+        steps = data["images"][0]["steps"]
+        assert steps["sign"]["status"] == "SUCCEEDED"
+        assert steps["cleanup"]["status"] == "FAILED"
+        assert steps["cleanup"]["attempts"] == 5
+
+    def test_build_completed_steps_not_queued(self):
+        self.setup_with_build()
+        mock_trigger_signing_image = MagicMock()
+        mock_delete_pod = MagicMock()
+        builds_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        with patch(
+            "pubgrade.modules.endpoints.builds.trigger_signing_image",
+            mock_trigger_signing_image,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.delete_pod",
+            mock_delete_pod,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.get_cache_stats",
+            MagicMock(return_value=None),
+        ):
+            with self.app.app_context():
+                # The API stops before the steps are queued.
+                with patch(
+                    "pubgrade.modules.endpoints.builds.enqueue_task",
+                    MagicMock(side_effect=SystemExit),
+                ):
+                    with pytest.raises(SystemExit):
+                        build_completed(
+                            MOCK_REPOSITORY_2["id"],
+                            MOCK_BUILD_INFO["id"],
+                            MOCK_REPOSITORY_2["access_token"],
+                        )
+                data = builds_collection.find_one(
+                    {"id": MOCK_BUILD_INFO["id"]}
+                )
+                assert data["status"] == "SUCCEEDED"
+                assert data["pending_steps"] == 3
+                assert data["images"][0]["steps"]["sign"]["status"] == (
+                    "PENDING"
+                )
+            pool = TaskWorkerPool(
+                self.app,
+                handlers={
+                    "sign": builds.sign_image,
+                    "cleanup": builds.clean_up_image,
+                    "notify": builds.notify_subscriptions_of_image,
+                },
+                claim_timeout=0,
+            )
+            while pool.run_once("worker-1"):
+                pass
+        mock_trigger_signing_image.assert_called_once()
+        mock_delete_pod.assert_called_once()
+        data = builds_collection.find_one({"id": MOCK_BUILD_INFO["id"]})
+        assert data["pending_steps"] == 0
+        steps = data["images"][0]["steps"]
+        assert steps["sign"]["status"] == "SUCCEEDED"
+        assert steps["cleanup"]["status"] == "SUCCEEDED"
+        assert steps["notify"]["status"] == "SUCCEEDED"
+
+    @patch(
+        "pubgrade.modules.endpoints.builds.remove_files", mocked_remove_files
+    )
+    @patch("requests.Session.request", mocked_request_api)
+    def test_build_completed_notifications_retried(self):
+        self.setup_with_build()
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "subscriptions"
+        ].client = mongomock.MongoClient().db.collection
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "subscriptions"
+        ].client.insert_one(
+            {
+                **MOCK_SUBSCRIPTION_INFO,
+                "callback_url": "https://example.org/update",
+            }
+        )
+        builds_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        mock_send = MagicMock()
+        add_notifications = builds.add_notifications
+        attempts = []
+
+        # Writing to the outbox fails once.
+        def add_notifications_once(*args, **kwargs):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise Exception("outbox unavailable")
+            add_notifications(*args, **kwargs)
+
+        with patch(
+            "pubgrade.modules.endpoints.subscriptions.send_notification",
+            mock_send,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.add_notifications",
+            add_notifications_once,
+        ):
+            with self.app.app_context():
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                )
+                data = builds_collection.find_one(
+                    {"id": MOCK_BUILD_INFO["id"]}
+                )
+                assert data["status"] == "SUCCEEDED"
+                assert data["images"][0]["steps"]["notify"]["status"] == (
+                    "PENDING"
+                )
+            pool = TaskWorkerPool(
+                self.app,
+                handlers={
+                    "sign": builds.sign_image,
+                    "cleanup": builds.clean_up_image,
+                    "notify": builds.notify_subscriptions_of_image,
+                },
+                claim_timeout=0,
+            )
+            while pool.run_once("worker-1"):
+                pass
+            self.run_tasks()
+        assert len(attempts) == 2
+        mock_send.assert_called_once()
+        data = builds_collection.find_one({"id": MOCK_BUILD_INFO["id"]})
+        assert data["pending_steps"] == 0
+        assert data["images"][0]["steps"]["notify"]["status"] == "SUCCEEDED"
+        assert data["images"][0]["notifications"][0]["status"] == "SENT"
+        # The update log is written once although notifying was repeated.
+        assert (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["subscription_updates"]
+            .client.count_documents({"build_id": MOCK_BUILD_INFO["id"]})
+            == 1
+        )
+
+    def test_build_completed_failed(self):
+        self.setup_with_multi_image_build()
+        builds_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        builds_collection.update_one(
+            {"id": MOCK_BUILD_INFO["id"]},
+            {
+                "$set": {
+                    "status": "RUNNING",
+                    "images.0.status": "RUNNING",
+                    "images.0.pod_name": "eiic.gngdgrs-0",
+                    "images.1.status": "RUNNING",
+                    "images.1.pod_name": "eiic.gngdgrs-1",
+                }
+            },
+        )
+        mock_delete_pod = MagicMock()
+        mock_trigger_signing_image = MagicMock()
+        with patch(
+            "pubgrade.modules.endpoints.builds.delete_pod", mock_delete_pod
+        ), patch(
+            "pubgrade.modules.endpoints.builds.trigger_signing_image",
+            mock_trigger_signing_image,
+        ):
+            with self.app.app_context():
+                for _ in range(2):
+                    res = build_completed(
+                        MOCK_REPOSITORY_2["id"],
+                        MOCK_BUILD_INFO["id"],
+                        MOCK_REPOSITORY_2["access_token"],
+                        1,
+                        "FAILED",
+                        "Error",
+                        1,
+                    )
+                    assert res == {"id": MOCK_BUILD_INFO["id"]}
+                # Images of failed builds are not completed anymore.
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                    0,
+                )
+            mock_delete_pod.assert_not_called()
+            self.run_tasks()
+        assert [call[0][0] for call in mock_delete_pod.call_args_list] == [
+            "eiic.gngdgrs-1",
+            "eiic.gngdgrs-0",
+        ]
+        mock_trigger_signing_image.assert_not_called()
+        data = builds_collection.find_one({"id": MOCK_BUILD_INFO["id"]})
+        assert data["status"] == "FAILED"
+        assert data["error"] == "Error"
+        assert "active_build_key" not in data
+        assert data["images"][1]["status"] == "FAILED"
+        assert data["images"][1]["exit_code"] == 1
+        assert data["images"][0]["status"] == "FAILED"
+
+    def test_build_completed_failed_sibling_succeeded(self):
+        self.setup_with_multi_image_build()
+        builds_collection = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        builds_collection.update_one(
+            {"id": MOCK_BUILD_INFO["id"]},
+            {
+                "$set": {
+                    "status": "RUNNING",
+                    "images.0.status": "RUNNING",
+                    "images.0.pod_name": "eiic.gngdgrs-0",
+                    "images.1.status": "RUNNING",
+                    "images.1.pod_name": "eiic.gngdgrs-1",
+                }
+            },
+        )
+        find_one_and_update = builds_collection.find_one_and_update
+
+        def fail_and_complete_sibling(*args, **kwargs):
+            data = find_one_and_update(*args, **kwargs)
+            # Image 0 succeeds after the failed image was recorded, but
+            # before its siblings are.
+            builds_collection.update_one(
+                {"id": MOCK_BUILD_INFO["id"]},
+                {"$set": {"images.0.status": "SUCCEEDED"}},
+            )
+            return data
+
+        mock_delete_pod = MagicMock()
+        with patch.object(
+            builds_collection,
+            "find_one_and_update",
+            fail_and_complete_sibling,
+        ), patch(
+            "pubgrade.modules.endpoints.builds.delete_pod", mock_delete_pod
+        ):
+            with self.app.app_context():
+                build_completed(
+                    MOCK_REPOSITORY_2["id"],
+                    MOCK_BUILD_INFO["id"],
+                    MOCK_REPOSITORY_2["access_token"],
+                    1,
+                    "FAILED",
+                    "Error",
+                    1,
+                )
+            self.run_tasks()
+        data = builds_collection.find_one({"id": MOCK_BUILD_INFO["id"]})
+        assert data["status"] == "FAILED"
+        assert data["images"][1]["status"] == "FAILED"
+        assert data["images"][0]["status"] == "SUCCEEDED"
+        assert "reason" not in data["images"][0]
+        mock_delete_pod.assert_called_once_with(
+            "eiic.gngdgrs-1", "pubgrade-ns"
+        )
+
+    def test_build_completed_timed_out(self):
+        self.setup_with_build()
+        with self.app.app_context():
+            build_completed(
+                MOCK_REPOSITORY_2["id"],
+                MOCK_BUILD_INFO["id"],
+                MOCK_REPOSITORY_2["access_token"],
+                status="TIMED_OUT",
+                reason="Build exceeded timeout of 3600s.",
+            )
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_BUILD_INFO["id"]})
+        )
+        assert data["status"] == "TIMED_OUT"
+        assert data["images"][0]["status"] == "TIMED_OUT"
+        assert data["images"][0]["exit_code"] is None
+        assert data["images"][0]["steps"]["cleanup"]["status"] == "QUEUED"
+
     def test_build_completed_build_not_found(self):
         self.setup_with_build()
         with self.app.app_context():
@@ -514,12 +1785,107 @@ class TestBuild:
                     MOCK_REPOSITORY_2["access_token"],
                 )
 
+    @patch(
+        "pubgrade.modules.endpoints.builds.remove_files", mocked_remove_files
+    )
+    @patch("pubgrade.modules.endpoints.builds.delete_pod", mocked_delete_pod)
+    @patch(
+        "pubgrade.modules.endpoints.builds.get_cache_stats",
+        MagicMock(return_value=None),
+    )
+    @patch("requests.Session.request", mocked_request_api)
+    def test_complete_builds(self):
+        self.setup_with_build()
+        completion = {
+            "repository_id": MOCK_REPOSITORY_2["id"],
+            "build_id": MOCK_REPOSITORY_2["build_list"][0],
+            "access_token": MOCK_REPOSITORY_2["access_token"],
+        }
+        with self.app.app_context():
+            res = complete_builds(
+                [
+                    completion,
+                    {**completion, "access_token": "123"},
+                    {**completion, "build_id": "build12"},
+                    {**completion, "repository_id": "repo125"},
+                ]
+            )
+        assert [result["status_code"] for result in res["results"]] == [
+            200,
+            401,
+            404,
+            404,
+        ]
+        assert "error" not in res["results"][0]
+        assert res["results"][2]["build_id"] == "build12"
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_REPOSITORY_2["build_list"][0]})
+        )
+        assert data["status"] == "SUCCEEDED"
+
+    @patch(
+        "pubgrade.modules.endpoints.builds.remove_files", mocked_remove_files
+    )
+    @patch("pubgrade.modules.endpoints.builds.delete_pod", mocked_delete_pod)
+    @patch("requests.Session.request", mocked_request_api)
+    def test_complete_builds_failed(self):
+        self.setup_with_build()
+        with self.app.app_context():
+            res = complete_builds(
+                [
+                    {
+                        "repository_id": MOCK_REPOSITORY_2["id"],
+                        "build_id": MOCK_REPOSITORY_2["build_list"][0],
+                        "access_token": MOCK_REPOSITORY_2["access_token"],
+                        "image_index": 0,
+                        "status": "FAILED",
+                        "reason": "Error",
+                        "exit_code": 1,
+                    }
+                ]
+            )
+        assert res["results"][0]["status_code"] == 200
+        data = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client.find_one({"id": MOCK_REPOSITORY_2["build_list"][0]})
+        )
+        assert data["status"] == "FAILED"
+        assert data["images"][0]["exit_code"] == 1
+
+    def test_trigger_signing_image_error_status(self):
+        self.setup()
+        response = requests.Response()
+        response.status_code = 422
+        mock_request = MagicMock(return_value=response)
+        with patch("requests.Session.request", mock_request):
+            with self.app.app_context():
+                with pytest.raises(SigningError):
+                    trigger_signing_image(
+                        cosign_private_key="key",
+                        cosign_password="password",
+                        dockerhub_token=MOCK_BUILD_INFO["dockerhub_token"],
+                        image_path="akash7778/test-updater:0.0.1",
+                        pull_tag="ttl.sh/test-updater:1h",
+                        push_tag="akash7778/test-updater:0.0.1",
+                    )
+        # Dispatches are not idempotent and only retried if rate limited.
+        mock_request.assert_called_once()
+
     @patch("pubgrade.modules.endpoints.builds.delete_pod", mocked_delete_pod)
     def test_remove_files(self):
         os.mkdir("build123")
         remove_files("build123", "pod_name", "namespace")
         assert not os.path.isdir("build123")
 
+    @patch(
+        "pubgrade.modules.endpoints.builds.get_kubernetes_client",
+        KubernetesClient,
+    )
     @patch("kubernetes.config.load_kube_config", mocked_load_cluster_config)
     @patch(
         "kubernetes.client.api.core_v1_api.CoreV1Api.create_namespaced_pod",
@@ -536,6 +1902,10 @@ class TestBuild:
             build_push_image_using_kaniko(builds.template_file)
         del os.environ["NAMESPACE"]
 
+    @patch(
+        "pubgrade.modules.endpoints.builds.get_kubernetes_client",
+        KubernetesClient,
+    )
     @patch(
         "kubernetes.config.kube_config.load_kube_config",
         mocked_load_kube_config,
@@ -559,6 +1929,37 @@ class TestBuild:
             with pytest.raises(CreatePodError):
                 build_push_image_using_kaniko(builds.template_file)
 
+    @patch(
+        "pubgrade.modules.endpoints.builds.get_kubernetes_client",
+        KubernetesClient,
+    )
+    @patch(
+        "kubernetes.config.kube_config.load_kube_config",
+        mocked_load_kube_config,
+    )
+    @patch(
+        "kubernetes.client.api.core_v1_api.CoreV1Api.create_namespaced_pod",
+        mocked_create_namespaced_pod_conflict,
+    )
+    @patch(
+        "kubernetes.config.kube_config._get_kube_config_loader",
+        mocked_get_kube_config_loader,
+    )
+    @patch(
+        "kubernetes.config.kube_config.KubeConfigLoader", MockKubeConfigLoader
+    )
+    def test_build_push_image_using_kaniko_pod_exists(self):
+        builds.template_file = (
+            "pubgrade/modules/endpoints/kaniko" "/template.yaml"
+        )
+        with self.app.app_context():
+            build_push_image_using_kaniko(builds.template_file)
+
+    @patch(
+        "pubgrade.modules.endpoints.builds.get_kubernetes_client",
+        KubernetesClient,
+    )
+    @patch("kubernetes.config.load_kube_config", mocked_load_cluster_config)
     @patch("kubernetes.client.api.core_v1_api.CoreV1Api", mocked_core_v1_api)
     @patch(
         "kubernetes.client.api.core_v1_api.CoreV1Api" ".delete_namespaced_pod",
@@ -568,6 +1969,11 @@ class TestBuild:
         with self.app.app_context():
             builds.delete_pod("name", "namespace")
 
+    @patch(
+        "pubgrade.modules.endpoints.builds.get_kubernetes_client",
+        KubernetesClient,
+    )
+    @patch("kubernetes.config.load_kube_config", mocked_load_cluster_config)
     @patch("kubernetes.client.api.core_v1_api.CoreV1Api", mocked_core_v1_api)
     @patch(
         "kubernetes.client.api.core_v1_api.CoreV1Api" ".delete_namespaced_pod",
@@ -578,6 +1984,10 @@ class TestBuild:
             with pytest.raises(DeletePodError):
                 builds.delete_pod("name", "namespace")
 
+    @patch(
+        "pubgrade.modules.endpoints.builds.get_kubernetes_client",
+        KubernetesClient,
+    )
     @patch(
         "kubernetes.config.load_incluster_config", mocked_load_incluster_config
     )
@@ -49,6 +49,25 @@ class TestRepository:
             assert "access_token" in res
             assert isinstance(res, dict)
 
+    def test_register_repository_with_settings(self):
+        self.setup()
+        data = {
+            "url": self.repository_url,
+            "clone_strategy": "shallow",
+            "cache": {"enabled": False},
+        }
+        with self.app.app_context():
+            res = register_repository(data=data)
+            assert set(res) == {"id", "access_token"}
+            repository = (
+                self.app.config["FOCA"]
+                .db.dbs["pubgradeStore"]
+                .collections["repositories"]
+                .client.find_one({"id": res["id"]})
+            )
+            assert repository["clone_strategy"] == "shallow"
+            assert repository["cache"] == {"enabled": False}
+
     def test_register_repository_url_not_found(self):
         self.setup()
         data = {}
@@ -1,6 +1,8 @@
 """Tests for /subscriptions endpoint """
 from unittest.mock import patch, MagicMock
 
+import datetime
+
 import mongomock
 import pytest
 import requests
@@ -13,17 +15,22 @@ from pubgrade.errors.exceptions import (
     RepositoryNotFound,
     UserNotFound,
     SubscriptionNotFound,
-    BuildNotFound,
     RequestNotSent,
     UserNotVerified,
 )
+import pubgrade.modules.callback_hosts as callback_hosts
 from pubgrade.modules.endpoints.subscriptions import (
+    add_subscription_updates,
+    get_subscription_updates,
     register_subscription,
     get_subscriptions,
     get_subscription_info,
     delete_subscription,
-    notify_subscriptions,
+    deliver_notification,
+    find_matching_subscriptions,
+    send_notification,
 )
+from pubgrade.modules.outbox import DeliveryDeferred
 from tests.mock_data import (
     MONGO_CONFIG,
     ENDPOINT_CONFIG,
@@ -38,22 +45,30 @@ from tests.mock_data import (
 )
 
 
-def mocked_request_api(method, url, data, headers):
-    return "successful"
+def mocked_request_api(self, method, url, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    return response
 
 
-def mocked_request_api_timeout_error(method, url, data, headers):
+def mocked_request_api_timeout_error(self, method, url, **kwargs):
     raise requests.exceptions.Timeout
 
 
-def mocked_request_api_too_many_redirects(method, url, data, headers):
+def mocked_request_api_too_many_redirects(self, method, url, **kwargs):
     raise requests.exceptions.TooManyRedirects
 
 
-def mocked_request_api_request_exception(method, url, data, headers):
+def mocked_request_api_request_exception(self, method, url, **kwargs):
     raise requests.exceptions.RequestException
 
 
+def mocked_request_api_error_status(self, method, url, **kwargs):
+    response = requests.Response()
+    response.status_code = 404
+    return response
+
+
 class TestSubscriptions:
     app = Flask(__name__)
 
@@ -89,6 +104,13 @@ class TestSubscriptions:
         self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
             "users"
         ].client.insert_one(MOCK_USER_NOT_VERIFIED)
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "subscription_updates"
+        ].client = mongomock.MongoClient().db.collection
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "callback_hosts"
+        ].client = mongomock.MongoClient().db.collection
+        callback_hosts._callback_hosts = None
 
     def insert_subscription(self):
         self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
@@ -355,13 +377,120 @@ class TestSubscriptions:
                     MOCK_SUBSCRIPTION_INFO["id"],
                 )
 
-    @patch("requests.request", mocked_request_api)
-    def test_notify_subscriptions(self):
+    def test_get_subscription_updates(self):
         self.setup()
         self.insert_subscription()
         with self.app.app_context():
-            notify_subscriptions(
+            for build_id in [MOCK_BUILD_INFO["id"], MOCK_BUILD_INFO_2["id"]]:
+                add_subscription_updates(
+                    build_id,
+                    "akash7778/test-updater:0.0.1",
+                    [MOCK_SUBSCRIPTION_INFO, {"id": "deleted"}],
+                )
+            res = get_subscription_updates(
+                MOCK_USER["uid"],
+                MOCK_USER["user_access_token"],
+                MOCK_SUBSCRIPTION_INFO["id"],
+            )
+            assert [update["seq"] for update in res["updates"]] == [1, 2]
+            assert res["updates"][1]["build_id"] == MOCK_BUILD_INFO_2["id"]
+            assert res["cursor"] == 2
+            res = get_subscription_updates(
+                MOCK_USER["uid"],
+                MOCK_USER["user_access_token"],
                 MOCK_SUBSCRIPTION_INFO["id"],
+                since=2,
+                wait=0.01,
+            )
+            assert res == {"updates": [], "cursor": 2}
+
+    def test_get_subscription_updates_missing_update(self):
+        self.setup()
+        self.insert_subscription()
+        updates = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["subscription_updates"]
+            .client
+        )
+        now = datetime.datetime.utcnow()
+        for seq, created_at in [
+            (1, now - datetime.timedelta(minutes=1)),
+            (3, now - datetime.timedelta(minutes=1)),
+            (5, now),
+        ]:
+            updates.insert_one(
+                {
+                    "subscription_id": MOCK_SUBSCRIPTION_INFO["id"],
+                    "seq": seq,
+                    "build_id": MOCK_BUILD_INFO["id"],
+                    "image": "akash7778/test-updater:0.0.1",
+                    "created_at": created_at,
+                }
+            )
+        with self.app.app_context():
+            res = get_subscription_updates(
+                MOCK_USER["uid"],
+                MOCK_USER["user_access_token"],
+                MOCK_SUBSCRIPTION_INFO["id"],
+            )
+        # Update 4 may still be written; update 2 was given up on.
+        assert [update["seq"] for update in res["updates"]] == [1, 3]
+        assert res["cursor"] == 3
+
+    def test_get_subscription_updates_subscription_not_found(self):
+        self.setup()
+        with self.app.app_context():
+            with pytest.raises(SubscriptionNotFound):
+                get_subscription_updates(
+                    MOCK_USER["uid"],
+                    MOCK_USER["user_access_token"],
+                    MOCK_SUBSCRIPTION_INFO["id"],
+                )
+
+    def test_find_matching_subscriptions(self):
+        self.setup()
+        subscriptions = [
+            ("branch_main", "eiic.g", "branch", "main"),
+            ("tag_1", "eiic.g", "tag", "1.0.0"),
+            ("branch_dev", "eiic.g", "branch", "dev"),
+            ("other_repository", "repo12", "branch", "main"),
+        ]
+        for subscription_id, repository_id, type, value in subscriptions:
+            self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+                "subscriptions"
+            ].client.insert_one(
+                {
+                    "id": subscription_id,
+                    "repository_id": repository_id,
+                    "type": type,
+                    "value": value,
+                }
+            )
+        build = {
+            "head_commit": {"branch": "main"},
+            "head_commit_aliases": [{"tag": "1.0.0"}],
+        }
+        with self.app.app_context():
+            subscription_ids = [
+                subscription["id"]
+                for subscription in find_matching_subscriptions(
+                    "eiic.g", build
+                )
+            ]
+            assert sorted(subscription_ids) == ["branch_main", "tag_1"]
+            assert (
+                find_matching_subscriptions("eiic.g", {"head_commit": {}})
+                == []
+            )
+
+    @patch("requests.Session.request", mocked_request_api)
+    def test_send_notification(self):
+        self.setup()
+        self.insert_subscription()
+        with self.app.app_context():
+            send_notification(
+                MOCK_SUBSCRIPTION_INFO,
                 "elixir-cloud-aai/pubgrade:0.0.1",
                 MOCK_BUILD_INFO["id"],
             )
@@ -375,38 +504,33 @@ class TestSubscriptions:
             assert data["state"] == "Active"
             assert data["build_id"] == MOCK_BUILD_INFO["id"]
 
-    @patch("requests.request", mocked_request_api)
-    def test_notify_subscriptions_subscription_not_found(self):
+    @patch("requests.Session.request", mocked_request_api_timeout_error)
+    def test_send_notification_timeout(self):
         self.setup()
         self.insert_subscription()
         with self.app.app_context():
-            with pytest.raises(SubscriptionNotFound):
-                notify_subscriptions(
-                    "id",
+            with pytest.raises(RequestNotSent):
+                send_notification(
+                    MOCK_SUBSCRIPTION_INFO,
                     "elixir-cloud-aai/pubgrade:0.0.1",
                     MOCK_BUILD_INFO["id"],
                 )
+            data = (
+                self.app.config["FOCA"]
+                .db.dbs["pubgradeStore"]
+                .collections["subscriptions"]
+                .client.find_one({"id": MOCK_SUBSCRIPTION_INFO["id"]})
+            )
+            assert data["state"] == "Inactive"
 
-    @patch("requests.request", mocked_request_api)
-    def test_notify_subscriptions_build_not_found(self):
-        self.setup()
-        self.insert_subscription()
-        with self.app.app_context():
-            with pytest.raises(BuildNotFound):
-                notify_subscriptions(
-                    MOCK_SUBSCRIPTION_INFO["id"],
-                    "elixir-cloud-aai/pubgrade:0.0.1",
-                    "id",
-                )
-
-    @patch("requests.request", mocked_request_api_timeout_error)
-    def test_notify_subscriptions_timeout(self):
+    @patch("requests.Session.request", mocked_request_api_too_many_redirects)
+    def test_send_notification_too_many_redirects(self):
         self.setup()
         self.insert_subscription()
         with self.app.app_context():
             with pytest.raises(RequestNotSent):
-                notify_subscriptions(
-                    MOCK_SUBSCRIPTION_INFO["id"],
+                send_notification(
+                    MOCK_SUBSCRIPTION_INFO,
                     "elixir-cloud-aai/pubgrade:0.0.1",
                     MOCK_BUILD_INFO["id"],
                 )
@@ -418,14 +542,14 @@ class TestSubscriptions:
             )
             assert data["state"] == "Inactive"
 
-    @patch("requests.request", mocked_request_api_too_many_redirects)
-    def test_notify_subscriptions_too_many_redirects(self):
+    @patch("requests.Session.request", mocked_request_api_request_exception)
+    def test_send_notification_request_exception(self):
         self.setup()
         self.insert_subscription()
         with self.app.app_context():
             with pytest.raises(RequestNotSent):
-                notify_subscriptions(
-                    MOCK_SUBSCRIPTION_INFO["id"],
+                send_notification(
+                    MOCK_SUBSCRIPTION_INFO,
                     "elixir-cloud-aai/pubgrade:0.0.1",
                     MOCK_BUILD_INFO["id"],
                 )
@@ -437,14 +561,14 @@ class TestSubscriptions:
             )
             assert data["state"] == "Inactive"
 
-    @patch("requests.request", mocked_request_api_request_exception)
-    def test_notify_subscriptions_request_exception(self):
+    @patch("requests.Session.request", mocked_request_api_error_status)
+    def test_send_notification_error_status(self):
         self.setup()
         self.insert_subscription()
         with self.app.app_context():
             with pytest.raises(RequestNotSent):
-                notify_subscriptions(
-                    MOCK_SUBSCRIPTION_INFO["id"],
+                send_notification(
+                    MOCK_SUBSCRIPTION_INFO,
                     "elixir-cloud-aai/pubgrade:0.0.1",
                     MOCK_BUILD_INFO["id"],
                 )
@@ -456,44 +580,49 @@ class TestSubscriptions:
             )
             assert data["state"] == "Inactive"
 
-    @patch("requests.request", mocked_request_api)
-    def test_notify_subscriptions_value_not_matched(self):
+    @patch("requests.Session.request", mocked_request_api_timeout_error)
+    def test_deliver_notification(self):
         self.setup()
-        MOCK_SUBSCRIPTION_INFO["value"] = "master"
         self.insert_subscription()
+        delivery = {
+            "subscription_id": MOCK_SUBSCRIPTION_INFO["id"],
+            "image": "elixir-cloud-aai/pubgrade:0.0.1",
+            "build_id": MOCK_BUILD_INFO["id"],
+        }
         with self.app.app_context():
-            notify_subscriptions(
-                MOCK_SUBSCRIPTION_INFO["id"],
-                "elixir-cloud-aai/pubgrade:0.0.1",
-                MOCK_BUILD_INFO["id"],
-            )
+            with pytest.raises(RequestNotSent):
+                deliver_notification(delivery)
             data = (
                 self.app.config["FOCA"]
                 .db.dbs["pubgradeStore"]
                 .collections["subscriptions"]
                 .client.find_one({"id": MOCK_SUBSCRIPTION_INFO["id"]})
             )
-            assert isinstance(data, dict)
-            assert data["state"] == "Inactive"
-            assert "build_id" not in data
+            # Subscriptions are deactivated once the notification is given
+            # up on, see `pubgrade.modules.outbox`.
+            assert data["state"] == "Active"
+            # Callbacks to the host are postponed after repeated failures.
+            with pytest.raises(RequestNotSent):
+                deliver_notification(delivery)
+            with pytest.raises(DeliveryDeferred):
+                deliver_notification(delivery)
 
-    @patch("requests.request", mocked_request_api)
-    def test_notify_subscriptions_type_not_matched(self):
+    @patch("requests.Session.request", mocked_request_api_error_status)
+    def test_deliver_notification_rejected(self):
         self.setup()
-        MOCK_SUBSCRIPTION_INFO["type"] = "tag"
         self.insert_subscription()
+        delivery = {
+            "subscription_id": MOCK_SUBSCRIPTION_INFO["id"],
+            "image": "elixir-cloud-aai/pubgrade:0.0.1",
+            "build_id": MOCK_BUILD_INFO["id"],
+        }
         with self.app.app_context():
-            notify_subscriptions(
-                MOCK_SUBSCRIPTION_INFO["id"],
-                "elixir-cloud-aai/pubgrade:0.0.1",
-                MOCK_BUILD_INFO["id"],
-            )
-            data = (
-                self.app.config["FOCA"]
-                .db.dbs["pubgradeStore"]
-                .collections["subscriptions"]
-                .client.find_one({"id": MOCK_SUBSCRIPTION_INFO["id"]})
+            # Hosts rejecting callbacks are up; their breaker stays closed.
+            for _ in range(3):
+                with pytest.raises(RequestNotSent):
+                    deliver_notification(delivery)
+            # Notifications of deleted subscriptions are dropped.
+            assert (
+                deliver_notification({**delivery, "subscription_id": "id"})
+                is None
             )
-            assert isinstance(data, dict)
-            assert data["state"] == "Inactive"
-            assert "build_id" not in data
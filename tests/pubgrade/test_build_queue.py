@@ -0,0 +1,131 @@
+"""Tests for build queue"""
+import datetime
+from unittest.mock import MagicMock
+
+import mongomock
+from flask import Flask
+from foca.models.config import Config, MongoConfig
+
+from pubgrade.modules.build_queue import (
+    BuildWorkerPool,
+    claim_build,
+    complete_build,
+    enqueue_build,
+    release_build,
+)
+from tests.mock_data import ENDPOINT_CONFIG, MONGO_CONFIG
+
+
+class TestBuildQueue:
+    app = Flask(__name__)
+
+    def setup(self):
+        self.app.config["FOCA"] = Config(
+            db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+        )
+        self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "build_queue"
+        ].client = mongomock.MongoClient().db.collection
+        self.queue = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["build_queue"]
+            .client
+        )
+
+    def test_enqueue_build(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_build("eiic.gngdgrs", "eiic.g")
+        job = self.queue.find_one({"id": "eiic.gngdgrs"})
+        assert job["state"] == "QUEUED"
+        assert job["attempts"] == 0
+
+    def test_claim_build_oldest_first(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_build("eiic.gngdgrs", "eiic.g")
+            enqueue_build("eiic.gnabmns", "eiic.g")
+            job = claim_build("worker-1", 900)
+            assert job["id"] == "eiic.gngdgrs"
+            assert job["state"] == "CLAIMED"
+            assert job["claimed_by"] == "worker-1"
+            assert job["attempts"] == 1
+            assert claim_build("worker-2", 900)["id"] == "eiic.gnabmns"
+            assert claim_build("worker-3", 900) is None
+
+    def test_claim_build_abandoned(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_build("eiic.gngdgrs", "eiic.g")
+            claim_build("worker-1", 900)
+            self.queue.update_one(
+                {"id": "eiic.gngdgrs"},
+                {
+                    "$set": {
+                        "claimed_at": datetime.datetime.utcnow()
+                        - datetime.timedelta(seconds=1000)
+                    }
+                },
+            )
+            job = claim_build("worker-2", 900)
+            assert job["claimed_by"] == "worker-2"
+            assert job["attempts"] == 2
+
+    def test_complete_build(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_build("eiic.gngdgrs", "eiic.g")
+            claim_build("worker-1", 900)
+            complete_build("eiic.gngdgrs", "worker-2")
+            assert self.queue.find_one({"id": "eiic.gngdgrs"}) is not None
+            complete_build("eiic.gngdgrs", "worker-1")
+            assert self.queue.find_one({"id": "eiic.gngdgrs"}) is None
+
+    def test_release_build(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_build("eiic.gngdgrs", "eiic.g")
+            claim_build("worker-1", 900)
+            release_build("eiic.gngdgrs", "worker-1")
+            assert claim_build("worker-2", 900)["attempts"] == 2
+
+    def test_worker_pool_run_once(self):
+        self.setup()
+        handler = MagicMock()
+        failure_handler = MagicMock()
+        pool = BuildWorkerPool(self.app, handler, failure_handler)
+        with self.app.app_context():
+            enqueue_build("eiic.gngdgrs", "eiic.g")
+        assert pool.run_once("worker-1")
+        assert not pool.run_once("worker-1")
+        assert handler.call_count == 1
+        failure_handler.assert_not_called()
+        assert self.queue.find_one({"id": "eiic.gngdgrs"}) is None
+
+    def test_worker_pool_run_once_retries(self):
+        self.setup()
+        error = Exception("clone failed")
+        handler = MagicMock(side_effect=error)
+        failure_handler = MagicMock()
+        retry_handler = MagicMock(side_effect=Exception("cleanup failed"))
+        pool = BuildWorkerPool(
+            self.app,
+            handler,
+            failure_handler,
+            retry_handler=retry_handler,
+            max_attempts=2,
+        )
+        with self.app.app_context():
+            enqueue_build("eiic.gngdgrs", "eiic.g")
+        pool.run_once("worker-1")
+        # Builds are retried even if cleaning up after an attempt failed.
+        assert self.queue.find_one({"id": "eiic.gngdgrs"})["state"] == (
+            "QUEUED"
+        )
+        failure_handler.assert_not_called()
+        pool.run_once("worker-1")
+        assert handler.call_count == 2
+        assert retry_handler.call_count == 1
+        assert failure_handler.call_args[0][1] is error
+        assert self.queue.find_one({"id": "eiic.gngdgrs"}) is None
@@ -0,0 +1,193 @@
+"""Tests for post-build task queue"""
+import datetime
+from unittest.mock import MagicMock, patch
+
+import mongomock
+from flask import Flask
+from foca.models.config import Config, MongoConfig
+
+from pubgrade.modules.build_tasks import (
+    TaskWorkerPool,
+    add_pending_steps,
+    claim_task,
+    enqueue_pending_steps,
+    enqueue_task,
+)
+from tests.mock_data import ENDPOINT_CONFIG, MOCK_BUILD_INFO, MONGO_CONFIG
+
+
+class TestBuildTasks:
+    app = Flask(__name__)
+
+    def setup(self):
+        self.app.config["FOCA"] = Config(
+            db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+        )
+        for collection in ["builds", "build_tasks"]:
+            self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+                collection
+            ].client = mongomock.MongoClient().db.collection
+        self.builds = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        self.builds.insert_one(MOCK_BUILD_INFO)
+        self.tasks = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["build_tasks"]
+            .client
+        )
+
+    def get_step(self, step):
+        build = self.builds.find_one({"id": MOCK_BUILD_INFO["id"]})
+        return build["images"][0]["steps"][step]
+
+    def test_enqueue_task(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "sign", {"key": "value"})
+        task = self.tasks.find_one({"step": "sign"})
+        assert task["state"] == "QUEUED"
+        assert task["payload"] == {"key": "value"}
+        assert self.get_step("sign")["status"] == "QUEUED"
+
+    def add_pending_step(self, step, payload=None):
+        self.builds.update_one(
+            {"id": MOCK_BUILD_INFO["id"]},
+            add_pending_steps({}, 0, {step: payload}),
+        )
+
+    def test_enqueue_task_pending(self):
+        self.setup()
+        self.add_pending_step("sign", {"key": "value"})
+        assert self.get_step("sign")["status"] == "PENDING"
+        with self.app.app_context():
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "sign", {"key": "value"})
+            # Queued concurrently, e.g. by `enqueue_pending_steps`.
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "sign", {"key": "value"})
+        assert self.tasks.count_documents({"step": "sign"}) == 1
+        assert self.get_step("sign")["status"] == "QUEUED"
+        build = self.builds.find_one({"id": MOCK_BUILD_INFO["id"]})
+        assert build["pending_steps"] == 0
+
+    def test_enqueue_pending_steps(self):
+        self.setup()
+        self.add_pending_step("sign")
+        self.add_pending_step("cleanup", {"pod_names": ["pod"]})
+        with self.app.app_context():
+            assert enqueue_pending_steps(["sign", "cleanup"], 60) == 0
+            assert enqueue_pending_steps(["cleanup"], 0) == 1
+        task = self.tasks.find_one({"step": "cleanup"})
+        assert task["payload"] == {"pod_names": ["pod"]}
+        assert self.get_step("sign")["status"] == "PENDING"
+        assert self.get_step("cleanup")["status"] == "QUEUED"
+
+    def test_claim_task_due(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "sign")
+            self.tasks.update_one(
+                {"step": "sign"},
+                {
+                    "$set": {
+                        "run_after": datetime.datetime.utcnow()
+                        + datetime.timedelta(seconds=60)
+                    }
+                },
+            )
+            assert claim_task("worker-1", 300) is None
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "notify")
+            task = claim_task("worker-1", 300)
+            assert task["step"] == "notify"
+            assert task["state"] == "RUNNING"
+            assert task["attempts"] == 1
+            assert claim_task("worker-2", 300) is None
+
+    def test_claim_task_abandoned(self):
+        self.setup()
+        with self.app.app_context():
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "sign")
+            claim_task("worker-1", 300)
+            self.tasks.update_one(
+                {"step": "sign"},
+                {
+                    "$set": {
+                        "claimed_at": datetime.datetime.utcnow()
+                        - datetime.timedelta(seconds=400)
+                    }
+                },
+            )
+            task = claim_task("worker-2", 300)
+            assert task["claimed_by"] == "worker-2"
+            assert task["attempts"] == 2
+
+    def test_worker_pool_run_once(self):
+        self.setup()
+        handler = MagicMock()
+        pool = TaskWorkerPool(self.app, {"sign": handler})
+        with self.app.app_context():
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "sign")
+        assert pool.run_once("worker-1")
+        assert not pool.run_once("worker-1")
+        assert handler.call_args[0][0]["step"] == "sign"
+        assert self.tasks.find_one({"step": "sign"}) is None
+        step = self.get_step("sign")
+        assert step["status"] == "SUCCEEDED"
+        assert step["attempts"] == 1
+
+    def test_worker_pool_run_once_retries(self):
+        self.setup()
+        handler = MagicMock(side_effect=Exception("callback failed"))
+        pool = TaskWorkerPool(
+            self.app, {"notify": handler}, max_attempts=2, backoff_base=0
+        )
+        with self.app.app_context():
+            enqueue_task(MOCK_BUILD_INFO["id"], 0, "notify")
+        pool.run_once("worker-1")
+        assert self.tasks.find_one({"step": "notify"})["state"] == "QUEUED"
+        step = self.get_step("notify")
+        assert step["status"] == "QUEUED"
+        assert "callback failed" in step["error"]
+        pool.run_once("worker-1")
+        assert handler.call_count == 2
+        assert self.tasks.find_one({"step": "notify"})["state"] == "FAILED"
+        assert self.get_step("notify")["status"] == "FAILED"
+        assert not pool.run_once("worker-1")
+
+    def test_worker_pool_run_once_pending(self):
+        self.setup()
+        handler = MagicMock()
+        pool = TaskWorkerPool(
+            self.app, {"sign": handler}, claim_timeout=0, sweep_interval=60
+        )
+        self.add_pending_step("sign")
+        assert pool.run_once("worker-1")
+        assert handler.call_count == 1
+        # Steps are looked for at most every `sweep_interval` seconds.
+        self.add_pending_step("sign")
+        assert not pool.run_once("worker-1")
+        assert self.get_step("sign")["status"] == "PENDING"
+
+    def test_worker_pool_join(self):
+        pool = TaskWorkerPool(self.app, {})
+        pool._threads = [MagicMock(), MagicMock()]
+        with patch(
+            "pubgrade.modules.build_tasks.time.monotonic",
+            MagicMock(side_effect=[0, 3, 10]),
+        ):
+            pool.join(5)
+        # Threads share one deadline.
+        pool._threads[0].join.assert_called_once_with(2)
+        pool._threads[1].join.assert_called_once_with(0)
+
+    def test_get_delay(self):
+        pool = TaskWorkerPool(self.app, {}, backoff_base=5, backoff_max=30)
+        assert [pool.get_delay(attempts) for attempts in range(1, 5)] == [
+            5,
+            10,
+            20,
+            30,
+        ]
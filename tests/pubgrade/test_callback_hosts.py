@@ -0,0 +1,137 @@
+"""Tests for circuit breakers and rate limits of callback hosts"""
+from unittest.mock import patch
+
+import mongomock
+from flask import Flask
+from foca.models.config import Config, MongoConfig
+
+import pubgrade.modules.callback_hosts as callback_hosts
+from pubgrade.modules.callback_hosts import (
+    CallbackHosts,
+    CircuitBreaker,
+    TokenBucket,
+    get_callback_hosts,
+)
+from tests.mock_data import ENDPOINT_CONFIG, MONGO_CONFIG
+
+
+@patch("time.time")
+def test_circuit_breaker(mock_time):
+    mock_time.return_value = 100
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30)
+    breaker.record_failure()
+    assert breaker.get_delay() is None
+    breaker.record_failure()
+    assert breaker.state == "OPEN"
+    assert breaker.get_delay() == 30
+    mock_time.return_value = 130
+    # A single call probes the host.
+    assert breaker.get_delay() is None
+    breaker.acquire()
+    assert breaker.state == "HALF_OPEN"
+    assert breaker.get_delay() == 30
+    breaker.record_failure()
+    assert breaker.state == "OPEN"
+    mock_time.return_value = 160
+    assert breaker.get_delay() is None
+    breaker.acquire()
+    breaker.record_success()
+    assert breaker.state == "CLOSED"
+    assert breaker.failures == 0
+
+
+@patch("time.time")
+def test_token_bucket(mock_time):
+    mock_time.return_value = 100
+    bucket = TokenBucket(rate=2, burst=2)
+    assert bucket.try_acquire() is None
+    assert bucket.try_acquire() is None
+    assert bucket.try_acquire() == 0.5
+    mock_time.return_value = 100.5
+    assert bucket.try_acquire() is None
+    mock_time.return_value = 200
+    bucket.refill()
+    assert bucket.tokens == 2
+
+
+def get_app():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "callback_hosts"
+    ].client = mongomock.MongoClient().db.collection
+    return app
+
+
+def test_callback_hosts():
+    hosts = CallbackHosts(
+        circuit_breaker={"failure_threshold": 1, "recovery_timeout": 30},
+        rate_limit={"rate": 1, "burst": 1},
+    )
+    with get_app().app_context():
+        assert hosts.acquire("broken.example.org") is None
+        hosts.record("broken.example.org", success=False)
+        assert hosts.acquire("broken.example.org") > 0
+        # Other hosts are not affected.
+        assert hosts.acquire("callback.example.org") is None
+        assert hosts.acquire("callback.example.org") > 0
+        states = hosts.get_states()
+    assert states["broken.example.org"]["state"] == "OPEN"
+    assert states["broken.example.org"]["retry_in"] > 0
+    assert states["callback.example.org"]["state"] == "CLOSED"
+    assert states["callback.example.org"]["tokens"] < 1
+
+
+def test_callback_hosts_shared():
+    settings = {
+        "circuit_breaker": {"failure_threshold": 1, "recovery_timeout": 30},
+        "rate_limit": {"rate": 1, "burst": 1},
+    }
+    # E.g. the API and a notifier replica.
+    hosts, other_hosts = CallbackHosts(**settings), CallbackHosts(**settings)
+    with get_app().app_context():
+        hosts.record("broken.example.org", success=False)
+        assert other_hosts.acquire("broken.example.org") > 0
+        assert other_hosts.get_states()["broken.example.org"]["state"] == (
+            "OPEN"
+        )
+
+
+def test_callback_hosts_concurrent_change():
+    hosts = CallbackHosts(rate_limit={"rate": 1, "burst": 2})
+    app = get_app()
+    collection = (
+        app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["callback_hosts"]
+        .client
+    )
+    with app.app_context():
+        assert hosts.acquire("callback.example.org") is None
+        update_one = collection.update_one
+
+        # Another process takes the last token while it is being taken.
+        def update_one_concurrently(*args, **kwargs):
+            collection.update_one = update_one
+            collection.update_one(
+                {"host": "callback.example.org"},
+                {"$set": {"bucket.tokens": 0.0}, "$inc": {"version": 1}},
+            )
+            return update_one(*args, **kwargs)
+
+        collection.update_one = update_one_concurrently
+        assert hosts.acquire("callback.example.org") > 0
+
+
+def test_get_callback_hosts():
+    app = get_app()
+    with patch.object(callback_hosts, "_callback_hosts", None):
+        with app.app_context():
+            hosts = get_callback_hosts()
+            assert hosts is get_callback_hosts()
+        assert (
+            hosts.circuit_breaker
+            == ENDPOINT_CONFIG["notifications"]["circuit_breaker"]
+        )
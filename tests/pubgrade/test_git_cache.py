@@ -0,0 +1,129 @@
+"""Tests for git mirror cache"""
+import os
+
+from git import Repo
+
+from pubgrade.modules.git_cache import (
+    MirrorCache,
+    _dir_size,
+    get_mirror_cache,
+    normalize_repository_url,
+)
+
+
+def create_source_repository(path):
+    repo = Repo.init(path)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "pubgrade")
+        config.set_value("user", "email", "pubgrade@example.org")
+    commit_file(repo, "Dockerfile", "FROM python:3\n")
+    repo.git.branch("-M", "main")
+    return repo
+
+
+def commit_file(repo, name, content):
+    with open(os.path.join(repo.working_tree_dir, name), "w") as f:
+        f.write(content)
+    repo.index.add([name])
+    return repo.index.commit(f"Add {name}").hexsha
+
+
+def test_normalize_repository_url():
+    expected = "github.com/elixir-cloud-aai/drs-filer"
+    assert normalize_repository_url(
+        "https://github.com/elixir-cloud-aai/drs-filer"
+    ) == expected
+    assert normalize_repository_url(
+        "https://user@GitHub.com/elixir-cloud-aai/drs-filer.git/"
+    ) == expected
+    assert normalize_repository_url(
+        "git@github.com:elixir-cloud-aai/drs-filer.git"
+    ) == expected
+    assert normalize_repository_url(
+        "ssh://git@github.com:2222/elixir-cloud-aai/drs-filer"
+    ) == "github.com:2222/elixir-cloud-aai/drs-filer"
+
+
+def test_mirror_path_same_for_equivalent_urls(tmp_path):
+    cache = MirrorCache(str(tmp_path / "mirrors"), 1024)
+    assert cache.mirror_path(
+        "https://github.com/elixir-cloud-aai/drs-filer"
+    ) == cache.mirror_path("https://github.com/elixir-cloud-aai/drs-filer.git")
+
+
+def test_update_fetches_new_commits(tmp_path):
+    source = create_source_repository(str(tmp_path / "source"))
+    cache = MirrorCache(str(tmp_path / "mirrors"), 1024)
+    mirror_path = cache.update(source.working_tree_dir)
+    assert os.path.isdir(mirror_path)
+    new_commit = commit_file(source, "README.md", "readme")
+    cache.update(source.working_tree_dir)
+    assert Repo(mirror_path).commit("main").hexsha == new_commit
+
+
+def test_checkout_worktree(tmp_path):
+    source = create_source_repository(str(tmp_path / "source"))
+    first_commit = source.head.commit.hexsha
+    commit_file(source, "README.md", "readme")
+    cache = MirrorCache(str(tmp_path / "mirrors"), 1024)
+
+    clone_path = str(tmp_path / "build123" / "source")
+    assert cache.checkout_worktree(
+        source.working_tree_dir, clone_path, "main"
+    ) == clone_path
+    assert os.path.isfile(os.path.join(clone_path, "README.md"))
+
+    clone_path_2 = str(tmp_path / "build456" / "source")
+    cache.checkout_worktree(
+        source.working_tree_dir, clone_path_2, first_commit
+    )
+    assert Repo(clone_path_2).head.commit.hexsha == first_commit
+    assert not os.path.isfile(os.path.join(clone_path_2, "README.md"))
+
+
+def test_checkout_worktree_sparse(tmp_path):
+    source = create_source_repository(str(tmp_path / "source"))
+    os.makedirs(os.path.join(source.working_tree_dir, "services", "api"))
+    os.makedirs(os.path.join(source.working_tree_dir, "docs"))
+    commit_file(source, "services/api/Dockerfile", "FROM python:3\n")
+    commit_file(source, "docs/index.md", "docs")
+    cache = MirrorCache(str(tmp_path / "mirrors"), 1024)
+
+    clone_path = str(tmp_path / "build123" / "source")
+    cache.checkout_worktree(
+        source.working_tree_dir, clone_path, "main", ["services/api"]
+    )
+    assert os.path.isfile(
+        os.path.join(clone_path, "services", "api", "Dockerfile")
+    )
+    assert not os.path.isdir(os.path.join(clone_path, "docs"))
+
+
+def test_evict_least_recently_used(tmp_path):
+    source_1 = create_source_repository(str(tmp_path / "source_1"))
+    source_2 = create_source_repository(str(tmp_path / "source_2"))
+    cache = MirrorCache(str(tmp_path / "mirrors"), 1024)
+    mirror_1 = cache.update(source_1.working_tree_dir)
+    mirror_2 = cache.update(source_2.working_tree_dir)
+    os.utime(mirror_1, (0, 0))
+    cache.max_size = _dir_size(mirror_2)
+    cache.evict()
+    assert not os.path.isdir(mirror_1)
+    assert os.path.isdir(mirror_2)
+
+
+def test_evict_skips_mirrors_with_worktrees(tmp_path):
+    source = create_source_repository(str(tmp_path / "source"))
+    cache = MirrorCache(str(tmp_path / "mirrors"), 1024)
+    clone_path = str(tmp_path / "build123" / "source")
+    cache.checkout_worktree(source.working_tree_dir, clone_path, "main")
+    cache.max_size = 1
+    cache.evict()
+    assert os.path.isdir(cache.mirror_path(source.working_tree_dir))
+
+
+def test_get_mirror_cache(tmp_path):
+    cache_dir = str(tmp_path / "mirrors")
+    assert get_mirror_cache(cache_dir, 1024) is get_mirror_cache(
+        cache_dir, 1024
+    )
@@ -0,0 +1,121 @@
+"""Tests for shared HTTP client"""
+import email.utils
+import io
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+from flask import Flask
+from foca.models.config import Config, MongoConfig
+
+import pubgrade.modules.http_client as http_client
+from pubgrade.modules.http_client import (
+    HttpClient,
+    get_http_client,
+    get_rate_limit_delay,
+)
+from tests.mock_data import ENDPOINT_CONFIG, MONGO_CONFIG
+
+
+def get_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    # Responses of retried requests are closed.
+    response.raw = io.BytesIO()
+    return response
+
+
+def get_client(responses):
+    client = HttpClient(max_retries=2, backoff_base=0, max_retry_after=10)
+    client.session.request = MagicMock(side_effect=responses)
+    return client
+
+
+@patch("time.sleep")
+def test_request_retries_idempotent(mock_sleep):
+    client = get_client([get_response(503), get_response(200)])
+    response = client.request("PUT", "https://callback.example.org/update")
+    assert response.status_code == 200
+    assert client.session.request.call_count == 2
+    assert client.session.request.call_args[1]["timeout"] == (5, 30)
+    stats = client.get_stats()["callback.example.org"]
+    assert stats["requests"] == 2
+    assert stats["errors"] == 1
+    assert stats["retries"] == 1
+    assert stats["last_status_code"] == 200
+
+
+@patch("time.sleep")
+def test_request_does_not_retry_post(mock_sleep):
+    client = get_client(
+        [get_response(503)] + [requests.exceptions.ReadTimeout()]
+    )
+    response = client.request("POST", "https://api.github.com/dispatches")
+    assert response.status_code == 503
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.request("POST", "https://api.github.com/dispatches")
+    assert client.session.request.call_count == 2
+    mock_sleep.assert_not_called()
+
+
+@patch("time.sleep")
+def test_request_retries_connect_timeout(mock_sleep):
+    client = get_client(
+        [requests.exceptions.ConnectTimeout(), get_response(204)]
+    )
+    response = client.request("POST", "https://api.github.com/dispatches")
+    assert response.status_code == 204
+    assert client.get_stats()["api.github.com"]["errors"] == 1
+
+
+@patch("time.sleep")
+def test_request_gives_up(mock_sleep):
+    client = get_client([requests.exceptions.ConnectionError()] * 3)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.request("GET", "https://callback.example.org/update")
+    assert client.session.request.call_count == 3
+
+
+@patch("time.sleep")
+def test_request_rate_limited(mock_sleep):
+    client = get_client(
+        [
+            get_response(403, {"Retry-After": "3"}),
+            get_response(
+                403,
+                {
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset": str(int(time.time()) + 3600),
+                },
+            ),
+        ]
+    )
+    response = client.request("POST", "https://api.github.com/dispatches")
+    # Rate limit resetting too late for a retry.
+    assert response.status_code == 403
+    mock_sleep.assert_called_once_with(3)
+
+
+def test_get_rate_limit_delay():
+    assert get_rate_limit_delay(get_response(429, {"Retry-After": "5"})) == 5
+    retry_at = email.utils.formatdate(time.time() + 60, usegmt=True)
+    delay = get_rate_limit_delay(get_response(503, {"Retry-After": retry_at}))
+    assert 55 < delay <= 60
+    assert get_rate_limit_delay(get_response(403)) is None
+    assert get_rate_limit_delay(get_response(200)) is None
+
+
+def test_get_http_client():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    with patch.object(http_client, "_http_client", None):
+        with app.app_context():
+            client = get_http_client()
+            assert client is get_http_client()
+        assert client.max_retries == ENDPOINT_CONFIG["http"]["max_retries"]
+        assert client.timeout == (5, 30)
+        assert client.max_duration == 107
@@ -0,0 +1,83 @@
+"""Tests for Kubernetes client holder"""
+import threading
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+from foca.models.config import Config, MongoConfig
+from kubernetes.client import ApiException
+
+import pubgrade.modules.kubernetes_client as kubernetes_client
+from pubgrade.modules.kubernetes_client import (
+    KubernetesClient,
+    get_kubernetes_client,
+)
+from tests.mock_data import ENDPOINT_CONFIG, MONGO_CONFIG
+
+
+@patch("kubernetes.config.load_kube_config")
+def test_get_api_client_loads_config_once(mock_load_kube_config):
+    holder = KubernetesClient(pool_size=3)
+    api_clients = []
+    threads = [
+        threading.Thread(
+            target=lambda: api_clients.append(holder.get_api_client())
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_load_kube_config.call_count == 1
+    assert all(api_client is api_clients[0] for api_client in api_clients)
+    assert api_clients[0].configuration.connection_pool_maxsize == 3
+    assert holder.core_v1().api_client is api_clients[0]
+
+
+@patch("kubernetes.config.load_kube_config")
+def test_get_api_client_refresh(mock_load_kube_config):
+    holder = KubernetesClient(config_refresh_interval=0)
+    first = holder.get_api_client()
+    first.close = MagicMock()
+    first.rest_client.pool_manager.clear = MagicMock()
+    assert holder.get_api_client() is not first
+    assert mock_load_kube_config.call_count == 2
+    # Connections of the replaced client are not leaked.
+    first.close.assert_called_once()
+    first.rest_client.pool_manager.clear.assert_called_once()
+
+
+@patch("kubernetes.config.load_kube_config")
+def test_reset_if_unauthorized(mock_load_kube_config):
+    holder = KubernetesClient()
+    first = holder.get_api_client()
+    holder.reset_if_unauthorized(ApiException(status=404))
+    assert holder.get_api_client() is first
+    first.close = MagicMock()
+    holder.reset_if_unauthorized(ApiException(status=401))
+    assert holder.get_api_client() is not first
+    first.close.assert_called_once()
+    assert mock_load_kube_config.call_count == 2
+
+
+def test_get_kubernetes_client():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    with patch.object(kubernetes_client, "_kubernetes_client", None):
+        with app.app_context():
+            holder = get_kubernetes_client()
+            assert holder is get_kubernetes_client()
+        assert holder.pool_size == (
+            ENDPOINT_CONFIG["builds"]["kubernetes"]["pool_size"]
+        )
+        assert holder.request_timeout == (5, 60)
+
+
+def test_request_timeout():
+    holder = KubernetesClient(connect_timeout=2, read_timeout=10)
+    assert holder.request_timeout == (2, 10)
+    holder.get_api_client = MagicMock()
+    holder.core_v1()
+    holder.get_api_client.assert_called_once()
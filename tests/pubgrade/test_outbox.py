@@ -0,0 +1,362 @@
+"""Tests for notification outbox"""
+import datetime
+from unittest.mock import MagicMock
+
+import mongomock
+from flask import Flask
+from foca.models.config import Config, MongoConfig
+
+from pubgrade.errors.exceptions import RequestNotSent
+from pubgrade.modules.outbox import (
+    DeliveryDeferred,
+    DeliveryWorkerPool,
+    add_notifications,
+    complete_delivery,
+    dead_letter_delivery,
+    get_dead_letters,
+    get_waves,
+    lease_delivery,
+    record_sent_sequence,
+    replay_dead_letters,
+)
+from tests.mock_data import (
+    ENDPOINT_CONFIG,
+    MOCK_BUILD_INFO,
+    MOCK_SUBSCRIPTION_INFO,
+    MONGO_CONFIG,
+)
+
+IMAGE = "akash7778/test-updater:0.0.1"
+SUBSCRIPTIONS = [{"id": "tnglot"}, {"id": "sub123"}, {"id": "sub456"}]
+GATED_POLICY = {"canary_percent": 10, "wave_size": 1, "gate_on_acks": True}
+
+
+def test_get_waves():
+    assert get_waves(3, {}) == [0, 0, 0]
+    assert get_waves(5, {"wave_size": 2}) == [0, 0, 1, 1, 2]
+    assert get_waves(5, {"canary_percent": 30, "wave_size": 3}) == [
+        0,
+        0,
+        1,
+        1,
+        1,
+    ]
+    # Canary waves contain at least one notification.
+    assert get_waves(2, {"canary_percent": 1}) == [0, 1]
+    assert get_waves(0, {"canary_percent": 10}) == []
+
+
+class TestOutbox:
+    app = Flask(__name__)
+
+    def setup(self):
+        self.app.config["FOCA"] = Config(
+            db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+        )
+        for collection in [
+            "builds",
+            "subscriptions",
+            "notification_outbox",
+            "notification_dead_letters",
+            "notification_sequences",
+        ]:
+            self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+                collection
+            ].client = mongomock.MongoClient().db.collection
+        self.builds = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        self.builds.insert_one(dict(MOCK_BUILD_INFO))
+        self.subscriptions = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["subscriptions"]
+            .client
+        )
+        self.subscriptions.insert_one(
+            {**MOCK_SUBSCRIPTION_INFO, "state": "Active"}
+        )
+        self.outbox = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["notification_outbox"]
+            .client
+        )
+
+    def get_notifications(self, build_id=MOCK_BUILD_INFO["id"]):
+        build = self.builds.find_one({"id": build_id})
+        return build["images"][0]["notifications"]
+
+    def test_add_notifications(self):
+        self.setup()
+        with self.app.app_context():
+            for _ in range(2):
+                add_notifications(
+                    MOCK_BUILD_INFO["id"],
+                    0,
+                    IMAGE,
+                    [{"id": "tnglot"}, {"id": "sub123"}],
+                    "1",
+                )
+        assert self.outbox.count_documents({}) == 2
+        delivery = self.outbox.find_one({"subscription_id": "sub123"})
+        assert delivery["state"] == "PENDING"
+        assert delivery["image"] == IMAGE
+        assert [
+            notification["status"]
+            for notification in self.get_notifications()
+        ] == ["PENDING", "PENDING"]
+
+    def test_worker_pool_run_once(self):
+        self.setup()
+        deliver = MagicMock()
+        pool = DeliveryWorkerPool(self.app, deliver)
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"], 0, IMAGE, [{"id": "tnglot"}], "1"
+            )
+        assert pool.run_once("worker-1")
+        assert not pool.run_once("worker-1")
+        assert deliver.call_args[0][0]["subscription_id"] == "tnglot"
+        assert self.outbox.count_documents({}) == 0
+        notification = self.get_notifications()[0]
+        assert notification["status"] == "SENT"
+        assert notification["attempts"] == 1
+        assert notification["finished_at"] is not None
+
+    def test_worker_pool_run_once_dead_letters(self):
+        self.setup()
+        deliver = MagicMock(side_effect=RequestNotSent)
+        pool = DeliveryWorkerPool(
+            self.app, deliver, max_attempts=2, backoff_base=0
+        )
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"], 0, IMAGE, [{"id": "tnglot"}], "1"
+            )
+        pool.run_once("worker-1")
+        assert self.outbox.find_one()["state"] == "PENDING"
+        assert self.get_notifications()[0]["status"] == "PENDING"
+        # Subscriptions stay active while notifications are retried.
+        assert self.subscriptions.find_one()["state"] == "Active"
+        pool.run_once("worker-1")
+        assert deliver.call_count == 2
+        assert self.outbox.count_documents({}) == 0
+        assert self.get_notifications()[0]["status"] == "FAILED"
+        assert self.subscriptions.find_one()["state"] == "Inactive"
+        with self.app.app_context():
+            dead_letters = get_dead_letters()
+        assert len(dead_letters) == 1
+        assert dead_letters[0]["attempts"] == 2
+        assert not pool.run_once("worker-1")
+
+    def test_replay_dead_letters(self):
+        self.setup()
+        deliver = MagicMock(side_effect=[RequestNotSent, None])
+        pool = DeliveryWorkerPool(
+            self.app, deliver, max_attempts=1, backoff_base=0
+        )
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"], 0, IMAGE, [{"id": "tnglot"}], "1"
+            )
+        pool.run_once("worker-1")
+        assert self.subscriptions.find_one()["state"] == "Inactive"
+        with self.app.app_context():
+            assert replay_dead_letters(["unknown"]) == []
+            replayed = replay_dead_letters()
+            assert len(replayed) == 1
+            assert get_dead_letters() == []
+        assert self.subscriptions.find_one()["state"] == "Active"
+        assert pool.run_once("worker-1")
+        notification = self.get_notifications()[0]
+        assert notification["status"] == "SENT"
+        assert notification["attempts"] == 1
+
+    def test_lease_delivery_expired(self):
+        self.setup()
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"], 0, IMAGE, [{"id": "tnglot"}], "1"
+            )
+            delivery = lease_delivery("worker-1", 60)
+            assert delivery["leased_by"] == "worker-1"
+            assert lease_delivery("worker-2", 60) is None
+            # Worker 1 stopped without renewing its lease.
+            self.outbox.update_one(
+                {"id": delivery["id"]},
+                {
+                    "$set": {
+                        "lease_expires_at": datetime.datetime.utcnow()
+                        - datetime.timedelta(seconds=1)
+                    }
+                },
+            )
+            delivery_2 = lease_delivery("worker-2", 60)
+            assert delivery_2["leased_by"] == "worker-2"
+            assert delivery_2["attempts"] == 2
+            assert not complete_delivery(delivery, "worker-1")
+            assert not dead_letter_delivery(delivery, "worker-1", "error")
+            assert get_dead_letters() == []
+            assert complete_delivery(delivery_2, "worker-2")
+        assert self.get_notifications()[0]["status"] == "SENT"
+
+    def test_worker_pool_renew_leases(self):
+        self.setup()
+
+        def deliver(delivery):
+            # Lease is about to expire while the notification is being sent.
+            lease_expires_at = datetime.datetime.utcnow()
+            self.outbox.update_one(
+                {"id": delivery["id"]},
+                {"$set": {"lease_expires_at": lease_expires_at}},
+            )
+            pool.renew_leases()
+            assert self.outbox.find_one()["lease_expires_at"] > (
+                lease_expires_at + datetime.timedelta(seconds=30)
+            )
+
+        deliver = MagicMock(side_effect=deliver)
+        pool = DeliveryWorkerPool(self.app, deliver, visibility_timeout=60)
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"], 0, IMAGE, [{"id": "tnglot"}], "1"
+            )
+        assert pool.run_once("worker-1")
+        deliver.assert_called_once()
+        assert self.get_notifications()[0]["status"] == "SENT"
+
+    def test_worker_pool_run_once_deferred(self):
+        self.setup()
+        deliver = MagicMock(side_effect=DeliveryDeferred(30))
+        pool = DeliveryWorkerPool(self.app, deliver, max_attempts=1)
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"], 0, IMAGE, [{"id": "tnglot"}], "1"
+            )
+        assert pool.run_once("worker-1")
+        # Postponed notifications are not due and keep their attempts.
+        assert not pool.run_once("worker-1")
+        delivery = self.outbox.find_one()
+        assert delivery["state"] == "PENDING"
+        assert delivery["attempts"] == 0
+        assert delivery["run_after"] > datetime.datetime.utcnow()
+        assert self.get_notifications()[0]["status"] == "PENDING"
+
+    def test_add_notifications_supersedes(self):
+        self.setup()
+        build = {
+            key: value
+            for key, value in MOCK_BUILD_INFO.items()
+            if key != "_id"
+        }
+        self.builds.insert_one({**build, "id": "build456"})
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"],
+                0,
+                IMAGE,
+                [{"id": "tnglot", "debounce": 60}],
+                "1",
+            )
+            run_after = self.outbox.find_one()["run_after"]
+            add_notifications(
+                "build456",
+                0,
+                "akash7778/test-updater:0.0.2",
+                [{"id": "tnglot", "debounce": 60}],
+                "2",
+            )
+            # Notifications about older builds are not sent anymore.
+            add_notifications(
+                "build789", 0, IMAGE, [{"id": "tnglot"}], "0"
+            )
+        assert self.get_notifications()[0]["status"] == "SUPERSEDED"
+        delivery = self.outbox.find_one()
+        assert self.outbox.count_documents({}) == 1
+        assert delivery["build_id"] == "build456"
+        # The newer notification is sent when the first would have been.
+        assert delivery["run_after"] == run_after
+        assert run_after > datetime.datetime.utcnow()
+        assert self.get_notifications("build456")[0]["status"] == "PENDING"
+
+    def test_worker_pool_run_once_superseded(self):
+        self.setup()
+        deliver = MagicMock()
+        pool = DeliveryWorkerPool(self.app, deliver)
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"], 0, IMAGE, [{"id": "tnglot"}], "1"
+            )
+            delivery = self.outbox.find_one()
+            # A newer build's notification was sent meanwhile.
+            record_sent_sequence({**delivery, "sequence": "2"})
+        assert pool.run_once("worker-1")
+        deliver.assert_not_called()
+        assert self.outbox.count_documents({}) == 0
+        assert self.get_notifications()[0]["status"] == "SUPERSEDED"
+
+    def test_worker_pool_run_once_gated_waves(self):
+        self.setup()
+        deliver = MagicMock()
+        pool = DeliveryWorkerPool(self.app, deliver)
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"],
+                0,
+                IMAGE,
+                SUBSCRIPTIONS,
+                "1",
+                delivery_policy=GATED_POLICY,
+            )
+        assert [
+            notification["status"]
+            for notification in self.get_notifications()
+        ] == ["PENDING", "WAITING", "WAITING"]
+        assert pool.run_once("worker-1")
+        assert [
+            notification["status"]
+            for notification in self.get_notifications()
+        ] == ["SENT", "PENDING", "WAITING"]
+        assert pool.run_once("worker-1")
+        assert pool.run_once("worker-1")
+        assert not pool.run_once("worker-1")
+        assert [
+            call[0][0]["subscription_id"] for call in deliver.call_args_list
+        ] == ["tnglot", "sub123", "sub456"]
+
+    def test_worker_pool_run_once_halted_waves(self):
+        self.setup()
+        deliver = MagicMock(side_effect=RequestNotSent)
+        pool = DeliveryWorkerPool(
+            self.app, deliver, max_attempts=1, backoff_base=0
+        )
+        with self.app.app_context():
+            add_notifications(
+                MOCK_BUILD_INFO["id"],
+                0,
+                IMAGE,
+                SUBSCRIPTIONS,
+                "1",
+                delivery_policy=GATED_POLICY,
+            )
+        assert pool.run_once("worker-1")
+        # Later waves are not sent after the canary failed.
+        assert not pool.run_once("worker-1")
+        deliver.assert_called_once()
+        assert self.outbox.count_documents({}) == 0
+        assert [
+            notification["status"]
+            for notification in self.get_notifications()
+        ] == ["FAILED", "FAILED", "FAILED"]
+        with self.app.app_context():
+            dead_letters = get_dead_letters()
+        assert len(dead_letters) == 3
+        assert sorted(
+            dead_letter["subscription_id"]
+            for dead_letter in dead_letters
+            if dead_letter["error"].startswith("Rollout halted")
+        ) == ["sub123", "sub456"]
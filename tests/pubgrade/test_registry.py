@@ -0,0 +1,128 @@
+"""Tests for registry client"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from pubgrade.errors.exceptions import RegistryError
+from pubgrade.modules.registry import (
+    RegistryClient,
+    get_registry_client,
+    image_exists,
+    parse_image_reference,
+    with_tag,
+)
+
+TOKEN = "registry-token"
+
+
+class LocalRegistry(BaseHTTPRequestHandler):
+    """Minimal stand-in for a registry with a token service."""
+
+    manifests = {("pubgrade/test-updater", "8cd58eb")}
+    token_requests = []
+
+    def do_HEAD(self):
+        if self.headers.get("Authorization") != "Bearer %s" % TOKEN:
+            self.send_response(401)
+            self.send_header(
+                "WWW-Authenticate",
+                'Bearer realm="http://%s:%s/token",service="local"'
+                % self.server.server_address,
+            )
+            self.end_headers()
+            return
+        repository, _, reference = (
+            self.path[len("/v2/"):].rpartition("/manifests/")
+        )
+        if (repository, reference) in self.manifests:
+            self.send_response(200)
+        elif repository == "pubgrade/broken":
+            self.send_response(500)
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def do_GET(self):
+        self.token_requests.append(self.path)
+        body = json.dumps({"token": TOKEN, "expires_in": 300}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def registry():
+    server = HTTPServer(("127.0.0.1", 0), LocalRegistry)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    LocalRegistry.token_requests.clear()
+    yield "127.0.0.1:%s" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_image_reference():
+    assert parse_image_reference("ttl.sh/test-updater:1h") == (
+        "ttl.sh",
+        "test-updater",
+        "1h",
+    )
+    assert parse_image_reference("akash7778/test-updater") == (
+        "registry-1.docker.io",
+        "akash7778/test-updater",
+        "latest",
+    )
+    assert parse_image_reference("python:3.9") == (
+        "registry-1.docker.io",
+        "library/python",
+        "3.9",
+    )
+    assert parse_image_reference("localhost:5000/pubgrade/api@sha256:ab") == (
+        "localhost:5000",
+        "pubgrade/api",
+        "sha256:ab",
+    )
+
+
+def test_with_tag():
+    assert with_tag("ttl.sh/test-updater:1h", "8cd58eb") == (
+        "ttl.sh/test-updater:8cd58eb"
+    )
+    assert with_tag("localhost:5000/pubgrade", "8cd58eb") == (
+        "localhost:5000/pubgrade:8cd58eb"
+    )
+
+
+def test_manifest_exists(registry):
+    client = RegistryClient(registry, scheme="http")
+    assert client.manifest_exists("pubgrade/test-updater", "8cd58eb")
+    assert not client.manifest_exists("pubgrade/test-updater", "1111111")
+    # Token is cached per repository scope.
+    assert len(LocalRegistry.token_requests) == 1
+    assert "scope=repository%3Apubgrade%2Ftest-updater%3Apull" in (
+        LocalRegistry.token_requests[0]
+    )
+
+
+def test_manifest_exists_unexpected_response(registry):
+    client = RegistryClient(registry, scheme="http")
+    with pytest.raises(RegistryError):
+        client.manifest_exists("pubgrade/broken", "8cd58eb")
+
+
+def test_manifest_exists_registry_unreachable():
+    client = RegistryClient("127.0.0.1:1", timeout=1, scheme="http")
+    with pytest.raises(RegistryError):
+        client.manifest_exists("pubgrade/test-updater", "8cd58eb")
+
+
+def test_image_exists(registry):
+    assert image_exists("%s/pubgrade/test-updater:8cd58eb" % registry)
+    assert get_registry_client(registry) is get_registry_client(registry)
+    assert get_registry_client(registry).scheme == "http"
@@ -0,0 +1,172 @@
+"""Tests for build scheduler"""
+import datetime
+from unittest.mock import MagicMock
+
+import mongomock
+from flask import Flask
+from foca.models.config import Config, MongoConfig
+
+from pubgrade.modules.build_queue import BuildWorkerPool, enqueue_build
+from pubgrade.modules.scheduler import (
+    BuildScheduler,
+    get_queue_status,
+    get_running_builds,
+    release_slot,
+)
+from tests.mock_data import ENDPOINT_CONFIG, MONGO_CONFIG
+
+
+class TestBuildScheduler:
+    app = Flask(__name__)
+
+    def setup(self):
+        self.app.config["FOCA"] = Config(
+            db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+        )
+        for collection in [
+            "builds",
+            "build_queue",
+            "build_slots",
+            "repositories",
+        ]:
+            self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+                collection
+            ].client = mongomock.MongoClient().db.collection
+        self.builds = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["builds"]
+            .client
+        )
+        self.queue = (
+            self.app.config["FOCA"]
+            .db.dbs["pubgradeStore"]
+            .collections["build_queue"]
+            .client
+        )
+
+    def enqueue(self, build_id, repository_id, age=0):
+        self.builds.insert_one({"id": build_id, "status": "QUEUED"})
+        enqueue_build(build_id, repository_id)
+        self.queue.update_one(
+            {"id": build_id},
+            {
+                "$set": {
+                    "queued_at": datetime.datetime.utcnow()
+                    - datetime.timedelta(seconds=age)
+                }
+            },
+        )
+
+    def test_claim_global_limit(self):
+        self.setup()
+        scheduler = BuildScheduler(2, 2)
+        with self.app.app_context():
+            self.enqueue("repo_1.aaaa", "repo_1")
+            self.enqueue("repo_2.aaaa", "repo_2")
+            self.enqueue("repo_3.aaaa", "repo_3")
+            assert scheduler.claim("worker-1", 900) is not None
+            assert scheduler.claim("worker-1", 900) is not None
+            assert scheduler.claim("worker-1", 900) is None
+            assert get_running_builds([])["global"] == 2
+
+    def test_claim_repository_limit(self):
+        self.setup()
+        scheduler = BuildScheduler(10, 1)
+        with self.app.app_context():
+            self.enqueue("repo_1.aaaa", "repo_1", age=20)
+            self.enqueue("repo_1.bbbb", "repo_1", age=10)
+            self.app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+                "repositories"
+            ].client.insert_one({"id": "repo_2", "max_concurrent_builds": 2})
+            self.enqueue("repo_2.aaaa", "repo_2")
+            self.enqueue("repo_2.bbbb", "repo_2")
+            claimed = [
+                scheduler.claim("worker-1", 900)["id"] for _ in range(3)
+            ]
+            assert scheduler.claim("worker-1", 900) is None
+            assert sorted(claimed) == [
+                "repo_1.aaaa",
+                "repo_2.aaaa",
+                "repo_2.bbbb",
+            ]
+            job = self.queue.find_one({"id": "repo_1.bbbb"})
+            assert job["state"] == "QUEUED"
+            assert job["attempts"] == 0
+
+    def test_claim_fair_share(self):
+        self.setup()
+        scheduler = BuildScheduler(10, 5)
+        with self.app.app_context():
+            self.enqueue("repo_1.aaaa", "repo_1", age=30)
+            self.enqueue("repo_1.bbbb", "repo_1", age=20)
+            self.enqueue("repo_2.aaaa", "repo_2", age=10)
+            assert scheduler.claim("worker-1", 900)["id"] == "repo_1.aaaa"
+            # repo_1 has a running build, so repo_2 goes first.
+            assert scheduler.claim("worker-1", 900)["id"] == "repo_2.aaaa"
+            assert scheduler.claim("worker-1", 900)["id"] == "repo_1.bbbb"
+
+    def test_release_slot(self):
+        self.setup()
+        scheduler = BuildScheduler(1, 1)
+        with self.app.app_context():
+            self.enqueue("repo_1.aaaa", "repo_1")
+            self.enqueue("repo_1.bbbb", "repo_1")
+            assert scheduler.claim("worker-1", 900)["id"] == "repo_1.aaaa"
+            assert scheduler.claim("worker-1", 900) is None
+            release_slot("repo_1.aaaa")
+            release_slot("repo_1.aaaa")
+            assert get_running_builds(["repo_1"]) == {
+                "global": 0,
+                "repo_1": 0,
+            }
+            assert scheduler.claim("worker-1", 900)["id"] == "repo_1.bbbb"
+
+    def test_claim_abandoned_build_keeps_slot(self):
+        self.setup()
+        scheduler = BuildScheduler(1, 1)
+        with self.app.app_context():
+            self.enqueue("repo_1.aaaa", "repo_1")
+            scheduler.claim("worker-1", 900)
+            self.queue.update_one(
+                {"id": "repo_1.aaaa"},
+                {
+                    "$set": {
+                        "claimed_at": datetime.datetime.utcnow()
+                        - datetime.timedelta(seconds=1000)
+                    }
+                },
+            )
+            assert scheduler.claim("worker-2", 900)["id"] == "repo_1.aaaa"
+            assert get_running_builds([])["global"] == 1
+
+    def test_worker_pool_releases_slot_on_error(self):
+        self.setup()
+        scheduler = BuildScheduler(1, 1)
+        handler = MagicMock(side_effect=Exception("clone failed"))
+        pool = BuildWorkerPool(
+            self.app, handler, MagicMock(), scheduler=scheduler
+        )
+        with self.app.app_context():
+            self.enqueue("repo_1.aaaa", "repo_1")
+        assert pool.run_once("worker-1")
+        with self.app.app_context():
+            assert get_running_builds([])["global"] == 0
+            assert not self.builds.find_one({"id": "repo_1.aaaa"})[
+                "slot_held"
+            ]
+
+    def test_get_queue_status(self):
+        self.setup()
+        scheduler = BuildScheduler(10, 1)
+        with self.app.app_context():
+            self.enqueue("repo_1.aaaa", "repo_1", age=30)
+            self.enqueue("repo_1.bbbb", "repo_1", age=20)
+            scheduler.claim("worker-1", 900)
+            status = get_queue_status(10)
+        assert status["queued"] == 1
+        assert status["running"] == 1
+        assert status["oldest_wait_seconds"] >= 20
+        assert status["average_wait_seconds"] >= 30
+        assert status["repositories"][0]["repository_id"] == "repo_1"
+        assert status["repositories"][0]["running"] == 1
@@ -1,7 +1,9 @@
 import mongomock
 import pytest
+import requests
 
 from flask import Flask
+from werkzeug.exceptions import Unauthorized
 
 from foca.models.config import Config
 from foca.models.config import MongoConfig
@@ -21,16 +23,23 @@ from pubgrade.modules.server import (
     postBuild,
     getBuilds,
     getBuildInfo,
+    getBuildQueue,
     updateBuild,
+    postBuildCompletions,
     postSubscription,
     getSubscriptions,
     getSubscriptionInfo,
+    getSubscriptionUpdates,
     deleteSubscription,
     postUser,
     getUsers,
     verifyUser,
     unverifyUser,
     deleteUser,
+    getHttpDestinations,
+    getCallbackHosts,
+    getDeadLetters,
+    postDeadLettersReplay,
 )
 
 from tests.mock_data import (
@@ -45,6 +54,7 @@ from tests.mock_data import (
     MOCK_BUILD_INFO_2,
     SUBSCRIPTION_PAYLOAD,
     MOCK_ADMIN_USER_1,
+    MOCK_DEAD_LETTER,
 )
 
 drs_url = "https://github.com/elixir-cloud-aai/drs-filer.git"
@@ -52,8 +62,10 @@ user_access_token = "c42a6d44e3d0"
 uid = "9fe2c4e93f654fdbb24c02b15259716c"
 
 
-def mocked_request_api(method, url, data, headers):
-    return "successful"
+def mocked_request_api(self, method, url, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    return response
 
 
 def test_getRepositories():
@@ -208,6 +220,9 @@ def test_postBuild():
     app.config["FOCA"].db.dbs["pubgradeStore"].collections[
         "builds"
     ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "build_queue"
+    ].client = mongomock.MongoClient().db.collection
     with app.test_request_context(
         json=MOCK_BUILD_PAYLOAD,
         headers={
@@ -271,16 +286,45 @@ def test_getBuildInfo():
         assert isinstance(res, dict)
 
 
-def mock_remove_files(dir_location: str, pod_name: str, namespace: str):
-    return "remove files successful"
+def test_getBuildQueue():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    for collection in ["builds", "build_queue", "build_slots", "admin_users"]:
+        app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            collection
+        ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client.insert_one(MOCK_ADMIN_USER_1)
+    with app.test_request_context(
+        headers={
+            "X-Super-User-Id": MOCK_ADMIN_USER_1["uid"],
+            "X-Super-User-Access-Token": MOCK_ADMIN_USER_1[
+                "user_access_token"
+            ],
+        },
+    ):
+        res = getBuildQueue.__wrapped__()
+        assert res["queued"] == 0
+        assert res["running"] == 0
+    with app.test_request_context(
+        headers={
+            "X-Super-User-Id": MOCK_ADMIN_USER_1["uid"],
+            "X-Super-User-Access-Token": "invalid",
+        },
+    ):
+        with pytest.raises(Unauthorized):
+            getBuildQueue.__wrapped__()
 
 
-def mock_notify_subscriptions():
-    return "notify successful"
+def mock_remove_files(dir_location: str, pod_name: str, namespace: str):
+    return "remove files successful"
 
 
 @patch("pubgrade.modules.endpoints.builds.remove_files", mock_remove_files)
-@patch("requests.request", mocked_request_api)
+@patch("requests.Session.request", mocked_request_api)
 def test_updateBuild():
     app = Flask(__name__)
     app.config["FOCA"] = Config(
@@ -305,6 +349,18 @@ def test_updateBuild():
     app.config["FOCA"].db.dbs["pubgradeStore"].collections[
         "builds"
     ].client.insert_one(MOCK_BUILD_INFO)
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "build_tasks"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "notification_outbox"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "subscription_updates"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "notification_sequences"
+    ].client = mongomock.MongoClient().db.collection
     with app.test_request_context(
         json=MOCK_BUILD_PAYLOAD,
         headers={
@@ -318,6 +374,57 @@ def test_updateBuild():
         assert isinstance(res, dict)
 
 
+@patch("pubgrade.modules.endpoints.builds.remove_files", mock_remove_files)
+@patch("requests.Session.request", mocked_request_api)
+def test_postBuildCompletions():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "repositories"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "subscriptions"
+    ].client = mongomock.MongoClient().db.collection
+    for repository in MOCK_REPOSITORIES:
+        app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            "repositories"
+        ].client.insert_one(repository)
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "builds"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "builds"
+    ].client.insert_one(MOCK_BUILD_INFO)
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "build_tasks"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "notification_outbox"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "subscription_updates"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "notification_sequences"
+    ].client = mongomock.MongoClient().db.collection
+    with app.test_request_context(
+        json={
+            "completions": [
+                {
+                    "repository_id": MOCK_REPOSITORIES[1]["id"],
+                    "build_id": MOCK_BUILD_INFO["id"],
+                    "access_token": MOCK_REPOSITORIES[1]["access_token"],
+                }
+            ]
+        },
+        headers={"Content-Type": "application/json"},
+    ):
+        res = postBuildCompletions.__wrapped__()
+        assert res["results"][0]["status_code"] == 200
+
+
 def test_postSubscription():
     app = Flask(__name__)
     app.config["FOCA"] = Config(
@@ -401,6 +508,34 @@ def test_getSubscriptionInfo():
         assert isinstance(res, dict)
 
 
+def test_getSubscriptionUpdates():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    for collection in ["users", "subscriptions", "subscription_updates"]:
+        app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            collection
+        ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "users"
+    ].client.insert_one(MOCK_USER_DB)
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "subscriptions"
+    ].client.insert_one(MOCK_SUBSCRIPTION_INFO)
+    with app.test_request_context(
+        headers={
+            "X-User-Access-Token": user_access_token,
+            "X-User-Id": uid,
+            "Content-Type": "application/json",
+        }
+    ):
+        res = getSubscriptionUpdates.__wrapped__(
+            MOCK_SUBSCRIPTION_INFO["id"], since=0, wait=0
+        )
+        assert res == {"updates": [], "cursor": 0}
+
+
 def test_deleteSubscription():
     app = Flask(__name__)
     app.config["FOCA"] = Config(
@@ -574,3 +709,125 @@ def test_unverify_user():
     ):
         response = unverifyUser.__wrapped__(MOCK_USER_DB["uid"])
         assert response == "User unverified successfully."
+
+
+def test_getHttpDestinations():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client.insert_one(MOCK_ADMIN_USER_1)
+    with app.test_request_context(
+        headers={
+            "X-Super-User-Id": MOCK_ADMIN_USER_1["uid"],
+            "X-Super-User-Access-Token": MOCK_ADMIN_USER_1[
+                "user_access_token"
+            ],
+        },
+    ):
+        res = getHttpDestinations.__wrapped__()
+        assert isinstance(res, list)
+
+
+def test_getCallbackHosts():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client.insert_one(MOCK_ADMIN_USER_1)
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "callback_hosts"
+    ].client = mongomock.MongoClient().db.collection
+    with app.test_request_context(
+        headers={
+            "X-Super-User-Id": MOCK_ADMIN_USER_1["uid"],
+            "X-Super-User-Access-Token": MOCK_ADMIN_USER_1[
+                "user_access_token"
+            ],
+        },
+    ):
+        res = getCallbackHosts.__wrapped__()
+        assert isinstance(res, list)
+
+
+def test_getDeadLetters():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client.insert_one(MOCK_ADMIN_USER_1)
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "notification_dead_letters"
+    ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "notification_dead_letters"
+    ].client.insert_one(dict(MOCK_DEAD_LETTER))
+    with app.test_request_context(
+        headers={
+            "X-Super-User-Id": MOCK_ADMIN_USER_1["uid"],
+            "X-Super-User-Access-Token": MOCK_ADMIN_USER_1[
+                "user_access_token"
+            ],
+        },
+    ):
+        res = getDeadLetters.__wrapped__()
+        assert res[0]["id"] == MOCK_DEAD_LETTER["id"]
+        assert res[0]["dead_lettered_at"] == "2021-08-05T10:00:00"
+
+
+def test_postDeadLettersReplay():
+    app = Flask(__name__)
+    app.config["FOCA"] = Config(
+        db=MongoConfig(**MONGO_CONFIG), endpoints=ENDPOINT_CONFIG
+    )
+    for collection in [
+        "admin_users",
+        "builds",
+        "subscriptions",
+        "notification_outbox",
+        "notification_dead_letters",
+    ]:
+        app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+            collection
+        ].client = mongomock.MongoClient().db.collection
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "admin_users"
+    ].client.insert_one(MOCK_ADMIN_USER_1)
+    app.config["FOCA"].db.dbs["pubgradeStore"].collections[
+        "notification_dead_letters"
+    ].client.insert_one(dict(MOCK_DEAD_LETTER))
+    with app.test_request_context(
+        json={"ids": [MOCK_DEAD_LETTER["id"]]},
+        headers={
+            "X-Super-User-Id": MOCK_ADMIN_USER_1["uid"],
+            "X-Super-User-Access-Token": MOCK_ADMIN_USER_1[
+                "user_access_token"
+            ],
+            "Content-Type": "application/json",
+        },
+    ):
+        res = postDeadLettersReplay.__wrapped__()
+        assert res == {"replayed": [MOCK_DEAD_LETTER["id"]]}
+    delivery = (
+        app.config["FOCA"]
+        .db.dbs["pubgradeStore"]
+        .collections["notification_outbox"]
+        .client.find_one({"id": MOCK_DEAD_LETTER["id"]})
+    )
+    assert delivery["state"] == "PENDING"
+    assert delivery["attempts"] == 0